@@ -1,14 +1,50 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
-from werkzeug.utils import secure_filename
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_file
 from flask_cors import CORS
+from werkzeug.exceptions import HTTPException
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
+import secrets
 from datetime import datetime
-import json
 from functools import wraps
+import click
+from storage import Store
+from audit import AuditLog, AuditError, CHECKPOINT_EVERY
+from sqlstore import SqliteStore, DB_FILE, import_json
+from blobs import BlobStore, decode_data_uri
+from images import ImagePipeline
+from photomatch import PhotoIndex, SIMILAR_DISTANCE, DUPLICATE_DISTANCE
+from search import ReportSearch
+from matching import NameMatcher, find_duplicates
+from listing import ListingError, list_response, ranked_needed
+from httpcache import ResponseCache
+from jobs import JobQueue
+from uploads import Uploads
+from sessions import SqliteSessionInterface
+from ratelimit import RateLimiter, MemoryBuckets, SqliteBuckets, benchmark as benchmark_buckets
+from passwords import Passwords, parse_hash, benchmark as benchmark_scrypt
+from feed import ChangeFeed, FeedError
+from metrics import Metrics
+from geo import Gazetteer, GeoIndex, GeoError, parse_bbox, parse_point, DEFAULT_RADIUS_KM, MAX_RADIUS_KM, WORLD
 
 app = Flask(__name__)
-CORS(app)  # Enable CORS for all routes
-app.secret_key = 'your-secret-key-here'  # Required for flash messages and sessions
+# Behind reverse proxies (nginx, a load balancer) every request comes from a
+# proxy's address, so rate limits would be shared by all clients.
+# TRUSTED_PROXIES=<number of proxies> takes the client address, scheme and
+# host from the X-Forwarded-* headers they add. Only set it when clients can
+# reach the app through those proxies alone, or they could forge the headers.
+trusted_proxies = int(os.environ.get('TRUSTED_PROXIES', 0))
+if trusted_proxies:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=trusted_proxies, x_proto=trusted_proxies,
+                            x_host=trusted_proxies)
+CORS(app, expose_headers=['X-Next-Cursor', 'Link', 'ETag', 'X-Profile-Id'])  # Enable CORS for all routes
+# Sessions live server-side (below), so the key needn't be shared between workers
+app.secret_key = os.environ.get('SECRET_KEY') or secrets.token_hex(32)
+
+# Session data in SQLite, shared by all workers; the cookie only holds its id
+app.session_interface = SqliteSessionInterface('data/sessions.sqlite3')
+
+# Per-IP/per-user token buckets for login, signup and submission routes
+limiter = RateLimiter(app, 'data/ratelimit.sqlite3')
 
 # Configure upload folder
 UPLOAD_FOLDER = 'static/uploads'
@@ -19,9 +55,278 @@ if not os.path.exists(UPLOAD_FOLDER):
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Reports, pending reports, info updates and users, kept in memory by id and
+# persisted to the JSON files (default) or, with STORE_BACKEND=sqlite, to SQLite
+if os.environ.get('STORE_BACKEND') == 'sqlite':
+    store = SqliteStore(os.path.join('data', DB_FILE))
+else:
+    store = Store('data', snapshot_format=os.environ.get('SNAPSHOT_FORMAT', 'json'))
+
+# Every change to the file store kept as segmented history, for report
+# history and point-in-time listings (not kept with STORE_BACKEND=sqlite)
+audit = None
+if not isinstance(store, SqliteStore):
+    audit = AuditLog(store, int(os.environ.get('AUDIT_CHECKPOINT_EVERY', CHECKPOINT_EVERY)))
+
+# Per-route timings split by phase, data file I/O counters and /metrics
+metrics = Metrics(app, store)
+
+# Report photos, stored once per distinct content and referenced by hash.
+# Originals keep their EXIF (GPS included) and are never served; only the
+# resized renditions, which carry no metadata, are
+blobs = BlobStore(os.path.abspath('data/blobs'))
+renditions = BlobStore(os.path.abspath('data/renditions'))
+
+# Uploads stream to disk with size/type checks and land in the blob store by rename
+uploads = Uploads(app, blobs)
+
+# Password hashing, on a bounded thread pool so login bursts queue instead of piling up
+passwords = Passwords(app)
+
+# Resizes uploads into thumb/card/full renditions (run as a background job)
+image_pipeline = ImagePipeline(blobs, renditions)
+
+# Perceptual-hash index for "reports with a similar photo"
+photo_index = PhotoIndex(store.reports, store.pending_reports)
+
+# Offline place-name lookup giving reports lat/lon, and a spatial index over approved ones
+gazetteer = Gazetteer(os.environ.get('GAZETTEER_PATH', 'data/gazetteer.csv'))
+geo_index = GeoIndex(store.reports)
+
+# Inverted index over approved reports, maintained as the store changes
+report_search = ReportSearch(store)
+
+# Fuzzy/phonetic name lookup, for duplicate detection and ?fuzzy=1 searches
+approved_names = NameMatcher(store.reports)
+pending_names = NameMatcher(store.pending_reports)
+
+# Serialized read responses, revalidated against collection versions
+cache = ResponseCache(store)
+
+# Server-sent events for every report/info change, so clients needn't poll
+feed = ChangeFeed(store)
+
+# Durable queue for work that shouldn't hold up a request
+jobs = JobQueue('data/jobs.sqlite3', before_each=store.refresh)
+metrics.add_jobs(jobs)
+
+# Fold the store log into the JSON files from a job instead of mid-request
+store.compact_requested = lambda: jobs.enqueue('compact', {}, unique=True)
+
+@app.before_request
+def refresh_store():
+    # Pick up writes made by other worker processes
+    store.refresh()
+    jobs.start()
+
+@app.errorhandler(413)
+@app.errorhandler(415)
+@app.errorhandler(503)
+def upload_error(e):
+    # Upload limits can trip before a view's own error handling runs (e.g.
+    # when a rate limit reads the form); API clients still get JSON
+    if request.path.startswith('/api/'):
+        return jsonify({'error': e.description}), e.code
+    return e
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def image_url(digest):
+    return url_for('get_image', digest=digest, _external=True)
+
+# Report fields describing its photo
+PHOTO_FIELDS = ('image', 'image_id', 'images', 'phash')
+
+def rendition_digests(report):
+    """Digests of the renditions a report's 'images' URLs point at"""
+    return [url.rsplit('/', 1)[-1] for url in (report.get('images') or {}).values()]
+
+def image_fields(result):
+    """Report fields for a processed photo: rendition URLs (cards show the
+    'card' size) and its perceptual hash"""
+    if not result:
+        return {}
+    renditions = result['renditions']
+    return {
+        'image': image_url(renditions['card']),
+        'images': {name: image_url(digest) for name, digest in renditions.items()},
+        'phash': result['phash']
+    }
+
+def queue_renditions(report_id, image_id, base_url):
+    """Process a report's photo in the background and point the report at the results"""
+    return jobs.enqueue('process_photo', {
+        'report_id': report_id,
+        'image_id': image_id,
+        'base_url': base_url
+    })
+
+def location_fields(location):
+    """lat/lon for a free-text location from the gazetteer (None if no place is recognised)"""
+    place = gazetteer.geocode(location)
+    if place is None:
+        return {'lat': None, 'lon': None}
+    return {'lat': place[0], 'lon': place[1]}
+
+def form_point(values):
+    """lat/lon given explicitly in a form or JSON body, or {} if absent"""
+    if values.get('lat') in (None, '') and values.get('lon') in (None, ''):
+        return {}
+    lat, lon = parse_point(values.get('lat'), values.get('lon'))
+    return {'lat': lat, 'lon': lon}
+
+def reports_in_area(args):
+    """Approved reports inside ?bbox=, or within ?radius= km of ?lat=&lon= (closest
+    first, with distance_km); None if neither is asked for"""
+    if 'bbox' in args:
+        bbox = parse_bbox(args['bbox'])
+        found = (store.reports.get(i) for i in sorted(geo_index.within(bbox)))
+        return [r for r in found if r is not None]
+    if 'lat' not in args and 'lon' not in args:
+        return None
+    lat, lon = parse_point(args.get('lat'), args.get('lon'))
+    try:
+        radius = float(args.get('radius', DEFAULT_RADIUS_KM))
+    except ValueError:
+        raise GeoError('radius must be a number of km')
+    if not 0 < radius <= MAX_RADIUS_KM:
+        raise GeoError(f'radius must be between 0 and {MAX_RADIUS_KM} km')
+    nearby = []
+    for report_id, distance in geo_index.near(lat, lon, radius):
+        report = store.reports.get(report_id)
+        if report is not None:
+            nearby.append(dict(report, distance_km=round(distance, 3)))
+    return nearby
+
+@jobs.handler('process_photo')
+def process_photo(payload):
+    report_id = payload['report_id']
+    result = image_pipeline.process(payload['image_id'])
+    if not result:
+        return None
+    with app.test_request_context(base_url=payload['base_url']):
+        changes = image_fields(result)
+    # Another report with a near-identical photo is probably the same person
+    # (a photo too flat to hash has no phash and matches nothing)
+    photo_matches = []
+    if result['phash']:
+        photo_matches = [i for i, _ in photo_index.near(result['phash'], DUPLICATE_DISTANCE) if i != report_id]
+    # The report may have been approved while we were processing
+    with store.transaction():
+        for collection in (store.pending_reports, store.reports):
+            report = collection.get(report_id)
+            if report is None:
+                continue
+            if photo_matches:
+                duplicates = report.get('possible_duplicates') or []
+                changes['possible_duplicates'] = duplicates + [i for i in photo_matches if i not in duplicates]
+            collection.update(report_id, changes)
+            break
+    return {'report_id': report_id, 'phash': result['phash']}
+
+@jobs.handler('submit_report')
+def process_report_submission(payload):
+    report = payload['report']
+    with store.transaction():
+        # A retried or re-leased job may have stored it already
+        stored = stored_submission(store.pending_reports, store.reports, report)
+        if stored is None:
+            # Flag likely re-submissions of the same person for the moderators
+            report['possible_duplicates'] = find_duplicates((approved_names, pending_names), report['name'])
+            if report.get('lat') is None:
+                report.update(location_fields(report['location']))
+            stored = insert_submission(store.pending_reports, store.reports, report)
+    if stored.get('image_id'):
+        queue_renditions(stored['id'], stored['image_id'], payload['base_url'])
+    return {'report_id': stored['id'], 'possible_duplicates': stored.get('possible_duplicates', [])}
+
+@jobs.handler('submit_report_info')
+def process_info_submission(payload):
+    info_update = payload['info_update']
+    with store.transaction():
+        stored = stored_submission(store.pending_info, store.approved_info, info_update)
+        if stored is None:
+            stored = insert_submission(store.pending_info, store.approved_info, info_update)
+    return {'id': stored['id']}
+
+def stored_submission(pending, approved, record):
+    """The copy of a submission an earlier run of its job stored, or None.
+    insert_submission() takes the first free id from the payload's, so it is
+    the first record from there with the same submitter and time, still
+    pending or approved since."""
+    record_id = record['id']
+    while True:
+        existing = pending.get(record_id) or approved.get(record_id)
+        if existing is None:
+            return None
+        if (existing.get('submitted_by'), existing.get('submitted_at')) == \
+                (record.get('submitted_by'), record.get('submitted_at')):
+            return existing
+        record_id += 1
+
+def insert_submission(pending, approved, record):
+    """Add a submission to pending under the first id from its own that
+    neither collection uses (approval keeps the id)"""
+    with store.transaction():
+        while record['id'] in pending or record['id'] in approved:
+            record['id'] += 1
+        return pending.put(record)
+
+@jobs.handler('compact')
+def compact_store(payload):
+    # Several requests may have queued this; only the first still has work to do
+    if store.log_entries >= store.compact_every:
+        store.compact()
+
+def accepted(message, job_id):
+    """202 response pointing the client at a queued job"""
+    return jsonify({
+        'message': message,
+        'job_id': job_id,
+        'status_url': url_for('get_job', job_id=job_id, _external=True)
+    }), 202
+
+def approve_pending(pending, approved, record_id):
+    """Move a record from a pending collection to its approved one; None if missing"""
+    with store.transaction():
+        record = pending.delete(record_id)
+        if not record:
+            return None
+        return approved.put(dict(record, status='approved', approved_at=datetime.now().isoformat()))
+
+def moderate_batch(pending, approved, data):
+    """Approve/reject lists of ids in one transaction, returning per-item results"""
+    if not isinstance(data, dict):
+        # No body, malformed JSON (get_json(silent=True) gives None) or not an object
+        raise ValueError('Body must be a JSON object with approve and reject lists')
+    approve_ids = data.get('approve', [])
+    reject_ids = data.get('reject', [])
+    for ids in (approve_ids, reject_ids):
+        if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+            raise ValueError('approve and reject must be lists of ids')
+    
+    results = []
+    with store.transaction():
+        for record_id in approve_ids:
+            found = approve_pending(pending, approved, record_id) is not None
+            results.append({'id': record_id, 'action': 'approve', 'status': 'approved' if found else 'not_found'})
+        for record_id in reject_ids:
+            found = pending.delete(record_id) is not None
+            results.append({'id': record_id, 'action': 'reject', 'status': 'rejected' if found else 'not_found'})
+    return results
+
+def json_user(req):
+    return (req.get_json(silent=True) or {}).get('userId')
+
+def form_user(req):
+    return req.form.get('userId')
+
+def submitter(req):
+    if req.is_json:
+        return (req.get_json(silent=True) or {}).get('submitted_by')
+    return req.form.get('submitted_by')
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -43,6 +348,7 @@ def signup():
     return render_template('signup.html')
 
 @app.route('/auth/login', methods=['POST'])
+@limiter.limit('login', user=form_user)
 def auth_login():
     user_id = request.form.get('userId')
     password = request.form.get('password')
@@ -55,7 +361,14 @@ def auth_login():
     flash('Invalid credentials')
     return redirect(url_for('login'))
 
+@app.route('/logout')
+def logout():
+    # Drops the server-side session row, not just the cookie
+    session.clear()
+    return redirect(url_for('login'))
+
 @app.route('/auth/signup', methods=['POST'])
+@limiter.limit('signup')
 def auth_signup():
     phone = request.form.get('phone')
     user_id = request.form.get('userId')
@@ -75,6 +388,7 @@ def auth_signup():
     return redirect(url_for('home'))
 
 @app.route('/api/auth/login', methods=['POST'])
+@limiter.limit('login', user=json_user)
 def api_login():
     """API endpoint for login from React frontend"""
     try:
@@ -85,27 +399,28 @@ def api_login():
         if not user_id or not password:
             return jsonify({'error': 'User ID and password are required'}), 400
         
-        # Load users from file
-        users_file = 'data/users.json'
-        users = []
-        if os.path.exists(users_file):
-            with open(users_file, 'r') as f:
-                users = json.load(f)
-        
         # Find user and verify password
-        user = next((u for u in users if u['user_id'] == user_id), None)
-        if not user or user['password'] != password:
+        user = next(iter(store.users.find('user_id', user_id)), None)
+        matched, new_hash = passwords.verify(user['password'] if user else None, password)
+        if not matched:
             return jsonify({'error': 'Invalid credentials'}), 401
+        if new_hash:
+            # Plaintext or outdated hash: store one with the current settings
+            store.users.update(user['id'], {'password': new_hash})
         
         return jsonify({
             'message': 'Login successful',
             'user_id': user_id,
             'isLoggedIn': True
         }), 200
+    except HTTPException as e:
+        # Password workers all busy
+        return jsonify({'error': e.description}), e.code
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/auth/signup', methods=['POST'])
+@limiter.limit('signup')
 def api_signup():
     """API endpoint for signup from React frontend"""
     try:
@@ -121,47 +436,32 @@ def api_signup():
         if password != confirm_password:
             return jsonify({'error': 'Passwords do not match'}), 400
         
-        # Save user data (in a real app, you'd use a database)
-        users_file = 'data/users.json'
-        os.makedirs('data', exist_ok=True)
-        
-        users = []
-        if os.path.exists(users_file):
-            with open(users_file, 'r') as f:
-                users = json.load(f)
-        
-        # Check if user already exists
-        if any(u['user_id'] == user_id for u in users):
-            return jsonify({'error': 'User ID already exists'}), 400
-        
-        # Add new user
-        users.append({
-            'id': len(users) + 1,
-            'phone': phone,
-            'user_id': user_id,
-            'password': password,  # In production, hash this!
-            'created_at': datetime.now().isoformat()
-        })
-        
-        with open(users_file, 'w') as f:
-            json.dump(users, f)
+        # Hashed before taking the store lock, which it would otherwise hold for the whole hash
+        password_hash = passwords.hash(password)
+        with store.transaction():
+            # Check if user already exists
+            if store.users.find('user_id', user_id):
+                return jsonify({'error': 'User ID already exists'}), 400
+            
+            # Add new user
+            store.users.insert({
+                'id': len(store.users) + 1,
+                'phone': phone,
+                'user_id': user_id,
+                'password': password_hash,
+                'created_at': datetime.now().isoformat()
+            })
         
         return jsonify({'message': 'User created successfully', 'user_id': user_id}), 201
+    except HTTPException as e:
+        return jsonify({'error': e.description}), e.code
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/home')
 @login_required
 def home():
-    # Load missing persons reports from JSON file
-    reports = []
-    try:
-        with open('data/reports.json', 'r') as f:
-            reports = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        pass
-    
-    return render_template('home.html', reports=reports, user_id=session.get('user_id'))
+    return render_template('home.html', reports=store.reports.all(), user_id=session.get('user_id'))
 
 @app.route('/registration-details')
 @login_required
@@ -170,6 +470,7 @@ def registration_details():
 
 @app.route('/submit-details', methods=['POST'])
 @login_required
+@limiter.limit('submit_report', user=lambda req: session.get('user_id'))
 def submit_details():
     if 'photo' not in request.files:
         flash('No file part')
@@ -181,9 +482,7 @@ def submit_details():
         return redirect(url_for('registration_details'))
     
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
+        image_id = uploads.save(file)
         
         # Create new report
         new_report = {
@@ -193,22 +492,15 @@ def submit_details():
             'height': int(request.form.get('height')),
             'lastSeen': request.form.get('lastSeen'),
             'location': request.form.get('place'),
-            'image': f'/static/uploads/{filename}'
+            # Shown once the photo's renditions are made
+            'image': '',
+            'image_id': image_id
         }
-        
-        # Load existing reports
-        reports = []
-        try:
-            with open('data/reports.json', 'r') as f:
-                reports = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            pass
+        new_report.update(location_fields(new_report['location']))
         
         # Add new report and save
-        reports.append(new_report)
-        os.makedirs('data', exist_ok=True)
-        with open('data/reports.json', 'w') as f:
-            json.dump(reports, f)
+        store.reports.insert(new_report)
+        queue_renditions(new_report['id'], image_id, request.host_url)
         
         flash('Report submitted successfully')
         return redirect(url_for('home'))
@@ -217,6 +509,7 @@ def submit_details():
     return redirect(url_for('registration_details'))
 
 @app.route('/api/auth/admin-login', methods=['POST'])
+@limiter.limit('login', user=json_user)
 def api_admin_login():
     """API endpoint for admin login"""
     try:
@@ -246,17 +539,13 @@ def api_admin_login():
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/reports/pending', methods=['GET'])
+@cache.cached('pending_reports')
 def get_pending_reports():
     """Get all pending reports and updates"""
     try:
-        pending_file = 'data/pending_reports.json'
-        pending_reports = []
-        
-        if os.path.exists(pending_file):
-            with open(pending_file, 'r') as f:
-                pending_reports = json.load(f)
-        
-        return jsonify(pending_reports), 200
+        return list_response(store.pending_reports), 200
+    except ListingError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -264,40 +553,11 @@ def get_pending_reports():
 def approve_report(report_id):
     """Admin approves a pending report"""
     try:
-        pending_file = 'data/pending_reports.json'
-        approved_file = 'data/reports.json'
-        
-        # Load pending reports
-        pending_reports = []
-        if os.path.exists(pending_file):
-            with open(pending_file, 'r') as f:
-                pending_reports = json.load(f)
-        
-        # Find and remove the approved report
-        report = next((r for r in pending_reports if r['id'] == report_id), None)
+        # Move from pending to approved reports
+        report = approve_pending(store.pending_reports, store.reports, report_id)
         if not report:
             return jsonify({'error': 'Report not found'}), 404
         
-        pending_reports.remove(report)
-        
-        # Save updated pending reports
-        os.makedirs('data', exist_ok=True)
-        with open(pending_file, 'w') as f:
-            json.dump(pending_reports, f)
-        
-        # Add to approved reports
-        approved_reports = []
-        if os.path.exists(approved_file):
-            with open(approved_file, 'r') as f:
-                approved_reports = json.load(f)
-        
-        report['status'] = 'approved'
-        report['approved_at'] = datetime.now().isoformat()
-        approved_reports.append(report)
-        
-        with open(approved_file, 'w') as f:
-            json.dump(approved_reports, f)
-        
         return jsonify({'message': 'Report approved successfully'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -306,31 +566,28 @@ def approve_report(report_id):
 def reject_report(report_id):
     """Admin rejects a pending report"""
     try:
-        pending_file = 'data/pending_reports.json'
-        
-        # Load pending reports
-        pending_reports = []
-        if os.path.exists(pending_file):
-            with open(pending_file, 'r') as f:
-                pending_reports = json.load(f)
-        
         # Find and remove the rejected report
-        report = next((r for r in pending_reports if r['id'] == report_id), None)
+        report = store.pending_reports.delete(report_id)
         if not report:
             return jsonify({'error': 'Report not found'}), 404
         
-        pending_reports.remove(report)
-        
-        # Save updated pending reports
-        os.makedirs('data', exist_ok=True)
-        with open(pending_file, 'w') as f:
-            json.dump(pending_reports, f)
-        
         return jsonify({'message': 'Report rejected successfully'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/reports/batch', methods=['POST'])
+def moderate_reports_batch():
+    """Admin approves and rejects many pending reports at once"""
+    try:
+        results = moderate_batch(store.pending_reports, store.reports, request.get_json(silent=True))
+        return jsonify({'results': results}), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/report-info/submit', methods=['POST'])
+@limiter.limit('submit_report_info', user=submitter)
 def submit_report_info():
     """Submit new information about a missing person"""
     try:
@@ -352,21 +609,9 @@ def submit_report_info():
             'submitted_at': datetime.now().isoformat()
         }
         
-        # Load pending info updates
-        info_file = 'data/pending_info_updates.json'
-        info_updates = []
-        if os.path.exists(info_file):
-            with open(info_file, 'r') as f:
-                info_updates = json.load(f)
-        
-        info_updates.append(info_update)
-        
-        # Save info updates
-        os.makedirs('data', exist_ok=True)
-        with open(info_file, 'w') as f:
-            json.dump(info_updates, f)
-        
-        return jsonify({'message': 'Information submitted for review', 'id': info_update['id']}), 201
+        # Saved to pending info updates by a background job
+        job_id = jobs.enqueue('submit_report_info', {'info_update': info_update})
+        return accepted('Information submitted for review', job_id)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -374,75 +619,125 @@ def submit_report_info():
 def approve_info(info_id):
     """Admin approves new information"""
     try:
-        info_file = 'data/pending_info_updates.json'
-        approved_info_file = 'data/approved_info_updates.json'
-        
-        # Load pending info updates
-        info_updates = []
-        if os.path.exists(info_file):
-            with open(info_file, 'r') as f:
-                info_updates = json.load(f)
-        
-        # Find and remove the approved info
-        info = next((i for i in info_updates if i['id'] == info_id), None)
+        # Move from pending to approved info
+        info = approve_pending(store.pending_info, store.approved_info, info_id)
         if not info:
             return jsonify({'error': 'Info not found'}), 404
         
-        info_updates.remove(info)
-        
-        # Save updated pending info
-        os.makedirs('data', exist_ok=True)
-        with open(info_file, 'w') as f:
-            json.dump(info_updates, f)
-        
-        # Add to approved info
-        approved_info = []
-        if os.path.exists(approved_info_file):
-            with open(approved_info_file, 'r') as f:
-                approved_info = json.load(f)
-        
-        info['status'] = 'approved'
-        info['approved_at'] = datetime.now().isoformat()
-        approved_info.append(info)
-        
-        with open(approved_info_file, 'w') as f:
-            json.dump(approved_info, f)
-        
         return jsonify({'message': 'Information approved successfully'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/report-info/batch', methods=['POST'])
+def moderate_info_batch():
+    """Admin approves and rejects many pending information updates at once"""
+    try:
+        results = moderate_batch(store.pending_info, store.approved_info, request.get_json(silent=True))
+        return jsonify({'results': results}), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/report-info/<int:report_id>', methods=['GET'])
+@cache.cached('approved_info')
 def get_report_info(report_id):
     """Get all approved information for a report"""
     try:
-        info_file = 'data/approved_info_updates.json'
-        info_updates = []
-        
-        if os.path.exists(info_file):
-            with open(info_file, 'r') as f:
-                all_info = json.load(f)
-                info_updates = [i for i in all_info if i['report_id'] == report_id]
-        
-        return jsonify(info_updates), 200
+        info_updates = store.approved_info.find('report_id', report_id)
+        return list_response(info_updates), 200
+    except ListingError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/reports')
+@cache.cached('reports', 'approved_info')
 def get_reports():
-    search_term = request.args.get('search', '').lower()
+    search_term = request.args.get('search', '')
+    try:
+        # A page in rank order needs only the top of the ranking, unless an
+        # area filter drops some of it
+        area = any(k in request.args for k in ('bbox', 'lat', 'lon'))
+        top = None if area else ranked_needed(request.args)
+        if request.args.get('fuzzy') == '1' and search_term.strip():
+            reports = approved_names.search(search_term, limit=top)
+        else:
+            reports = report_search.search(search_term, limit=top)
+        # Search results page in rank order unless a sort= is given
+        searched = reports is not None
+        default_sort = None
+        if reports is None:
+            reports = store.reports
+            default_sort = 'id'
+        nearby = reports_in_area(request.args)
+        if nearby is not None:
+            if default_sort is None:
+                # Keep the search ranking, limited to the area
+                in_area = {r['id']: r for r in nearby}
+                reports = [in_area[r['id']] for r in reports if r['id'] in in_area]
+            else:
+                # Radius results stay closest first, bbox results go by id
+                reports = nearby
+                default_sort = 'id' if 'bbox' in request.args else None
+        # Search results come a page at a time even without paging parameters
+        return list_response(reports, default_sort=default_sort, paged=searched)
+    except (ListingError, GeoError) as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/reports/clusters', methods=['GET'])
+@cache.cached('reports')
+def get_report_clusters():
+    """Approved reports grouped into map clusters for a viewport"""
+    try:
+        bbox = parse_bbox(request.args['bbox']) if 'bbox' in request.args else WORLD
+        zoom = request.args.get('zoom', 0, type=int)
+        return jsonify(geo_index.clusters(bbox, zoom)), 200
+    except GeoError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/events', methods=['GET'])
+def get_events():
+    """Live feed of report and info changes (resumable with Last-Event-ID)"""
+    try:
+        return feed.response()
+    except FeedError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/images/<digest>', methods=['GET'])
+def get_image(digest):
+    """Serve a photo rendition by its content hash (never an original upload)"""
+    if not renditions.exists(digest):
+        return jsonify({'error': 'Image not found'}), 404
+    # Content never changes for a digest, so it doubles as a strong ETag;
+    # conditional=True answers If-None-Match and Range requests
+    return send_file(renditions.path(digest), mimetype=renditions.mimetype(digest), etag=digest,
+                     conditional=True, max_age=31536000)
+
+@app.route('/api/reports/<int:report_id>/similar-photos', methods=['GET'])
+def get_similar_photos(report_id):
+    """Approved reports whose photo looks like this report's photo"""
     try:
-        with open('data/reports.json', 'r') as f:
-            reports = json.load(f)
-            if search_term:
-                reports = [r for r in reports if 
-                          search_term in r['name'].lower() or 
-                          search_term in r['location'].lower()]
-            return jsonify(reports)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return jsonify([])
+        report = store.reports.get(report_id) or store.pending_reports.get(report_id)
+        if not report:
+            return jsonify({'error': 'Report not found'}), 404
+        if not report.get('phash'):
+            return jsonify({'error': 'Report has no photo to compare'}), 404
+        
+        max_distance = request.args.get('distance', SIMILAR_DISTANCE, type=int)
+        matches = []
+        for match_id, distance in photo_index.near(report['phash'], max_distance):
+            match = store.reports.get(match_id)
+            if match and match_id != report_id:
+                matches.append(dict(match, distance=distance))
+        return jsonify(matches), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/api/reports/submit', methods=['POST'])
+@limiter.limit('submit_report', user=submitter)
 def submit_report():
     """User submits a missing person report"""
     try:
@@ -457,14 +752,11 @@ def submit_report():
             return jsonify({'error': 'All fields are required'}), 400
         
         # Handle image
-        image_data = None
+        image_id = None
         if 'photo' in request.files:
             file = request.files['photo']
             if file and file.filename:
-                # Convert to base64
-                import base64
-                image_data = base64.b64encode(file.read()).decode('utf-8')
-                image_data = f"data:image/{file.filename.split('.')[-1]};base64,{image_data}"
+                image_id = uploads.save(file)
         
         # Create report
         report = {
@@ -474,41 +766,46 @@ def submit_report():
             'height': int(height),
             'lastSeen': last_seen,
             'location': place,
-            'image': image_data or '',
+            # Shown once the photo's renditions are made
+            'image': '',
+            'image_id': image_id,
             'submitted_by': submitted_by,
             'status': 'pending',
             'submitted_at': datetime.now().isoformat()
         }
-        
-        # Save to pending reports
-        pending_file = 'data/pending_reports.json'
-        pending_reports = []
-        if os.path.exists(pending_file):
-            with open(pending_file, 'r') as f:
-                pending_reports = json.load(f)
-        
-        pending_reports.append(report)
-        
-        os.makedirs('data', exist_ok=True)
-        with open(pending_file, 'w') as f:
-            json.dump(pending_reports, f)
-        
-        return jsonify({'message': 'Report submitted successfully', 'report_id': report['id']}), 201
+        # A map pin from the client wins over geocoding the place name
+        report.update(form_point(request.form))
+        
+        # Duplicate checks, geocoding, saving and photo processing happen in background jobs
+        job_id = jobs.enqueue('submit_report', {'report': report, 'base_url': request.host_url})
+        return accepted('Report submitted successfully', job_id)
+    except GeoError as e:
+        return jsonify({'error': str(e)}), 400
+    except HTTPException as e:
+        # Photo too large or not an image, or upload capacity full
+        return jsonify({'error': e.description}), e.code
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs/<int:job_id>', methods=['GET'])
+def get_job(job_id):
+    """Status and result of a background job"""
+    try:
+        job = jobs.get(job_id)
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(job), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/admin/reports', methods=['GET'])
+@cache.cached('reports')
 def admin_get_all_reports():
     """Admin view all approved reports"""
     try:
-        reports_file = 'data/reports.json'
-        reports = []
-        
-        if os.path.exists(reports_file):
-            with open(reports_file, 'r') as f:
-                reports = json.load(f)
-        
-        return jsonify(reports), 200
+        return list_response(store.reports), 200
+    except ListingError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -516,36 +813,15 @@ def admin_get_all_reports():
 def admin_delete_report(report_id):
     """Admin delete a report"""
     try:
-        reports_file = 'data/reports.json'
-        reports = []
-        
-        if os.path.exists(reports_file):
-            with open(reports_file, 'r') as f:
-                reports = json.load(f)
-        
-        # Find and remove the report
-        report = next((r for r in reports if r['id'] == report_id), None)
-        if not report:
-            return jsonify({'error': 'Report not found'}), 404
-        
-        reports.remove(report)
-        
-        # Save updated reports
-        os.makedirs('data', exist_ok=True)
-        with open(reports_file, 'w') as f:
-            json.dump(reports, f)
-        
-        # Also delete associated approved info updates
-        info_file = 'data/approved_info_updates.json'
-        if os.path.exists(info_file):
-            with open(info_file, 'r') as f:
-                info_updates = json.load(f)
+        with store.transaction():
+            # Find and remove the report
+            report = store.reports.delete(report_id)
+            if not report:
+                return jsonify({'error': 'Report not found'}), 404
             
-            # Remove info for this report
-            info_updates = [i for i in info_updates if i.get('report_id') != report_id]
-            
-            with open(info_file, 'w') as f:
-                json.dump(info_updates, f)
+            # Also delete associated approved info updates
+            for info in store.approved_info.find('report_id', report_id):
+                store.approved_info.delete(info['id'])
         
         return jsonify({'message': 'Report and associated information deleted successfully'}), 200
     except Exception as e:
@@ -556,38 +832,69 @@ def admin_update_report(report_id):
     """Admin update report details"""
     try:
         data = request.get_json()
-        reports_file = 'data/reports.json'
-        
-        reports = []
-        if os.path.exists(reports_file):
-            with open(reports_file, 'r') as f:
-                reports = json.load(f)
         
-        # Find and update the report
-        report = next((r for r in reports if r['id'] == report_id), None)
+        # Update allowed fields
+        changes = {k: data[k] for k in ('name', 'age', 'height', 'location', 'lastSeen') if k in data}
+        changes['updated_at'] = datetime.now().isoformat()
+        point = form_point(data)
+        if point:
+            changes.update(point)
+        elif 'location' in changes:
+            changes.update(location_fields(changes['location']))
+        
+        report = store.reports.update(report_id, changes)
         if not report:
             return jsonify({'error': 'Report not found'}), 404
         
-        # Update allowed fields
-        if 'name' in data:
-            report['name'] = data['name']
-        if 'age' in data:
-            report['age'] = data['age']
-        if 'height' in data:
-            report['height'] = data['height']
-        if 'location' in data:
-            report['location'] = data['location']
-        if 'lastSeen' in data:
-            report['lastSeen'] = data['lastSeen']
-        
-        report['updated_at'] = datetime.now().isoformat()
-        
-        # Save updated reports
-        os.makedirs('data', exist_ok=True)
-        with open(reports_file, 'w') as f:
-            json.dump(reports, f)
-        
         return jsonify({'message': 'Report updated successfully', 'report': report}), 200
+    except GeoError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def parse_time(value):
+    """Seconds since the epoch from an ISO 8601 time or a number of seconds"""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise AuditError(f'Invalid time: {value}')
+
+@app.route('/api/admin/reports/<int:report_id>/history', methods=['GET'])
+def admin_report_history(report_id):
+    """Admin view every change to a report, from submission on"""
+    try:
+        if audit is None:
+            return jsonify({'error': 'History is only kept by the file store'}), 404
+        history = [{
+            'at': datetime.fromtimestamp(entry['t']).isoformat(),
+            'collection': entry['c'],
+            'op': 'delete' if entry['op'] == 'del' else 'put',
+            'version': entry['v'],
+            'record': entry.get('r'),
+        } for entry in audit.history(('pending_reports', 'reports'), report_id)]
+        if not history:
+            return jsonify({'error': 'Report not found'}), 404
+        return jsonify({'report_id': report_id, 'history': history}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/reports/as-of', methods=['GET'])
+def admin_reports_as_of():
+    """Admin view reports as they were at ?t= (ISO time or epoch seconds);
+    ?status=pending for the pending queue"""
+    try:
+        if audit is None:
+            return jsonify({'error': 'History is only kept by the file store'}), 404
+        if 't' not in request.args:
+            return jsonify({'error': 'Missing t'}), 400
+        name = 'pending_reports' if request.args.get('status') == 'pending' else 'reports'
+        return list_response(audit.as_of(name, parse_time(request.args['t']))), 200
+    except (AuditError, ListingError) as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -614,19 +921,8 @@ def admin_add_report_info():
             'approved_at': datetime.now().isoformat()
         }
         
-        # Load approved info updates
-        info_file = 'data/approved_info_updates.json'
-        info_updates = []
-        if os.path.exists(info_file):
-            with open(info_file, 'r') as f:
-                info_updates = json.load(f)
-        
-        info_updates.append(info_update)
-        
-        # Save info updates
-        os.makedirs('data', exist_ok=True)
-        with open(info_file, 'w') as f:
-            json.dump(info_updates, f)
+        # Save to approved info updates
+        store.approved_info.insert(info_update)
         
         return jsonify({'message': 'Information added successfully', 'id': info_update['id']}), 201
     except Exception as e:
@@ -636,43 +932,142 @@ def admin_add_report_info():
 def admin_delete_report_info(info_id):
     """Admin delete approved information"""
     try:
-        info_file = 'data/approved_info_updates.json'
-        
-        info_updates = []
-        if os.path.exists(info_file):
-            with open(info_file, 'r') as f:
-                info_updates = json.load(f)
-        
         # Find and remove the info
-        info = next((i for i in info_updates if i['id'] == info_id), None)
+        info = store.approved_info.delete(info_id)
         if not info:
             return jsonify({'error': 'Information not found'}), 404
         
-        info_updates.remove(info)
-        
-        # Save updated info
-        os.makedirs('data', exist_ok=True)
-        with open(info_file, 'w') as f:
-            json.dump(info_updates, f)
-        
         return jsonify({'message': 'Information deleted successfully'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/pending-info', methods=['GET'])
+@cache.cached('pending_info')
 def get_pending_info():
     """Get all pending information updates for admin review"""
     try:
-        info_file = 'data/pending_info_updates.json'
-        info_updates = []
-        
-        if os.path.exists(info_file):
-            with open(info_file, 'r') as f:
-                info_updates = json.load(f)
-        
-        return jsonify(info_updates), 200
+        return list_response(store.pending_info), 200
+    except ListingError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.cli.command('migrate-images')
+@click.option('--base-url', default='http://localhost:5000', help='Public URL the API is served from')
+def migrate_images(base_url):
+    """Move inline base64 report photos into the blob store and process any
+    photo whose renditions are missing from the renditions store"""
+    moved = processed = skipped = 0
+    store.refresh()
+    with app.test_request_context(base_url=base_url):
+        for collection in (store.reports, store.pending_reports):
+            for report in list(collection):
+                # Decoding and re-encoding happen without the store lock;
+                # only applying the result takes it, briefly
+                photo = {key: report.get(key) for key in PHOTO_FIELDS}
+                changes = {}
+                digest = report.get('image_id')
+                data = decode_data_uri(report.get('image'))
+                if data is not None:
+                    digest = blobs.put(data)
+                    changes = {'image': '', 'image_id': digest}
+                stored = rendition_digests(report)
+                fields = {}
+                if digest and not (stored and all(renditions.exists(d) for d in stored)):
+                    fields = image_fields(image_pipeline.process(digest))
+                    if fields:
+                        changes.update(fields)
+                    elif report.get('image'):
+                        # Without Pillow there is nothing to show: originals aren't served
+                        changes['image'] = ''
+                if not changes:
+                    continue
+                with store.transaction():
+                    current = collection.get(report['id'])
+                    if current is None or any(current.get(key) != value for key, value in photo.items()):
+                        # Approved, deleted or given another photo meanwhile; a rerun picks it up
+                        skipped += 1
+                        continue
+                    collection.update(report['id'], changes)
+                moved += data is not None
+                processed += bool(fields)
+    store.compact()
+    click.echo(f'Moved {moved} inline images into {blobs.root}, processed {processed}, '
+               f'skipped {skipped} changed meanwhile (run again for those)')
+
+@app.cli.command('geocode-reports')
+@click.option('--all', 'redo', is_flag=True, help='Also redo reports that already have coordinates')
+def geocode_reports(redo):
+    """Give reports lat/lon from the gazetteer based on their location text"""
+    located = missed = 0
+    with store.transaction():
+        for collection in (store.reports, store.pending_reports):
+            for report in list(collection):
+                if report.get('lat') is not None and not redo:
+                    continue
+                changes = location_fields(report.get('location'))
+                if changes['lat'] is None:
+                    missed += 1
+                    continue
+                collection.update(report['id'], changes)
+                located += 1
+    click.echo(f'Located {located} reports using {len(gazetteer)} place names, {missed} not recognised')
+
+@app.cli.command('import-json')
+@click.option('--data-dir', default='data', help='Directory holding the JSON files and store.log')
+def import_json_command(data_dir):
+    """Copy the JSON files into the SQLite database used with STORE_BACKEND=sqlite"""
+    target = store if isinstance(store, SqliteStore) else SqliteStore(os.path.join(data_dir, DB_FILE))
+    counts = import_json(target, data_dir)
+    click.echo(f'Imported into {target.path}: ' + ', '.join(f'{n} {name}' for name, n in counts.items()))
+
+@app.cli.command('convert-snapshot')
+@click.option('--to', 'to_format', type=click.Choice(['binary', 'json']), required=True)
+def convert_snapshot(to_format):
+    """Rewrite the store's snapshot as data/store.<n>.snap or as the JSON files"""
+    if isinstance(store, SqliteStore):
+        raise click.ClickException('Only the file store has snapshots')
+    store.snapshot_format = to_format
+    store.compact()
+    click.echo(f'Wrote a {to_format} snapshot of ' + ', '.join(f'{len(c)} {n}' for n, c in store.collections.items()))
+
+@app.cli.command('hash-passwords')
+def hash_passwords():
+    """Hash plaintext passwords left in users.json (outdated hashes are
+    upgraded as their users log in)"""
+    rehashed = 0
+    with store.transaction():
+        for user in store.users:
+            if parse_hash(user.get('password')) is None:
+                store.users.update(user['id'], {'password': passwords.hash(user['password'])})
+                rehashed += 1
+    store.compact()
+    click.echo(f'Hashed {rehashed} plaintext passwords')
+
+@app.cli.command('benchmark-passwords')
+@click.option('--rounds', default=3, help='Hashes timed per setting')
+def benchmark_passwords(rounds):
+    """Time scrypt at a range of cost settings, to pick PASSWORD_SCRYPT_N"""
+    r, p = app.config['PASSWORD_SCRYPT_R'], app.config['PASSWORD_SCRYPT_P']
+    workers = app.config['PASSWORD_WORKERS']
+    current = app.config['PASSWORD_SCRYPT_N']
+    click.echo(f'r={r} p={p}, {workers} workers per process')
+    for n, ms, mb in benchmark_scrypt([2 ** i for i in range(12, 18)], r, p, rounds):
+        marker = '  (current)' if n == current else ''
+        click.echo(f'n=2**{n.bit_length() - 1:<3} {ms:8.1f} ms/hash {mb:6.0f} MB  ~{workers * 1000 / ms:6.0f} logins/s{marker}')
+
+@app.cli.command('benchmark-ratelimit')
+@click.option('--checks', default=10000, help='Checks timed per backend')
+def benchmark_ratelimit(checks):
+    """Time one rate-limit check against each bucket backend"""
+    path = 'data/ratelimit-bench.sqlite3'
+    try:
+        for name, backend in (('memory', MemoryBuckets()), ('sqlite', SqliteBuckets(path))):
+            click.echo(f'{name:<7} {benchmark_buckets(backend, checks):8.1f} us/check')
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,232 @@
+"""ASGI entry point, for holding many slow or long-lived connections per process.
+
+    uvicorn asgi:application --workers 4
+    gunicorn -k uvicorn.workers.UvicornWorker -w 4 asgi:application
+
+Every request is still handled by the Flask app in app.py: the same routes,
+hooks, sessions and error handling, so URLs and responses are identical to
+the WSGI server and the frontend needs no change. What moves onto the event
+loop is the waiting around it:
+
+  * request bodies are received on the loop, so a slow upload holds no
+    thread until it has arrived (bodies over BODY_MEMORY are spooled to a
+    temp file, written from the pool);
+  * the app then runs on a pool of ASGI_THREADS threads, which is where the
+    views block on store file I/O, SQLite and password hashing;
+  * response bodies are read from the app on the pool and sent as they
+    come, so streamed lists and photos still stream;
+  * GET /api/events streams (feed.FeedStream) are iterated on the loop, so
+    an idle subscriber costs a coroutine rather than a thread, and one
+    process can keep thousands of them open.
+
+A client that disconnects stops its response from being read any further.
+"""
+import asyncio
+import io
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app
+
+THREADS = int(os.environ.get('ASGI_THREADS', 32))
+# bodies up to this size are kept in memory, bigger ones go to a temp file
+BODY_MEMORY = 1024 * 1024
+# response bytes gathered on the pool per message sent
+CHUNK_SIZE = 64 * 1024
+
+
+def read_block(iterator):
+    """Up to about CHUNK_SIZE bytes from a WSGI iterator, and whether more follow"""
+    chunks, size = [], 0
+    for chunk in iterator:
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= CHUNK_SIZE:
+            return b''.join(chunks), True
+    return b''.join(chunks), False
+
+
+class WSGIBridge:
+    """ASGI application running a WSGI app on a thread pool"""
+
+    def __init__(self, wsgi_app, threads=THREADS, max_body=None):
+        self.wsgi_app = wsgi_app
+        self.max_body = max_body
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.pool.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+
+    async def http(self, scope, receive, send):
+        body, terminated = await self.read_body(scope, receive)
+        if body is None:
+            return
+        gone = asyncio.Event()
+        watcher = asyncio.ensure_future(self.watch_disconnect(receive, gone))
+        try:
+            await self.respond(self.environ(scope, body, terminated), send, gone)
+        finally:
+            watcher.cancel()
+            body.close()
+
+    async def read_body(self, scope, receive):
+        """The request body as a file (None if the client went away), and
+        whether it has no Content-Length"""
+        length = dict(scope['headers']).get(b'content-length')
+        if length is not None and length.isdigit() and self.max_body is not None and int(length) > self.max_body:
+            # The app answers 413 from the header alone
+            return io.BytesIO(), False
+        chunks, size, spool = [], 0, None
+        more = True
+        while more:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                if spool is not None:
+                    spool.close()
+                return None, False
+            data = message.get('body', b'')
+            more = message.get('more_body', False)
+            size += len(data)
+            if spool is not None:
+                await self.run(spool.write, data)
+            else:
+                chunks.append(data)
+                if size > BODY_MEMORY:
+                    spool = await self.run(tempfile.TemporaryFile)
+                    await self.run(spool.write, b''.join(chunks))
+                    chunks = None
+            if length is None and self.max_body is not None and size > self.max_body:
+                # Enough for the app to see it is too large and answer 413
+                break
+        if spool is None:
+            return io.BytesIO(b''.join(chunks)), length is None
+        spool.seek(0)
+        return spool, length is None
+
+    async def watch_disconnect(self, receive, gone):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                gone.set()
+                return
+
+    def environ(self, scope, body, terminated):
+        path = scope['path']
+        root_path = scope.get('root_path', '')
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+            'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f'HTTP/{scope["http_version"]}',
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        if terminated:
+            # No Content-Length: the body ends where the file does
+            environ['wsgi.input_terminated'] = True
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{name}'
+            if key in environ:
+                value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+            environ[key] = value
+        return environ
+
+    async def respond(self, environ, send, gone):
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            started[:] = [status, headers]
+
+        try:
+            app_iter = await self.run(self.wsgi_app, environ, start_response)
+        except Exception:
+            await send({'type': 'http.response.start', 'status': 500,
+                        'headers': [(b'content-type', b'text/plain')]})
+            await send({'type': 'http.response.body', 'body': b'Internal Server Error'})
+            raise
+        try:
+            if hasattr(app_iter, '__aiter__'):
+                await self.start(send, *started)
+                await self.send_async(app_iter, send, gone)
+            else:
+                iterator = iter(app_iter)
+                # The first block comes before the headers, since an app may
+                # call start_response as it starts iterating
+                data, more = await self.run(read_block, iterator)
+                await self.start(send, *started)
+                while not gone.is_set():
+                    await send({'type': 'http.response.body', 'body': data, 'more_body': more})
+                    if not more:
+                        break
+                    data, more = await self.run(read_block, iterator)
+        finally:
+            if hasattr(app_iter, 'close'):
+                await self.run(app_iter.close)
+
+    async def start(self, send, status, headers):
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+        })
+
+    async def send_async(self, app_iter, send, gone):
+        stream = app_iter.__aiter__()
+        disconnected = asyncio.ensure_future(gone.wait())
+        try:
+            while True:
+                step = asyncio.ensure_future(stream.__anext__())
+                await asyncio.wait({step, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+                if not step.done():
+                    step.cancel()
+                    await asyncio.wait({step})
+                    break
+                try:
+                    data = step.result()
+                except StopAsyncIteration:
+                    break
+                await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+            if not gone.is_set():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+            await stream.aclose()
+
+
+application = WSGIBridge(app, THREADS, app.config['MAX_CONTENT_LENGTH'])
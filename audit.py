@@ -0,0 +1,209 @@
+"""Append-only history of every store change, with point-in-time queries.
+
+Every write already costs one line in data/store.log, and each compaction
+retires that log as store.<g>.log for a generation before deleting it
+(storage.py). With an AuditLog installed the retired logs are moved into
+data/audit/ as segment.<g>.log instead, so auditing adds nothing to a
+request: the log line the write made anyway is the audit entry. Every
+CHECKPOINT_EVERY generations the compaction also leaves a checkpoint, the
+state its snapshot holds, as checkpoint.<g>.snap (a hard link when the store
+already writes binary snapshots, otherwise written with snapshot.py).
+
+    history(names, id)     every change to one record, oldest first
+    as_of(name, t)         a collection's records as they were at time t:
+                           the last checkpoint before t, plus the entries
+                           after it up to t
+
+Segments are immutable once archived and get an index (segment.<g>.idx,
+"collection:id" -> byte offsets), so history() seeks to a record's lines
+instead of parsing every segment. The entries not archived yet (the retired
+and the current store.log) are read directly. The file store only: the
+SQLite backend trims its changes table without handing rows over.
+"""
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import ExitStack
+
+from snapshot import Snapshot, write_snapshot
+from storage import LOCK_FILE, atomic_write
+
+AUDIT_DIR = 'audit'
+MANIFEST_FILE = 'checkpoints.json'
+CHECKPOINT_EVERY = 10
+# segment indexes kept parsed in memory
+INDEX_CACHE = 256
+
+SEGMENT_RE = re.compile(r'segment\.(\d+)\.log$')
+
+
+class AuditError(ValueError):
+    """History that was never recorded was asked for"""
+
+
+def read_lines(f, offset=0):
+    """(offset, entry) for each whole line of a log file from offset"""
+    f.seek(offset)
+    for line in f:
+        if line.endswith(b'\n'):
+            try:
+                yield offset, json.loads(line)
+            except json.JSONDecodeError:
+                pass
+        offset += len(line)
+
+
+class AuditLog:
+    def __init__(self, store, checkpoint_every=CHECKPOINT_EVERY):
+        self.store = store
+        self.checkpoint_every = checkpoint_every
+        self.dir = os.path.join(store.data_dir, AUDIT_DIR)
+        self.manifest_path = os.path.join(self.dir, MANIFEST_FILE)
+        os.makedirs(self.dir, exist_ok=True)
+        # Our own open of the lock file, so taking it shared never converts
+        # a lock the store's descriptor holds
+        self.lock_fd = os.open(os.path.join(store.data_dir, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        self.indexes = OrderedDict()
+        self.indexes_lock = threading.Lock()
+        store.archive = self
+        if not self.checkpoints():
+            # History starts at a checkpoint, which a compaction writes
+            store.compact()
+
+    def checkpoints(self):
+        """[(generation, time)] of the checkpoints written, oldest first"""
+        if not os.path.exists(self.manifest_path):
+            return []
+        with open(self.manifest_path) as f:
+            return [tuple(c) for c in json.load(f)]
+
+    def segment_path(self, generation):
+        return os.path.join(self.dir, f'segment.{generation}.log')
+
+    def checkpoint_path(self, generation):
+        return os.path.join(self.dir, f'checkpoint.{generation}.snap')
+
+    # --- called by Store._compact, under the exclusive lock -------------------
+
+    def compacted(self, generation, snapshot_path):
+        """Keep the log the store would now delete, and checkpoint the state
+        of the new generation when one is due"""
+        retired = self.store.retired_log_path(generation - 2)
+        if os.path.exists(retired):
+            path = self.segment_path(generation - 2)
+            os.replace(retired, path)
+            self._write_index(path)
+        checkpoints = self.checkpoints()
+        if checkpoints and generation - checkpoints[-1][0] < self.checkpoint_every:
+            return
+        path = self.checkpoint_path(generation)
+        if snapshot_path is not None:
+            os.link(snapshot_path, path)
+        else:
+            write_snapshot(path, {name: (c.all(), c.version, c.modified)
+                                  for name, c in self.store.collections.items()})
+        checkpoints.append((generation, time.time()))
+        atomic_write(self.manifest_path, json.dumps(checkpoints))
+
+    def _write_index(self, path):
+        index = {}
+        with open(path, 'rb') as f:
+            for offset, entry in read_lines(f):
+                index.setdefault(f'{entry["c"]}:{entry["id"]}', []).append(offset)
+        atomic_write(path[:-len('.log')] + '.idx', json.dumps(index))
+
+    # --- queries ----------------------------------------------------------------
+
+    def _index(self, path):
+        with self.indexes_lock:
+            index = self.indexes.get(path)
+            if index is not None:
+                self.indexes.move_to_end(path)
+                return index
+        index_path = path[:-len('.log')] + '.idx'
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+        else:
+            index = None
+        with self.indexes_lock:
+            self.indexes[path] = index
+            if len(self.indexes) > INDEX_CACHE:
+                self.indexes.popitem(last=False)
+        return index
+
+    def _open(self, since=None):
+        """Open every log holding entries from generation since on, in order,
+        as [(generation, path, file)]. Files stay readable after a compaction
+        moves them, so the lock is only held while opening."""
+        stack = ExitStack()
+        fcntl.flock(self.lock_fd, fcntl.LOCK_SH)
+        try:
+            logs = []
+            for name in os.listdir(self.dir):
+                match = SEGMENT_RE.match(name)
+                if match:
+                    logs.append((int(match.group(1)), os.path.join(self.dir, name)))
+            logs.sort()
+            generation = self.store._read_meta().get('generation', 0)
+            logs.append((generation - 1, self.store.retired_log_path(generation - 1)))
+            logs.append((generation, self.store.log_path))
+            opened = []
+            for g, path in logs:
+                if (since is None or g >= since) and os.path.exists(path):
+                    opened.append((g, path, stack.enter_context(open(path, 'rb'))))
+            return opened, stack
+        except BaseException:
+            stack.close()
+            raise
+        finally:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    def history(self, names, record_id):
+        """Every change to record_id in the named collections, oldest first"""
+        keys = {f'{name}:{record_id}' for name in names}
+        needle = f'"id": {record_id},'.encode()
+        entries = []
+        opened, stack = self._open()
+        with stack:
+            for _, path, f in opened:
+                index = self._index(path) if path.startswith(self.dir) else None
+                if index is not None:
+                    for offset in sorted(o for key in keys for o in index.get(key, ())):
+                        f.seek(offset)
+                        entries.append(json.loads(f.readline()))
+                    continue
+                for line in f:
+                    if needle in line and line.endswith(b'\n'):
+                        entry = json.loads(line)
+                        if f'{entry["c"]}:{entry["id"]}' in keys:
+                            entries.append(entry)
+        return entries
+
+    def as_of(self, name, t):
+        """The records of collection name as they were at time t"""
+        checkpoints = [c for c in self.checkpoints() if c[1] <= t]
+        if not checkpoints:
+            first = self.checkpoints()
+            raise AuditError('No history before ' + (time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(first[0][1]))
+                                                    if first else 'the first checkpoint'))
+        generation = checkpoints[-1][0]
+        snapshot = Snapshot(self.checkpoint_path(generation))
+        records = {r['id']: r for r in snapshot[name]} if name in snapshot else {}
+        opened, stack = self._open(since=generation)
+        with stack:
+            for _, _, f in opened:
+                for _, entry in read_lines(f):
+                    if entry.get('t', 0) > t:
+                        return list(records.values())
+                    if entry['c'] != name:
+                        continue
+                    if entry['op'] == 'put':
+                        records[entry['id']] = entry['r']
+                    elif entry['op'] == 'del':
+                        records.pop(entry['id'], None)
+        return list(records.values())
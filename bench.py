@@ -0,0 +1,473 @@
+"""Load-testing and benchmark harness for the API.
+
+Generate a synthetic registry, drive every API route against it through a
+local threaded WSGI server (or, with --server asgi, uvicorn running asgi.py),
+and compare two runs:
+
+    python bench.py generate /tmp/reg-100k --reports 100000 --images
+    python bench.py run /tmp/reg-100k --concurrency 16 --requests 2000 -o after.json
+    python bench.py compare before.json after.json
+
+`generate` writes data/*.json (and, with --images, a pool of photos in
+data/blobs with renditions in data/renditions) from a fixed seed, so the same arguments always
+produce the same registry. The JSON files are written a record at a time, so
+even a 1M-report registry is generated in bounded memory.
+
+`run` copies the registry to a scratch directory (photos are hard-linked)
+and starts the app as a subprocess working in it, so the app's data/ paths
+point there and every run starts from the same data. Rate limiting is
+turned off, and mutating routes are driven last since they use up pending
+items (each gets at most as many requests as there are items). For each
+route it reports p50/p99 latency, throughput, errors (any answer but a
+2xx/3xx) and the server's resident memory after the route (and its peak).
+
+`compare` lines two result files up route by route. It exits non-zero when
+a route's p50 or p99 got more than --threshold percent slower, its
+throughput fell by that much or it answered more errors, so it can gate a
+CI job.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SEED = 1301
+IMAGE_POOL = 64
+
+FIRST_NAMES = ['Aarav', 'Vivaan', 'Aditya', 'Vihaan', 'Arjun', 'Sai', 'Reyansh', 'Krishna', 'Ishaan', 'Rohan',
+               'Ananya', 'Diya', 'Aadhya', 'Saanvi', 'Pari', 'Myra', 'Kiara', 'Riya', 'Priya', 'Meera']
+LAST_NAMES = ['Sharma', 'Verma', 'Patel', 'Gupta', 'Singh', 'Kumar', 'Reddy', 'Nair', 'Iyer', 'Joshi',
+              'Mehta', 'Shah', 'Das', 'Bose', 'Rao', 'Pillai', 'Chopra', 'Malhotra', 'Kapoor', 'Desai']
+
+
+# --- generate ---------------------------------------------------------------
+
+def load_places():
+    places = []
+    with open(os.path.join(ROOT, 'data', 'gazetteer.csv')) as f:
+        next(f)
+        for line in f:
+            name, lat, lon = line.split(',')[:3]
+            places.append((name, float(lat), float(lon)))
+    return places
+
+
+def write_array(path, records):
+    """Write an iterable of records as one JSON array without holding it"""
+    count = 0
+    with open(path, 'w') as f:
+        f.write('[')
+        for record in records:
+            f.write(', ' if count else '')
+            f.write(json.dumps(record))
+            count += 1
+        f.write(']')
+    return count
+
+
+def make_images(data_dir, rng):
+    """A pool of distinct photos in the blob store: [(image_id, processed fields)]"""
+    sys.path.insert(0, ROOT)
+    from io import BytesIO
+    from PIL import Image, ImageDraw
+    from blobs import BlobStore
+    from images import process_image
+
+    blobs = BlobStore(os.path.join(data_dir, 'blobs'))
+    renditions = BlobStore(os.path.join(data_dir, 'renditions'))
+    pool = []
+    for _ in range(IMAGE_POOL):
+        image = Image.new('RGB', (640, 800), tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(12):
+            x, y = rng.randrange(600), rng.randrange(760)
+            draw.ellipse((x, y, x + rng.randrange(40, 200), y + rng.randrange(40, 200)),
+                         fill=tuple(rng.randrange(256) for _ in range(3)))
+        out = BytesIO()
+        image.save(out, 'JPEG', quality=85)
+        digest = blobs.put(out.getvalue())
+        result = process_image(blobs, digest, renditions)
+        pool.append((digest, result))
+    return pool
+
+
+def image_fields(base_url, digest, result):
+    url = lambda d: f'{base_url}/api/images/{d}'
+    return {
+        'image': url(result['renditions']['card']),
+        'image_id': digest,
+        'images': {name: url(d) for name, d in result['renditions'].items()},
+        'phash': result['phash']
+    }
+
+
+def generate(args):
+    rng = random.Random(SEED)
+    data_dir = os.path.join(args.directory, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    shutil.copy(os.path.join(ROOT, 'data', 'gazetteer.csv'), data_dir)
+    places = load_places()
+    pool = make_images(data_dir, rng) if args.images else []
+    start = 1_700_000_000_000
+
+    def report(i, status):
+        place, lat, lon = rng.choice(places)
+        record = {
+            'id': start + i,
+            'name': f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+            'age': rng.randrange(3, 90),
+            'height': rng.randrange(90, 195),
+            'lastSeen': f'Near {place} railway station',
+            'location': place,
+            'lat': round(lat + rng.uniform(-0.05, 0.05), 5),
+            'lon': round(lon + rng.uniform(-0.05, 0.05), 5),
+            'image': '',
+            'image_id': None,
+            'submitted_by': f'user{i % 1000}',
+            'status': status,
+            'submitted_at': f'2025-{1 + i % 12:02d}-{1 + i % 28:02d}T10:00:00',
+            'possible_duplicates': []
+        }
+        if pool:
+            record.update(image_fields(args.base_url, *pool[i % len(pool)]))
+        if status == 'approved':
+            record['approved_at'] = record['submitted_at']
+        return record
+
+    pending = max(1, args.reports // 10)
+    n = write_array(os.path.join(data_dir, 'reports.json'), (report(i, 'approved') for i in range(args.reports)))
+    write_array(os.path.join(data_dir, 'pending_reports.json'),
+                (report(args.reports + i, 'pending') for i in range(pending)))
+
+    def info(i, status):
+        record = {
+            'id': start + i,
+            'report_id': start + rng.randrange(args.reports),
+            'info': f'Seen near {rng.choice(places)[0]} market',
+            'submitted_by': f'user{i % 1000}',
+            'status': status,
+            'submitted_at': '2025-06-01T10:00:00'
+        }
+        if status == 'approved':
+            record['approved_at'] = record['submitted_at']
+        return record
+
+    write_array(os.path.join(data_dir, 'approved_info_updates.json'),
+                (info(i, 'approved') for i in range(args.reports // 2)))
+    write_array(os.path.join(data_dir, 'pending_info_updates.json'),
+                (info(args.reports + i, 'pending') for i in range(pending)))
+    write_array(os.path.join(data_dir, 'users.json'), ({
+        'id': i + 1, 'phone': f'9{i:09d}', 'user_id': f'user{i}', 'password': 'bench-password',
+        'created_at': '2025-01-01T00:00:00'
+    } for i in range(1000)))
+    meta = {'reports': n, 'pending': pending, 'first_id': start,
+            'images': [result['renditions']['card'] for _, result in pool]}
+    with open(os.path.join(args.directory, 'bench.json'), 'w') as f:
+        json.dump(meta, f)
+    print(f'Generated {n} reports, {pending} pending, {len(pool)} images in {args.directory}')
+
+
+# --- run --------------------------------------------------------------------
+
+def serve(args):
+    """Run the app from the registry directory (the child side of `run`)"""
+    sys.path.insert(0, ROOT)
+    os.chdir(args.directory)
+    import logging
+    from werkzeug.serving import make_server
+    from app import app
+    # One access-log line per request would dominate the timings
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    app.config['RATE_LIMIT_ENABLED'] = False
+    if args.server == 'asgi':
+        import uvicorn
+        from asgi import application
+        server = uvicorn.Server(uvicorn.Config(application, host='127.0.0.1', port=args.port, log_level='warning'))
+        thread = threading.Thread(target=server.run)
+        thread.start()
+        while not server.started:
+            time.sleep(0.05)
+        print('ready', flush=True)
+        thread.join()
+        return
+    server = make_server('127.0.0.1', args.port, app, threaded=True)
+    print('ready', flush=True)
+    server.serve_forever()
+
+
+def memory_kb(pid):
+    """(current, peak) resident set size of a process in kB (Linux only)"""
+    fields = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                fields[key] = value.strip()
+    except OSError:
+        return None, None
+    parse = lambda key: int(fields[key].split()[0]) if key in fields else None
+    return parse('VmRSS'), parse('VmHWM')
+
+
+def scenarios(meta):
+    """(name, method, path or path factory, body factory, most requests) for
+    every route. Every id a route is sent exists, so any 4xx/5xx answer is an
+    error; a route that uses up pending items is sent at most as many
+    requests as there are items (None: no cap)."""
+    rng = random.Random(SEED)
+    first, reports, pending = meta['first_id'], meta['reports'], meta['pending']
+    report_id = lambda: first + rng.randrange(reports)
+    counter = {}
+
+    def sequence(name, start, size):
+        # Each mutating call gets the next pending item, so none repeats
+        def next_id():
+            counter[name] = counter.get(name, -1) + 1
+            return start + counter[name] % size
+        return next_id
+
+    json_body = lambda data: ('application/json', json.dumps(data).encode())
+    form_body = lambda data: ('application/x-www-form-urlencoded', urlencode(data).encode())
+    approve = sequence('approve', first + reports, pending // 2 or 1)
+    reject = sequence('reject', first + reports + pending // 2, pending - pending // 2 or 1)
+    approve_info = sequence('approve_info', first + reports, pending)
+    delete = sequence('delete', first, reports)
+
+    read = [
+        ('reports', 'GET', '/api/reports', None, None),
+        ('reports_page', 'GET', '/api/reports?limit=50&sort=-submitted_at', None, None),
+        ('reports_search', 'GET', lambda: '/api/reports?search=' + rng.choice(LAST_NAMES), None, None),
+        ('reports_prefix', 'GET', lambda: '/api/reports?search=' + rng.choice(FIRST_NAMES)[:3], None, None),
+        ('reports_fuzzy', 'GET', lambda: '/api/reports?fuzzy=1&search=' + rng.choice(FIRST_NAMES) + 'h', None, None),
+        ('reports_radius', 'GET', '/api/reports?lat=19.07&lon=72.88&radius=25&limit=100', None, None),
+        ('reports_bbox', 'GET', '/api/reports?bbox=72.5,18.5,73.5,19.5&limit=100', None, None),
+        ('reports_stream', 'GET', '/api/reports?stream=1', None, None),
+        ('clusters', 'GET', '/api/reports/clusters?zoom=4', None, None),
+        ('pending_reports', 'GET', '/api/reports/pending', None, None),
+        ('admin_reports', 'GET', '/api/admin/reports?format=ndjson', None, None),
+        ('pending_info', 'GET', '/api/pending-info', None, None),
+        ('report_info', 'GET', lambda: f'/api/report-info/{report_id()}', None, None),
+        ('login', 'POST', '/api/auth/login',
+         lambda: json_body({'userId': f'user{rng.randrange(1000)}', 'password': 'bench-password'}), None),
+    ]
+    if meta['images']:
+        # Without photos every report would answer 'no photo to compare'
+        read.append(('similar_photos', 'GET', lambda: f'/api/reports/{report_id()}/similar-photos', None, None))
+        read.append(('image', 'GET', lambda: '/api/images/' + rng.choice(meta['images']), None, None))
+    write = [
+        ('submit_info', 'POST', '/api/report-info/submit',
+         lambda: json_body({'report_id': report_id(), 'info': 'Seen at the bus stand', 'submitted_by': 'bench'}), None),
+        ('submit_report', 'POST', '/api/reports/submit', lambda: form_body({
+            'personName': f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}', 'age': 30, 'height': 160,
+            'lastSeen': 'Near the temple', 'place': 'Pune', 'submitted_by': 'bench'}), None),
+        ('admin_update', 'PUT', lambda: f'/api/admin/reports/{report_id()}',
+         lambda: json_body({'location': 'Chennai', 'age': 41}), None),
+        ('admin_add_info', 'POST', '/api/admin/report-info/add',
+         lambda: json_body({'report_id': report_id(), 'info': 'Confirmed sighting', 'admin_id': 'admin'}), None),
+        ('approve_report', 'POST', lambda: f'/api/reports/approve/{approve()}', None, pending // 2 or 1),
+        ('reject_report', 'POST', lambda: f'/api/reports/reject/{reject()}', None, pending - pending // 2 or 1),
+        ('approve_info', 'POST', lambda: f'/api/report-info/approve/{approve_info()}', None, pending),
+        ('delete_report', 'DELETE', lambda: f'/api/admin/reports/{delete()}', None, reports),
+    ]
+    return read + write
+
+
+def drive(port, scenario, total, concurrency):
+    """Send total requests for one scenario from concurrency keep-alive clients"""
+    name, method, path, body, most = scenario
+    if most is not None:
+        total = min(total, most)
+    lock = threading.Lock()
+    remaining = [total]
+    latencies, errors = [], [0]
+
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        mine = []
+        while True:
+            with lock:
+                if not remaining[0]:
+                    break
+                remaining[0] -= 1
+                # Factories share one seeded RNG, so draw under the lock
+                url = path() if callable(path) else path
+                payload = body() if body else None
+            headers = {'Content-Type': payload[0]} if payload else {}
+            started = time.perf_counter()
+            try:
+                conn.request(method, url, body=payload[1] if payload else None, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                ok = 200 <= response.status < 400
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+                ok = False
+            mine.append(time.perf_counter() - started)
+            if not ok:
+                with lock:
+                    errors[0] += 1
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(client)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000 if latencies else 0
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'p50_ms': round(pick(0.50), 3),
+        'p99_ms': round(pick(0.99), 3),
+        'throughput': round(len(latencies) / elapsed, 1) if elapsed else 0,
+    }
+
+
+def wait_ready(process):
+    line = process.stdout.readline()
+    if 'ready' not in line:
+        process.kill()
+        raise SystemExit('Server failed to start')
+    # Let the background threads (jobs, feed) settle
+    time.sleep(0.5)
+
+
+def scratch_copy(directory):
+    """Copy a registry's data/ into a temp directory, linking the immutable blobs"""
+    scratch = tempfile.mkdtemp(prefix='bench-')
+    source = os.path.join(directory, 'data')
+    for name in os.listdir(source):
+        path = os.path.join(source, name)
+        if name in ('blobs', 'renditions'):
+            shutil.copytree(path, os.path.join(scratch, 'data', name), copy_function=os.link)
+        elif os.path.isfile(path) and (name.endswith('.json') or name.endswith('.csv')):
+            os.makedirs(os.path.join(scratch, 'data'), exist_ok=True)
+            shutil.copy(path, os.path.join(scratch, 'data', name))
+    return scratch
+
+
+def run(args):
+    with open(os.path.join(args.directory, 'bench.json')) as f:
+        meta = json.load(f)
+    scratch = scratch_copy(args.directory)
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'serve', scratch,
+                                '--port', str(args.port), '--server', args.server],
+                               stdout=subprocess.PIPE, text=True, env=env)
+    try:
+        wait_ready(process)
+        startup = time.perf_counter() - started
+        rss, _ = memory_kb(process.pid)
+        print(f'{meta["reports"]} reports, server up in {startup:.2f}s, RSS {rss} kB')
+        print(f'{"route":<16} {"reqs":>6} {"err":>4} {"p50 ms":>9} {"p99 ms":>9} {"req/s":>9} {"RSS kB":>9}')
+        results = {}
+        for scenario in scenarios(meta):
+            if args.only and scenario[0] not in args.only:
+                continue
+            result = drive(args.port, scenario, args.requests, args.concurrency)
+            result['rss_kb'], result['peak_rss_kb'] = memory_kb(process.pid)
+            results[scenario[0]] = result
+            print(f'{scenario[0]:<16} {result["requests"]:>6} {result["errors"]:>4} {result["p50_ms"]:>9.2f} '
+                  f'{result["p99_ms"]:>9.2f} {result["throughput"]:>9.1f} {result["rss_kb"] or 0:>9}')
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(scratch, ignore_errors=True)
+    output = {
+        'registry': meta['reports'],
+        'images': bool(meta['images']),
+        'concurrency': args.concurrency,
+        'server': args.server,
+        'startup_s': round(startup, 3),
+        'routes': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+
+# --- compare ----------------------------------------------------------------
+
+def compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    limit = 1 + args.threshold / 100
+    print(f'{"route":<16} {"p50 ms":>17} {"p99 ms":>17} {"req/s":>17}')
+    regressions = []
+    for name, new in after['routes'].items():
+        old = before['routes'].get(name)
+        if old is None:
+            continue
+        cells = []
+        for key, higher_is_worse in (('p50_ms', True), ('p99_ms', True), ('throughput', False)):
+            a, b = old[key], new[key]
+            change = (b - a) / a * 100 if a else 0
+            worse = b > a * limit if higher_is_worse else b * limit < a
+            cells.append(f'{b:>8.1f} {change:>+6.1f}%{"!" if worse else " "}')
+            if worse:
+                regressions.append(f'{name} {key}')
+        if new['errors'] > old['errors']:
+            regressions.append(f'{name} errors')
+        print(f'{name:<16} ' + ' '.join(cells))
+    if regressions:
+        print(f'\nSlower by more than {args.threshold:g}% or failing more: ' + ', '.join(regressions))
+        sys.exit(1)
+    print(f'\nNo route slower by more than {args.threshold:g}%, and no new errors')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('generate', help='write a synthetic registry')
+    p.add_argument('directory')
+    p.add_argument('--reports', type=int, default=1000, help='approved reports (1000 to 1000000)')
+    p.add_argument('--images', action='store_true', help='give reports photos from a pool of real images')
+    p.add_argument('--base-url', default='http://localhost:5000')
+    p.set_defaults(fn=generate)
+
+    p = commands.add_parser('run', help='drive every route against a registry')
+    p.add_argument('directory')
+    p.add_argument('--concurrency', type=int, default=8)
+    p.add_argument('--requests', type=int, default=500, help='requests per route')
+    p.add_argument('--port', type=int, default=5099)
+    p.add_argument('--only', nargs='*', help='route names to run')
+    p.add_argument('--server', choices=['wsgi', 'asgi'], default='wsgi', help='asgi needs uvicorn installed')
+    p.add_argument('-o', '--output', help='write results as JSON for `compare`')
+    p.set_defaults(fn=run)
+
+    p = commands.add_parser('serve', help=argparse.SUPPRESS)
+    p.add_argument('directory')
+    p.add_argument('--port', type=int, default=5099)
+    p.add_argument('--server', choices=['wsgi', 'asgi'], default='wsgi')
+    p.set_defaults(fn=serve)
+
+    p = commands.add_parser('compare', help='compare two `run` result files')
+    p.add_argument('before')
+    p.add_argument('after')
+    p.add_argument('--threshold', type=float, default=10, help='percent slowdown that counts as a regression')
+    p.set_defaults(fn=compare)
+
+    args = parser.parse_args()
+    args.fn(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Content-addressed store for uploaded images.
+
+Each blob lives at data/blobs/<first two hex chars>/<sha256 hex digest>, so the
+same photo uploaded twice is stored once and a digest always names the same
+bytes. Writes go to a temp file in the store and are renamed into place.
+"""
+import base64
+import hashlib
+import os
+import re
+import tempfile
+
+BLOB_DIR = 'data/blobs'
+CHUNK_SIZE = 64 * 1024
+
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+# leading bytes -> mimetype, for the image formats uploads are allowed in
+MAGIC = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+]
+
+
+def sniff_mimetype(head):
+    """Guess an image mimetype from its first bytes"""
+    for magic, mimetype in MAGIC:
+        if head.startswith(magic):
+            return mimetype
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+
+def decode_data_uri(uri):
+    """Return the bytes of a base64 data: URI, or None if it isn't one"""
+    if not uri or not uri.startswith('data:') or ';base64,' not in uri:
+        return None
+    return base64.b64decode(uri.split(';base64,', 1)[1])
+
+
+class BlobStore:
+    def __init__(self, root=BLOB_DIR):
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest):
+        return bool(DIGEST_RE.match(digest)) and os.path.exists(self.path(digest))
+
+    def put(self, data):
+        """Store bytes, returning their digest"""
+        return self.put_stream(iter([data]))
+
+    def put_file(self, fileobj):
+        """Store a file-like object read in chunks, returning its digest"""
+        return self.put_stream(iter(lambda: fileobj.read(CHUNK_SIZE), b''))
+
+    def put_stream(self, chunks):
+        """Store an iterable of byte chunks, returning their digest"""
+        sha = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    sha.update(chunk)
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            return self.adopt(tmp_path, sha.hexdigest())
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def adopt(self, tmp_path, digest):
+        """Move an already-hashed file into the store, keeping any existing copy"""
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        return digest
+
+    def mimetype(self, digest):
+        with open(self.path(digest), 'rb') as f:
+            return sniff_mimetype(f.read(16))
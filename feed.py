@@ -0,0 +1,270 @@
+"""Change feed for the registry, served as server-sent events.
+
+The hub watches the report and info collections through Collection.watch(),
+so every change lands in it: the ones made by moderation views in this
+process, by background jobs, and (once store.refresh() picks them up) by
+other worker processes. Each change becomes an event such as
+
+    event: reports.created
+    id: 12.5.3.8
+    data: {"collection": "reports", "id": 17, "record": {...}}
+
+and is kept in a bounded ring buffer that subscribers wait on. Event ids are
+the version numbers of the feed's collections after the change. Versions are
+shared by all workers, so a client reconnecting with Last-Event-ID can resume
+on any of them. If the changes it missed are no longer buffered it gets a
+'reset' event and should reload its lists instead.
+
+A subscriber waiting for changes costs one condition wait under a WSGI
+server. Under the ASGI entry point (asgi.py) the same FeedStream is iterated
+asynchronously and waits on a future the feed resolves, so an idle
+subscriber holds no thread at all. One poller thread per process calls
+store.refresh() while anyone is subscribed, and idle connections get a
+comment line every KEEPALIVE_SECONDS so proxies keep them open.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from flask import Response, request
+
+# Collections published on the feed, in event id order (users are never sent)
+FEED_COLLECTIONS = ('reports', 'pending_reports', 'pending_info', 'approved_info')
+BUFFER_SIZE = 1000
+KEEPALIVE_SECONDS = 15
+POLL_INTERVAL = 1.0
+RETRY_MS = 3000
+
+
+class FeedError(ValueError):
+    """Bad feed parameters; reported to the client as a 400"""
+
+
+def parse_event_id(value):
+    """Version vector from an event id ('12.5.3.8'); None if blank"""
+    if not value:
+        return None
+    parts = value.split('.')
+    if len(parts) != len(FEED_COLLECTIONS) or not all(p.isdigit() for p in parts):
+        raise FeedError('Invalid event id')
+    return dict(zip(FEED_COLLECTIONS, map(int, parts)))
+
+
+def parse_collections(value):
+    """Subset of FEED_COLLECTIONS from ?collections=a,b (all if absent)"""
+    if not value:
+        return set(FEED_COLLECTIONS)
+    names = {n.strip() for n in value.split(',') if n.strip()}
+    unknown = names - set(FEED_COLLECTIONS)
+    if unknown:
+        raise FeedError(f'Unknown collections: {", ".join(sorted(unknown))}')
+    return names
+
+
+def format_event(event_id, name, data):
+    return f'id: {event_id}\nevent: {name}\ndata: {json.dumps(data)}\n\n'
+
+
+class ChangeFeed:
+    def __init__(self, store, buffer_size=BUFFER_SIZE):
+        self.store = store
+        self.events = deque(maxlen=buffer_size)   # (versions, collection, version, name, data)
+        self.dropped = 0    # events pushed out of the buffer so far
+        self.condition = threading.Condition()
+        self.subscribers = 0
+        self.pid = None
+        # Event loop of the async subscribers, and the future they wait on
+        self.loop = None
+        self.wakeup = None
+        self.loading = True
+        for name in FEED_COLLECTIONS:
+            self.store.collections[name].watch(self._listener(name))
+        self.loading = False
+        # Per collection, the newest version whose changes may be missing here
+        self.since = self.versions()
+
+    def versions(self):
+        return {name: self.store.collections[name].version for name in FEED_COLLECTIONS}
+
+    def event_id(self, versions):
+        return '.'.join(str(versions[name]) for name in FEED_COLLECTIONS)
+
+    def _listener(self, name):
+        def changed(old, new):
+            if self.loading:
+                return
+            if new is None:
+                kind, data = 'deleted', {'collection': name, 'id': old['id']}
+            else:
+                kind = 'created' if old is None else 'updated'
+                data = {'collection': name, 'id': new['id'], 'record': new}
+            self.publish(name, f'{name}.{kind}', data)
+        return changed
+
+    def publish(self, collection, name, data):
+        versions = self.versions()
+        with self.condition:
+            if len(self.events) == self.events.maxlen:
+                dropped = self.events[0]
+                self.since[dropped[1]] = max(self.since[dropped[1]], dropped[2])
+                self.dropped += 1
+            self.events.append((versions, collection, versions[collection], name, data))
+            self.condition.notify_all()
+        loop = self.loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._wake)
+            except RuntimeError:
+                # The loop has been closed
+                self.loop = None
+
+    def _wake(self):
+        future, self.wakeup = self.wakeup, None
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def _changed(self, timeout):
+        """Wait (on the event loop) for the next publish, or timeout"""
+        if self.wakeup is None:
+            self.wakeup = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(asyncio.shield(self.wakeup), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _backlog(self, last_seen, collections):
+        """Buffered events newer than last_seen, or None if some were dropped"""
+        if any(last_seen[n] < self.since[n] for n in collections):
+            return None
+        return [e for e in self.events if e[1] in collections and e[2] > last_seen[e[1]]]
+
+    def start(self):
+        """Start this process's refresh poller (again, after a fork)"""
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        threading.Thread(target=self._poll, name='feed-poll', daemon=True).start()
+
+    def _poll(self):
+        while True:
+            with self.condition:
+                while not self.subscribers:
+                    self.condition.wait()
+            try:
+                self.store.refresh()
+            except Exception:
+                pass
+            time.sleep(POLL_INTERVAL)
+
+    def _subscribe(self, last_seen, collections):
+        """Count a subscriber in; returns its opening SSE text, the position
+        to follow the buffer from and the versions it already has"""
+        with self.condition:
+            self.subscribers += 1
+            self.condition.notify_all()
+            current = self.versions()
+            backlog = [] if last_seen is None else self._backlog(last_seen, collections)
+            # Events ever buffered, i.e. the position to follow from
+            sent = self.dropped + len(self.events)
+        opening = [f'retry: {RETRY_MS}\n\n']
+        if backlog is None:
+            opening.append(format_event(self.event_id(current), 'reset', {'reason': 'events missed'}))
+        else:
+            for versions, _, _, name, data in backlog:
+                opening.append(format_event(self.event_id(versions), name, data))
+        return opening, sent, last_seen or current
+
+    def _unsubscribe(self):
+        with self.condition:
+            self.subscribers -= 1
+
+    def _take(self, sent, collections, seen):
+        """SSE text for the events after position sent, and the new position;
+        call with the condition held"""
+        total = self.dropped + len(self.events)
+        if total == sent:
+            return [': keepalive\n\n'], total
+        if total - sent > len(self.events):
+            # Fell behind by a whole buffer; the client must reload
+            return [format_event(self.event_id(self.versions()), 'reset', {'reason': 'events missed'})], total
+        # seen: versions the client already has, so a worker that is still
+        # catching up doesn't resend changes the client got elsewhere
+        return [format_event(self.event_id(event_versions), name, data)
+                for event_versions, collection, version, name, data in
+                list(self.events)[len(self.events) - (total - sent):]
+                if collection in collections and version > seen[collection]], total
+
+    def stream(self, last_seen, collections):
+        """Yield SSE text: missed events (or a reset), then new ones as they happen"""
+        opening, sent, seen = self._subscribe(last_seen, collections)
+        try:
+            yield from opening
+            while True:
+                with self.condition:
+                    if self.dropped + len(self.events) == sent:
+                        self.condition.wait(KEEPALIVE_SECONDS)
+                    texts, sent = self._take(sent, collections, seen)
+                yield from texts
+        finally:
+            self._unsubscribe()
+
+    async def stream_async(self, last_seen, collections):
+        """stream() for an event loop, waiting without a thread"""
+        self.loop = asyncio.get_running_loop()
+        opening, sent, seen = self._subscribe(last_seen, collections)
+        try:
+            for text in opening:
+                yield text
+            while True:
+                if self.dropped + len(self.events) == sent:
+                    # publish() wakes the loop after appending, so a change
+                    # made since this check still ends the wait
+                    await self._changed(KEEPALIVE_SECONDS)
+                with self.condition:
+                    texts, sent = self._take(sent, collections, seen)
+                for text in texts:
+                    yield text
+        finally:
+            self._unsubscribe()
+
+    def response(self):
+        """text/event-stream response for the current request"""
+        last_seen = parse_event_id(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+        collections = parse_collections(request.args.get('collections'))
+        self.start()
+        # Passed through as is, so asgi.py gets the FeedStream to iterate asynchronously
+        return Response(FeedStream(self, last_seen, collections), mimetype='text/event-stream',
+                        direct_passthrough=True, headers={
+                            'Cache-Control': 'no-cache',
+                            'X-Accel-Buffering': 'no'
+                        })
+
+
+class FeedStream:
+    """One subscriber's events as UTF-8 chunks, for iterating either way:
+    a WSGI server iterates it in its thread, asgi.py with async for"""
+
+    def __init__(self, feed, last_seen, collections):
+        self.feed = feed
+        self.last_seen = last_seen
+        self.collections = collections
+        self.generator = None
+
+    def __iter__(self):
+        self.generator = self.feed.stream(self.last_seen, self.collections)
+        return (text.encode('utf-8') for text in self.generator)
+
+    async def __aiter__(self):
+        stream = self.feed.stream_async(self.last_seen, self.collections)
+        try:
+            async for text in stream:
+                yield text.encode('utf-8')
+        finally:
+            await stream.aclose()
+
+    def close(self):
+        if self.generator is not None:
+            self.generator.close()
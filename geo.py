@@ -0,0 +1,284 @@
+"""Offline geocoding of report locations and a spatial index over them.
+
+A report's 'location' is free text ("Near bus stand, Andheri, Mumbai"). The
+Gazetteer looks its words up in a local place-name file and gives the report
+'lat'/'lon' fields; no external service is called. The file is either a CSV
+with name,lat,lon,aliases columns (aliases separated by '|'), like the
+data/gazetteer.csv shipped here, or a GeoNames export (cities15000.txt etc.)
+for wider coverage.
+
+GeoIndex keeps approved reports in a grid of POINT_ZOOM cells for bbox and
+radius queries, which only look at the cells the area overlaps. For map views
+it also keeps a count and coordinate sum per cell at every zoom level, so
+clustering a viewport reads a few hundred cells however many reports there
+are. A cell at zoom z is 360 / 2 ** (z + 2) degrees on each side, and each
+cell splits into four at the next zoom.
+"""
+import csv
+import math
+import threading
+
+from search import tokenize
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = EARTH_RADIUS_KM * math.pi / 180
+
+MAX_ZOOM = 16
+CELLS_PER_DEGREE = (1 << (MAX_ZOOM + 2)) / 360.0
+# zoom of the grid used for bbox/radius queries (0.35 degree cells)
+POINT_ZOOM = 8
+# longest place name tried, in words
+MAX_NAME_WORDS = 4
+
+DEFAULT_RADIUS_KM = 10
+MAX_RADIUS_KM = 2000
+
+WORLD = (-180.0, -90.0, 180.0, 90.0)
+
+
+class GeoError(ValueError):
+    """Bad coordinates or area in a request; reported to the client as a 400"""
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def parse_point(lat, lon):
+    try:
+        lat, lon = float(lat), float(lon)
+    except (TypeError, ValueError):
+        raise GeoError('lat and lon must be numbers')
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise GeoError('lat must be within -90..90 and lon within -180..180')
+    return lat, lon
+
+
+def parse_bbox(text):
+    """'west,south,east,north' in degrees; west > east crosses the antimeridian"""
+    try:
+        west, south, east, north = (float(v) for v in text.split(','))
+    except ValueError:
+        raise GeoError('bbox must be west,south,east,north')
+    parse_point(south, west)
+    parse_point(north, east)
+    if south > north:
+        raise GeoError('bbox south must not be above north')
+    return west, south, east, north
+
+
+def radius_bbox(lat, lon, radius_km):
+    """Smallest bbox holding every point within radius_km of lat,lon"""
+    dlat = radius_km / KM_PER_DEGREE
+    south, north = max(-90.0, lat - dlat), min(90.0, lat + dlat)
+    cos_lat = min(math.cos(math.radians(south)), math.cos(math.radians(north)))
+    if south <= -90 or north >= 90 or cos_lat <= 0 or dlat / cos_lat >= 180:
+        return -180.0, south, 180.0, north
+    dlon = dlat / cos_lat
+    west, east = lon - dlon, lon + dlon
+    if west < -180:
+        west += 360
+    if east > 180:
+        east -= 360
+    return west, south, east, north
+
+
+def grid_cell(lat, lon, zoom=MAX_ZOOM):
+    # Coarser cells are the MAX_ZOOM cell numbers shifted right, so every
+    # level agrees on which cell a point falls in
+    shift = MAX_ZOOM - zoom
+    return int((lat + 90) * CELLS_PER_DEGREE) >> shift, int((lon + 180) * CELLS_PER_DEGREE) >> shift
+
+
+def lon_ranges(west, east):
+    # An antimeridian-crossing bbox is two ranges
+    if west <= east:
+        return [(west, east)]
+    return [(west, 180.0), (-180.0, east)]
+
+
+def cells_in(table, zoom, bbox):
+    """Keys and values of table's cells at zoom that overlap bbox"""
+    west, south, east, north = bbox
+    row_lo, _ = grid_cell(south, 0, zoom)
+    row_hi, _ = grid_cell(north, 0, zoom)
+    for lo, hi in lon_ranges(west, east):
+        _, col_lo = grid_cell(0, lo, zoom)
+        _, col_hi = grid_cell(0, hi, zoom)
+        # Walk the area's cells, or the table itself when that is smaller
+        if (row_hi - row_lo + 1) * (col_hi - col_lo + 1) <= len(table):
+            for row in range(row_lo, row_hi + 1):
+                for col in range(col_lo, col_hi + 1):
+                    value = table.get((row, col))
+                    if value is not None:
+                        yield (row, col), value
+        else:
+            for (row, col), value in list(table.items()):
+                if row_lo <= row <= row_hi and col_lo <= col <= col_hi:
+                    yield (row, col), value
+
+
+def in_bbox(lat, lon, bbox):
+    west, south, east, north = bbox
+    if not south <= lat <= north:
+        return False
+    return any(lo <= lon <= hi for lo, hi in lon_ranges(west, east))
+
+
+class Gazetteer:
+    """Place names from a local file, matched against free-text locations"""
+
+    def __init__(self, path):
+        self.path = path
+        self.places = {}   # normalized name -> (lat, lon, name, population)
+        try:
+            with open(path, encoding='utf-8', newline='') as f:
+                if path.endswith('.txt'):
+                    self._load_geonames(f)
+                else:
+                    self._load_csv(f)
+        except FileNotFoundError:
+            pass
+
+    def _add(self, name, lat, lon, canonical, population=0):
+        key = ' '.join(tokenize(name))
+        if not key:
+            return
+        current = self.places.get(key)
+        # Among places sharing a name, the most populous one wins
+        if current is None or population > current[3]:
+            self.places[key] = (float(lat), float(lon), canonical, population)
+
+    def _load_csv(self, f):
+        for row in csv.DictReader(f):
+            names = [row['name']] + [a for a in (row.get('aliases') or '').split('|') if a]
+            for name in names:
+                self._add(name, row['lat'], row['lon'], row['name'])
+
+    def _load_geonames(self, f):
+        # geonameid, name, asciiname, alternatenames, latitude, longitude, ..., population (column 14)
+        for line in f:
+            cols = line.rstrip('\n').split('\t')
+            if len(cols) < 15:
+                continue
+            population = int(cols[14] or 0)
+            for name in {cols[1], cols[2], *cols[3].split(',')}:
+                self._add(name, cols[4], cols[5], cols[1], population)
+
+    def __len__(self):
+        return len(self.places)
+
+    def geocode(self, text):
+        """(lat, lon, place name) for the most specific known place in text, or None"""
+        if not text:
+            return None
+        # Parts of an address usually go from specific to general
+        for part in str(text).replace(';', ',').split(','):
+            words = tokenize(part)
+            for n in range(min(MAX_NAME_WORDS, len(words)), 0, -1):
+                for i in range(len(words) - n + 1):
+                    place = self.places.get(' '.join(words[i:i + n]))
+                    if place is not None:
+                        return place[:3]
+        return None
+
+
+class GeoIndex:
+    """Grid index and per-zoom cluster counts over the 'lat'/'lon' of a collection"""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.points = {}   # record id -> (lat, lon)
+        self.cells = {}    # point cell -> ids
+        self.levels = [{} for _ in range(MAX_ZOOM + 1)]   # zoom -> cell -> [count, sum lat, sum lon]
+        self.lock = threading.Lock()
+        collection.watch(self._changed)
+
+    @staticmethod
+    def point(record):
+        if record is None or record.get('lat') is None or record.get('lon') is None:
+            return None
+        return float(record['lat']), float(record['lon'])
+
+    def _changed(self, old, new):
+        old_point, new_point = self.point(old), self.point(new)
+        if old_point == new_point:
+            return
+        with self.lock:
+            if old_point is not None:
+                self._remove(old['id'])
+            if new_point is not None:
+                self._add(new['id'], *new_point)
+
+    def _add(self, record_id, lat, lon):
+        self.points[record_id] = (lat, lon)
+        self.cells.setdefault(grid_cell(lat, lon, POINT_ZOOM), set()).add(record_id)
+        row, col = grid_cell(lat, lon)
+        for zoom, level in enumerate(self.levels):
+            shift = MAX_ZOOM - zoom
+            totals = level.get((row >> shift, col >> shift))
+            if totals is None:
+                totals = level[row >> shift, col >> shift] = [0, 0.0, 0.0]
+            totals[0] += 1
+            totals[1] += lat
+            totals[2] += lon
+
+    def _remove(self, record_id):
+        point = self.points.pop(record_id, None)
+        if point is None:
+            return
+        lat, lon = point
+        key = grid_cell(lat, lon, POINT_ZOOM)
+        self.cells[key].discard(record_id)
+        if not self.cells[key]:
+            del self.cells[key]
+        row, col = grid_cell(lat, lon)
+        for zoom, level in enumerate(self.levels):
+            shift = MAX_ZOOM - zoom
+            key = (row >> shift, col >> shift)
+            totals = level[key]
+            totals[0] -= 1
+            totals[1] -= lat
+            totals[2] -= lon
+            if not totals[0]:
+                del level[key]
+
+    def within(self, bbox):
+        """Ids of records inside bbox"""
+        with self.lock:
+            found = []
+            for _, ids in cells_in(self.cells, POINT_ZOOM, bbox):
+                found.extend(i for i in ids if in_bbox(*self.points[i], bbox))
+            return found
+
+    def near(self, lat, lon, radius_km):
+        """[(record id, distance in km)] within radius_km of lat,lon, closest first"""
+        bbox = radius_bbox(lat, lon, radius_km)
+        with self.lock:
+            found = []
+            for _, ids in cells_in(self.cells, POINT_ZOOM, bbox):
+                for record_id in ids:
+                    distance = haversine_km(lat, lon, *self.points[record_id])
+                    if distance <= radius_km:
+                        found.append((record_id, distance))
+        return sorted(found, key=lambda item: item[1])
+
+    def clusters(self, bbox, zoom):
+        """[{'lat', 'lon', 'count'}] per grid cell at zoom overlapping bbox; a
+        single report's cluster also carries its 'id'"""
+        zoom = max(0, min(zoom, MAX_ZOOM))
+        with self.lock:
+            result = []
+            for _, (count, sum_lat, sum_lon) in cells_in(self.levels[zoom], zoom, bbox):
+                cluster = {'lat': round(sum_lat / count, 6), 'lon': round(sum_lon / count, 6), 'count': count}
+                if count == 1:
+                    cluster['id'] = self._closest(sum_lat, sum_lon)
+                result.append(cluster)
+            return result
+
+    def _closest(self, lat, lon):
+        ids = self.cells.get(grid_cell(lat, lon, POINT_ZOOM), ())
+        return min(ids, key=lambda i: abs(self.points[i][0] - lat) + abs(self.points[i][1] - lon), default=None)
@@ -0,0 +1,105 @@
+"""Conditional GET and response caching for read endpoints.
+
+A view decorated with @cache.cached('reports', ...) depends on the named store
+collections. Its ETag is built from their version numbers plus the request's
+query string, and its Last-Modified from their modification times. A client
+that sends a matching If-None-Match gets a 304 without the view running. A
+full response body is kept in memory until any of those collections changes,
+so polling an unchanged list costs a dict lookup.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import current_app, request
+
+MAX_ENTRIES = 256
+# bodies bigger than this are served but not kept
+MAX_BODY_SIZE = 8 * 1024 * 1024
+
+
+class ResponseCache:
+    def __init__(self, store, max_entries=MAX_ENTRIES, max_body_size=MAX_BODY_SIZE):
+        self.store = store
+        self.max_entries = max_entries
+        self.max_body_size = max_body_size
+        self.entries = OrderedDict()   # (path, query) -> (versions, body, mimetype, headers)
+        self.lock = threading.Lock()
+
+    def versions(self, names):
+        return tuple(self.store.collections[n].version for n in names)
+
+    def last_modified(self, names):
+        times = [self.store.collections[n].modified for n in names]
+        times = [t for t in times if t is not None]
+        if not times:
+            return None
+        return datetime.fromtimestamp(int(max(times)), timezone.utc)
+
+    def etag(self, key, versions):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()[:12]
+        return '-'.join(str(v) for v in versions) + '-' + digest
+
+    def lookup(self, key, versions):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != versions:
+                # One of the collections was written since; drop the stale body
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def remember(self, key, versions, response):
+        body = response.get_data()
+        if len(body) > self.max_body_size:
+            return
+        headers = [(k, v) for k, v in response.headers.items()
+                   if k in ('X-Next-Cursor', 'Link')]
+        with self.lock:
+            self.entries[key] = (versions, body, response.mimetype, headers)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def cached(self, *names):
+        """Decorate a GET view whose output depends only on the named collections"""
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                key = (request.path, request.query_string)
+                versions = self.versions(names)
+                etag = self.etag(key, versions)
+                last_modified = self.last_modified(names)
+
+                if request.if_none_match.contains(etag):
+                    response = current_app.response_class(status=304)
+                else:
+                    entry = self.lookup(key, versions)
+                    if entry is not None:
+                        _, body, mimetype, headers = entry
+                        response = current_app.response_class(body, mimetype=mimetype, headers=headers)
+                    else:
+                        response = current_app.make_response(view(*args, **kwargs))
+                        if response.status_code != 200 or self.versions(names) != versions:
+                            # An error, or a write landed while rendering: don't tag it
+                            return response
+                        if not response.is_streamed:
+                            self.remember(key, versions, response)
+
+                response.set_etag(etag)
+                if last_modified is not None:
+                    response.last_modified = last_modified
+                # Let browsers keep the body but revalidate it on every poll
+                response.headers['Cache-Control'] = 'no-cache'
+                return response
+            return wrapper
+        return decorator
@@ -0,0 +1,83 @@
+"""Resized photo renditions and perceptual hashes.
+
+Each uploaded photo is decoded once, rotated upright from its EXIF orientation,
+stripped of metadata (EXIF, GPS, ICC) and re-encoded as WebP at a few fixed
+sizes. The renditions go into their own blob store (data/renditions/), the
+only one the app serves: an original upload keeps its EXIF, GPS position
+included, so it is stored but never sent out. The same pass computes a 64-bit
+difference hash (dHash) used to find similar photos.
+
+The app runs this as a background job (see jobs.py), off the request path.
+Pillow is optional: without it uploads are stored but reports show no photo.
+"""
+import io
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - optional dependency
+    Image = None
+
+# rendition name -> longest side in pixels, largest first
+RENDITIONS = {
+    'full': 1600,
+    'card': 480,
+    'thumb': 160,
+}
+WEBP_QUALITY = 80
+# A photo whose hashing thumbnail spans fewer gray levels than this (blank,
+# solid or nearly so) gets no hash: its bits would say nothing about it
+MIN_CONTRAST = 8
+
+
+def dhash(image, size=8):
+    """Difference hash: one bit per horizontally adjacent pixel pair, as hex;
+    None for an image too flat to tell apart from others"""
+    gray = image.convert('L').resize((size + 1, size), Image.LANCZOS)
+    pixels = list(gray.getdata())
+    if max(pixels) - min(pixels) < MIN_CONTRAST:
+        return None
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            i = row * (size + 1) + col
+            bits = (bits << 1) | (pixels[i] > pixels[i + 1])
+    return f'{bits:0{size * size // 4}x}'
+
+
+def process_image(blobs, digest, renditions):
+    """Renditions (put in the renditions store) and perceptual hash for a blob:
+    {'renditions': {name: digest}, 'phash': hex or None}"""
+    with Image.open(blobs.path(digest)) as original:
+        image = ImageOps.exif_transpose(original)
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+    return {'renditions': make_renditions(renditions, image), 'phash': dhash(image)}
+
+
+def make_renditions(blobs, image):
+    """Store resized WebP copies of a decoded image, returning {rendition: digest}.
+    Re-encoding from pixels leaves every metadata block of the original behind."""
+    image = image.copy()
+    renditions = {}
+    # Each size is shrunk from the previous one, which is cheaper than the original
+    for name, size in RENDITIONS.items():
+        image.thumbnail((size, size), Image.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, 'WEBP', quality=WEBP_QUALITY, method=4)
+        renditions[name] = blobs.put(out.getvalue())
+    return renditions
+
+
+class ImagePipeline:
+    """process_image() from one blob store into another, disabled when Pillow
+    is missing"""
+
+    def __init__(self, blobs, renditions):
+        self.blobs = blobs
+        self.renditions = renditions
+        self.enabled = Image is not None
+
+    def process(self, digest):
+        """Renditions and hash for digest; {} if Pillow is unavailable"""
+        if not self.enabled:
+            return {}
+        return process_image(self.blobs, digest, self.renditions)
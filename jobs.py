@@ -0,0 +1,189 @@
+"""Durable background job queue backed by SQLite.
+
+Jobs are rows in data/jobs.sqlite3, so queued work survives a restart and any
+worker process can pick it up; there is no external broker. Each process runs
+a few worker threads that claim the oldest queued job in an IMMEDIATE
+transaction, run the handler registered for its kind and store the result.
+A job left 'running' by a crashed worker is requeued once its lease expires,
+and a failing job is retried up to MAX_ATTEMPTS times, each retry waiting
+twice as long as the one before (RETRY_DELAY seconds first), so a brief
+outage does not use up every attempt. A job that fails for good stays in
+the table as 'failed' and is logged at ERROR level, and counts() feeds the
+jobs gauge in /metrics for alerting.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+WORKERS = 2
+POLL_INTERVAL = 1.0
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 6
+# seconds before the first retry; each later one waits twice as long
+RETRY_DELAY = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    lease_until REAL,
+    run_after REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+"""
+
+# columns added since the first schema, for existing databases
+MIGRATIONS = {
+    'run_after': 'ALTER TABLE jobs ADD COLUMN run_after REAL',
+}
+
+
+class JobQueue:
+    def __init__(self, path, workers=WORKERS, before_each=None):
+        self.path = path
+        self.workers = workers
+        self.before_each = before_each
+        self.handlers = {}
+        self.local = threading.local()
+        self.wakeup = threading.Event()
+        self.pid = None
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+            columns = {row['name'] for row in db.execute('PRAGMA table_info(jobs)')}
+            for column, statement in MIGRATIONS.items():
+                if column not in columns:
+                    db.execute(statement)
+
+    def connect(self):
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.row_factory = sqlite3.Row
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def handler(self, kind):
+        """Register fn(payload) -> result (JSON-serializable) for jobs of kind"""
+        def decorator(fn):
+            self.handlers[kind] = fn
+            return fn
+        return decorator
+
+    def enqueue(self, kind, payload, unique=False):
+        """Queue a job and return its id; with unique=True reuse a queued one of the same kind"""
+        db = self.connect()
+        now = time.time()
+        if unique:
+            row = db.execute("SELECT id FROM jobs WHERE kind = ? AND status = 'queued' LIMIT 1",
+                             (kind,)).fetchone()
+            if row:
+                return row['id']
+        cur = db.execute('INSERT INTO jobs (kind, payload, created_at, updated_at) VALUES (?, ?, ?, ?)',
+                         (kind, json.dumps(payload), now, now))
+        self.start()
+        self.wakeup.set()
+        return cur.lastrowid
+
+    def counts(self):
+        """{(kind, status): jobs} for the jobs not done, i.e. waiting or given up"""
+        rows = self.connect().execute("SELECT kind, status, COUNT(*) AS n FROM jobs "
+                                      "WHERE status IN ('queued', 'running', 'failed') GROUP BY kind, status")
+        return {(row['kind'], row['status']): row['n'] for row in rows}
+
+    def get(self, job_id):
+        row = self.connect().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'id': row['id'],
+            'kind': row['kind'],
+            'status': row['status'],
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error'],
+            'attempts': row['attempts'],
+            # When a failed job is tried again (None unless it is waiting to be)
+            'retry_at': row['run_after'] if row['status'] == 'queued' else None,
+            'created_at': row['created_at'],
+            'updated_at': row['updated_at']
+        }
+
+    def start(self):
+        """Start this process's worker threads (again, after a fork)"""
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f'jobs-{i}', daemon=True).start()
+
+    def _claim(self):
+        db = self.connect()
+        now = time.time()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # Jobs whose worker died mid-run go back to the queue
+            db.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running' AND lease_until < ?", (now,))
+            row = db.execute("SELECT * FROM jobs WHERE status = 'queued' AND (run_after IS NULL OR run_after <= ?) "
+                             "ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                db.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ?, "
+                           "lease_until = ? WHERE id = ?", (now, now + LEASE_SECONDS, row['id']))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return row
+
+    def _finish(self, job_id, status, result=None, error=None, run_after=None):
+        self.connect().execute('UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ?, '
+                               'lease_until = NULL, run_after = ? WHERE id = ?',
+                               (status, json.dumps(result) if result is not None else None, error,
+                                time.time(), run_after, job_id))
+
+    def run_one(self):
+        """Claim and run one queued job; returns False when the queue is empty"""
+        row = self._claim()
+        if row is None:
+            return False
+        try:
+            if self.before_each:
+                self.before_each()
+            handler = self.handlers[row['kind']]
+            result = handler(json.loads(row['payload']))
+        except Exception as e:
+            # attempts was counted up when the job was claimed
+            attempts = row['attempts'] + 1
+            if attempts >= MAX_ATTEMPTS:
+                log.exception('Job %s (%s) failed for good after %d attempts', row['id'], row['kind'], attempts)
+                self._finish(row['id'], 'failed', error=str(e))
+            else:
+                delay = RETRY_DELAY * 2 ** (attempts - 1)
+                log.warning('Job %s (%s) failed, retrying in %ds: %s', row['id'], row['kind'], delay, e)
+                self._finish(row['id'], 'queued', error=str(e), run_after=time.time() + delay)
+        else:
+            self._finish(row['id'], 'done', result=result)
+        return True
+
+    def _work(self):
+        while True:
+            try:
+                if self.run_one():
+                    continue
+            except Exception:
+                log.exception('Job worker error')
+            self.wakeup.wait(POLL_INTERVAL)
+            self.wakeup.clear()
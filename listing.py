@@ -0,0 +1,228 @@
+"""Pagination, sorting and field projection for the list endpoints.
+
+Without any of the parameters below a list endpoint behaves as it always has
+and returns every record as one JSON array. Passing them keeps that array
+shape, so existing clients are unaffected:
+
+    limit=N            at most N records (capped at MAX_LIMIT)
+    sort=key / -key    order by id, submitted_at, approved_at or name (ties by id)
+    cursor=...         continue after the last record of a previous page
+    fields=a,b         only return these fields ('id' is always included)
+
+    stream=1           send the array incrementally instead of building it first
+    format=ndjson      stream one JSON record per line (bulk export / backups)
+
+When more records are available the response carries the cursor for the next
+page in an X-Next-Cursor header and a Link: <...>; rel="next" header. A page is
+picked with heapq, so memory per request is bounded by the page size rather
+than by the number of records. Streamed responses serialize records a chunk
+at a time, so exporting the whole registry never holds its full JSON text.
+
+Search results are always paged, DEFAULT_LIMIT at a time without a limit=,
+and ranked_needed() tells the search how much of its ranking a page needs.
+"""
+import base64
+import heapq
+import json
+from urllib.parse import urlencode
+
+from flask import Response, current_app, jsonify, request
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# sortable key -> value used when a record lacks it
+SORT_KEYS = {
+    'id': 0,
+    'submitted_at': '',
+    'approved_at': '',
+    'name': '',
+}
+
+
+class ListingError(ValueError):
+    """Bad pagination parameters; reported to the client as a 400"""
+
+
+def encode_cursor(state):
+    return base64.urlsafe_b64encode(json.dumps(state).encode()).decode().rstrip('=')
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def valid_cursor_state(state):
+    """Whether a decoded cursor is one encode_cursor() could have made:
+    {'offset': n} or {'sort': key, 'after': [value, id]}"""
+    if not isinstance(state, dict):
+        return False
+    if set(state) == {'offset'}:
+        return is_int(state['offset']) and state['offset'] >= 0
+    if set(state) != {'sort', 'after'} or not isinstance(state['sort'], str):
+        return False
+    name = state['sort'][1:] if state['sort'].startswith('-') else state['sort']
+    after = state['after']
+    return (name in SORT_KEYS and isinstance(after, list) and len(after) == 2
+            and type(after[0]) is type(SORT_KEYS[name]) and is_int(after[1]))
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        state = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        raise ListingError('Invalid cursor')
+    if not valid_cursor_state(state):
+        raise ListingError('Invalid cursor')
+    return state
+
+
+def parse_fields(args):
+    fields = args.get('fields')
+    if not fields:
+        return None
+    return {'id'} | {f.strip() for f in fields.split(',') if f.strip()}
+
+
+def project(record, fields):
+    if fields is None:
+        return record
+    return {k: v for k, v in record.items() if k in fields}
+
+
+def parse_limit(args, paged):
+    limit = args.get('limit')
+    if limit is None:
+        return DEFAULT_LIMIT if paged else None
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise ListingError('limit must be an integer')
+    if limit < 1:
+        raise ListingError('limit must be positive')
+    return min(limit, MAX_LIMIT)
+
+
+def ranked_needed(args):
+    """How many records from the top of a ranked list the page asked for
+    needs: its offset, the page and one more to tell if another page follows.
+    None if a sort= orders the whole list instead."""
+    cursor = args.get('cursor')
+    state = decode_cursor(cursor) if cursor else None
+    if (state.get('sort') if state else args.get('sort')) is not None:
+        return None
+    offset = state.get('offset', 0) if state else 0
+    return offset + parse_limit(args, True) + 1
+
+
+def sort_key(name):
+    default = SORT_KEYS[name]
+
+    def key(record):
+        value = record.get(name)
+        return (default if value is None else value, record.get('id', 0))
+    return key
+
+
+def select_page(records, args, default_sort='id', paged=False):
+    """Return (page of records, next cursor state or None) for the given args.
+
+    records is iterated once; it may be a collection, list or generator.
+    With default_sort=None, pages without a sort= keep the order of records
+    (e.g. search ranking) and continue by offset. With paged=True a page is
+    returned even when no paging parameter is given.
+    """
+    cursor = args.get('cursor')
+    state = decode_cursor(cursor) if cursor else None
+    sort = args.get('sort')
+    paged = paged or bool(cursor or sort or args.get('limit'))
+    limit = parse_limit(args, paged)
+
+    if not paged:
+        return records, None
+
+    if state:
+        sort = state.get('sort')
+    elif sort is None:
+        sort = default_sort
+
+    if sort is None:
+        # Keep the caller's order (e.g. search ranking) and page by offset
+        offset = state.get('offset', 0) if state else 0
+        page = []
+        for i, record in enumerate(records):
+            if i < offset:
+                continue
+            if len(page) == limit:
+                return page, {'offset': offset + limit}
+            page.append(record)
+        return page, None
+
+    descending = sort.startswith('-')
+    name = sort.lstrip('-')
+    if name not in SORT_KEYS:
+        raise ListingError(f'Cannot sort by {name}')
+    key = sort_key(name)
+    if state:
+        after = tuple(state.get('after', ()))
+        if descending:
+            records = (r for r in records if key(r) < after)
+        else:
+            records = (r for r in records if key(r) > after)
+    pick = heapq.nlargest if descending else heapq.nsmallest
+    page = pick(limit + 1, records, key=key)
+    if len(page) <= limit:
+        return page, None
+    page = page[:limit]
+    return page, {'sort': sort, 'after': list(key(page[-1]))}
+
+
+def stream_records(records, fields, dumps, ndjson=False):
+    """Yield a JSON array (or NDJSON lines) of records in ~STREAM_CHUNK_SIZE chunks"""
+    buffer = []
+    size = 0
+    if not ndjson:
+        buffer.append('[')
+    first = True
+    for record in records:
+        text = dumps(project(record, fields))
+        if ndjson:
+            text += '\n'
+        elif not first:
+            text = ',' + text
+        first = False
+        buffer.append(text)
+        size += len(text)
+        if size >= STREAM_CHUNK_SIZE:
+            yield ''.join(buffer)
+            buffer, size = [], 0
+    if not ndjson:
+        buffer.append(']\n')
+    if buffer:
+        yield ''.join(buffer)
+
+
+def list_response(records, args=None, default_sort='id', paged=False):
+    """JSON array response for a list endpoint, honouring the paging params"""
+    args = request.args if args is None else args
+    fields = parse_fields(args)
+    page, next_state = select_page(records, args, default_sort, paged)
+    ndjson = args.get('format') == 'ndjson'
+    if ndjson or args.get('stream') == '1':
+        # Iterate a snapshot of the references, not the live dict
+        page = list(page)
+        dumps = current_app.json.dumps
+        mimetype = 'application/x-ndjson' if ndjson else current_app.json.mimetype
+        response = Response(stream_records(page, fields, dumps, ndjson), mimetype=mimetype)
+    else:
+        response = jsonify([project(r, fields) for r in page])
+    if next_state is not None:
+        next_cursor = encode_cursor(next_state)
+        query = args.to_dict()
+        query['cursor'] = next_cursor
+        query.pop('sort', None)
+        response.headers['X-Next-Cursor'] = next_cursor
+        response.headers['Link'] = f'<{request.base_url}?{urlencode(query)}>; rel="next"'
+    return response
@@ -0,0 +1,205 @@
+"""Fuzzy and phonetic name matching, used to spot duplicate reports.
+
+Names are compared by trigram similarity (Dice coefficient over the padded
+trigrams of each word, so word order does not matter) and by a phonetic key
+that folds common spelling and transliteration variants together
+('Mohammed Khan' / 'Muhamad Kaan'). Phonetic keys are kept per word, so a
+query matches names holding all of its words ('jon' finds 'John Smith'),
+scored by the share of the name it covers.
+
+A NameMatcher indexes each distinct name in a collection once (many reports
+share a name), in a trigram -> names inverted index and a phonetic word ->
+names table. A name needs a minimum number of the query's trigrams to reach
+the threshold, so only the postings of the rarest query trigrams are read for
+candidates, and each candidate is then scored with one set intersection.
+"""
+import heapq
+import math
+import re
+import threading
+
+from search import tokenize
+
+# similarity at or above which a new report is flagged as a likely duplicate
+DUPLICATE_THRESHOLD = 0.6
+# looser cut-off for ?fuzzy=1 searches
+FUZZY_THRESHOLD = 0.35
+# score given to names whose phonetic keys match exactly
+PHONETIC_SCORE = 0.75
+
+# spelling variants folded together before building a phonetic key
+PHONETIC_RULES = [
+    (re.compile(r'ph'), 'f'),
+    (re.compile(r'([kgtdbcj])h'), r'\1'),
+    (re.compile(r'sh|sch'), 's'),
+    (re.compile(r'ck|q|c(?=[aou])'), 'k'),
+    (re.compile(r'c'), 's'),
+    (re.compile(r'z'), 's'),
+    (re.compile(r'w'), 'v'),
+    (re.compile(r'x'), 'ks'),
+    (re.compile(r'y'), 'i'),
+]
+VOWELS_RE = re.compile(r'[aeiou]+')
+REPEAT_RE = re.compile(r'(.)\1+')
+
+
+def trigrams(name):
+    grams = set()
+    for token in tokenize(name):
+        padded = f'  {token} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def phonetic_word(word):
+    for pattern, replacement in PHONETIC_RULES:
+        word = pattern.sub(replacement, word)
+    word = REPEAT_RE.sub(r'\1', word)
+    # keep the leading sound, drop the vowels after it
+    return word[:1] + VOWELS_RE.sub('', word[1:]).replace('h', '')
+
+
+def phonetic_keys(name):
+    """Phonetic keys of the words of a name"""
+    return frozenset(phonetic_word(t) for t in tokenize(name) if not t.isdigit())
+
+
+def similarity(a, b):
+    """Trigram Dice similarity of two names, from 0.0 to 1.0"""
+    ta, tb = trigrams(a), trigrams(b)
+    if not ta or not tb:
+        return 0.0
+    return 2 * len(ta & tb) / (len(ta) + len(tb))
+
+
+class NameMatcher:
+    """Fuzzy name lookup over one store collection"""
+
+    def __init__(self, collection, field='name'):
+        self.collection = collection
+        self.field = field
+        # Indexed per distinct spelling, since many records share a name
+        self.names = {}      # id -> its name's words, joined
+        self.ids = {}        # name -> ids of the records with it
+        self.grams = {}      # name -> trigram set
+        self.keys = {}       # name -> phonetic keys of its words
+        self.postings = {}   # trigram -> names
+        self.phonetic = {}   # phonetic word key -> names
+        self.lock = threading.Lock()
+        collection.watch(self._changed)
+
+    def _changed(self, old, new):
+        if old is not None and new is not None and old.get(self.field) == new.get(self.field):
+            return
+        with self.lock:
+            if old is not None:
+                self._remove(old['id'])
+            if new is not None:
+                self._add(new['id'], new.get(self.field) or '')
+
+    def _add(self, record_id, text):
+        name = ' '.join(tokenize(text))
+        self.names[record_id] = name
+        ids = self.ids.get(name)
+        if ids is not None:
+            ids.add(record_id)
+            return
+        self.ids[name] = {record_id}
+        grams = trigrams(name)
+        keys = phonetic_keys(name)
+        self.grams[name] = grams
+        self.keys[name] = keys
+        for gram in grams:
+            self.postings.setdefault(gram, set()).add(name)
+        for key in keys:
+            self.phonetic.setdefault(key, set()).add(name)
+
+    def _remove(self, record_id):
+        name = self.names.pop(record_id, None)
+        if name is None:
+            return
+        ids = self.ids[name]
+        ids.discard(record_id)
+        if ids:
+            return
+        del self.ids[name]
+        for gram in self.grams.pop(name):
+            names = self.postings[gram]
+            names.discard(name)
+            if not names:
+                del self.postings[gram]
+        for key in self.keys.pop(name):
+            names = self.phonetic[key]
+            names.discard(name)
+            if not names:
+                del self.phonetic[key]
+
+    def match(self, name, threshold=DUPLICATE_THRESHOLD, limit=None):
+        """Return [(record id, score)] for names similar to name, best first"""
+        query = trigrams(name)
+        if not query:
+            return []
+        keys = phonetic_keys(name)
+        with self.lock:
+            scores = self._trigram_scores(query, threshold)
+            for match, score in self._phonetic_scores(keys, threshold):
+                if score > scores.get(match, 0):
+                    scores[match] = score
+            # Every name has at least one id, so limit names are enough
+            best = (heapq.nlargest(limit, scores.items(), key=lambda item: item[1]) if limit
+                    else sorted(scores.items(), key=lambda item: item[1], reverse=True))
+            ranked = []
+            for match, score in best:
+                ranked.extend((record_id, score) for record_id in self.ids[match])
+                if limit and len(ranked) >= limit:
+                    return ranked[:limit]
+        return ranked
+
+    def _trigram_scores(self, query, threshold):
+        """{name: Dice score} for the indexed names scoring at least threshold"""
+        size = len(query)
+        if threshold > 0:
+            # Dice >= threshold needs this many shared grams, and a length
+            # within these bounds, whatever the other name
+            needed = max(1, math.ceil(threshold * size / (2 - threshold) - 1e-9))
+            shortest, longest = threshold * size / (2 - threshold), (2 - threshold) * size / threshold
+        else:
+            needed, shortest, longest = 1, 0, math.inf
+        # A name missing all of the size - needed + 1 rarest grams cannot share
+        # enough of the rest, so candidates come from those postings only
+        rarest = sorted(query, key=lambda gram: len(self.postings.get(gram, ())))[:size - needed + 1]
+        candidates = set().union(*(self.postings.get(gram, ()) for gram in rarest))
+        scores = {}
+        for name in candidates:
+            grams = self.grams[name]
+            if not shortest <= len(grams) <= longest:
+                continue
+            score = 2 * len(query & grams) / (size + len(grams))
+            if score >= threshold:
+                scores[name] = score
+        return scores
+
+    def _phonetic_scores(self, keys, threshold):
+        """(name, score) for names holding every phonetic key of the query,
+        scored PHONETIC_SCORE times the share of the name's words it covers"""
+        if not keys or PHONETIC_SCORE < threshold:
+            return
+        postings = sorted((self.phonetic.get(key, set()) for key in keys), key=len)
+        for name in postings[0].intersection(*postings[1:]):
+            score = PHONETIC_SCORE * len(keys) / len(self.keys[name])
+            if score >= threshold:
+                yield name, score
+
+    def search(self, name, threshold=FUZZY_THRESHOLD, limit=None):
+        """Records whose name fuzzily matches, best first"""
+        records = (self.collection.get(i) for i, _ in self.match(name, threshold, limit))
+        return [r for r in records if r is not None]
+
+
+def find_duplicates(matchers, name, threshold=DUPLICATE_THRESHOLD, limit=10):
+    """Ids of likely duplicates of name across several matchers, best first"""
+    found = {}
+    for matcher in matchers:
+        for record_id, score in matcher.match(name, threshold, limit):
+            found[record_id] = max(score, found.get(record_id, 0))
+    return sorted(found, key=found.get, reverse=True)[:limit]
@@ -0,0 +1,259 @@
+"""Request metrics and an on-demand sampling profiler, in Prometheus format.
+
+Every request is timed per route and split into phases:
+
+    storage_read   reading data files (snapshots, the store log or SQLite)
+    parse          decoding what was read
+    serialize      encoding JSON responses
+    write          appending/committing changes and syncing them to disk
+    compute        everything else the view did
+
+The store reports its I/O through Store.on_io, so the read/parse/write
+phases and the per-file byte counters need nothing in the views; serialize
+is timed in the app's JSON provider. GET /metrics renders the counters and
+histograms in the Prometheus text format. The numbers are per process, so
+with several workers each scrape sees the worker that answered it; scrape
+each worker, or run one for metrics.
+
+With PROFILE_REQUESTS enabled, a request sent with an X-Profile: 1 header is
+sampled every PROFILE_INTERVAL seconds by a helper thread while it runs. The
+response carries an X-Profile-Id, and GET /metrics/profiles/<id> returns the
+samples as collapsed stacks (one 'frame;frame;frame count' line each), which
+flamegraph.pl and speedscope read. Only the last PROFILE_KEEP profiles are kept.
+"""
+import bisect
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, abort, g, has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+
+DEFAULTS = {
+    'PROFILE_REQUESTS': False,
+    'PROFILE_INTERVAL': 0.005,
+    'PROFILE_KEEP': 20,
+}
+# seconds; roughly exponential from 0.5 ms to 10 s
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PHASES = ('storage_read', 'parse', 'serialize', 'write', 'compute')
+# store on_io op -> phase
+IO_PHASES = {'read': 'storage_read', 'parse': 'parse', 'write': 'write', 'sync': 'write'}
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{escape(v)}"' for n, v in zip(names, values)) + '}'
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        with self.lock:
+            items = sorted(self.values.items())
+        for labels, value in items:
+            yield f'{self.name}{format_labels(self.labels, labels)} {value}'
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.series = {}   # labels -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        with self.lock:
+            items = sorted((labels, list(series)) for labels, series in self.series.items())
+        names = self.labels + ('le',)
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield f'{self.name}_bucket{format_labels(names, labels + (bound,))} {cumulative}'
+            yield f'{self.name}_bucket{format_labels(names, labels + ("+Inf",))} {series[-1]}'
+            yield f'{self.name}_sum{format_labels(self.labels, labels)} {series[-2]:.6f}'
+            yield f'{self.name}_count{format_labels(self.labels, labels)} {series[-1]}'
+
+
+class Gauge:
+    """Value read from a callback at scrape time: fn() -> {labels: value}"""
+
+    def __init__(self, name, help, labels, fn):
+        self.name, self.help, self.labels, self.fn = name, help, labels, fn
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} gauge'
+        for labels, value in sorted(self.fn().items()):
+            yield f'{self.name}{format_labels(self.labels, labels)} {value}'
+
+
+class Sampler:
+    """Samples one thread's stack on a helper thread until stopped"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+        return ''.join(f'{stack} {count}\n' for stack, count in
+                       sorted(self.stacks.items(), key=lambda item: -item[1]))
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Counts time spent encoding JSON responses as the serialize phase"""
+
+    def dumps(self, obj, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            add_phase('serialize', time.perf_counter() - started)
+
+
+def add_phase(phase, seconds):
+    if has_request_context():
+        phases = g.get('metric_phases')
+        if phases is not None:
+            phases[phase] = phases.get(phase, 0) + seconds
+
+
+class Metrics:
+    def __init__(self, app, store):
+        for key, value in DEFAULTS.items():
+            app.config.setdefault(key, value)
+        self.app = app
+        self.store = store
+        self.requests = Counter('http_requests_total', 'Requests handled', ('route', 'method', 'status'))
+        self.duration = Histogram('http_request_duration_seconds', 'Request time', ('route', 'method'))
+        self.phases = Histogram('http_request_phase_seconds', 'Request time by phase', ('route', 'phase'))
+        self.bytes_read = Counter('store_bytes_read_total', 'Bytes read from data files', ('file',))
+        self.bytes_written = Counter('store_bytes_written_total', 'Bytes written to data files', ('file',))
+        self.io_seconds = Counter('store_io_seconds_total', 'Time spent on data file I/O', ('file', 'op'))
+        self.records = Gauge('store_records', 'Records held per collection', ('collection',),
+                             lambda: {(name, ): len(c) for name, c in store.collections.items()})
+        self.versions = Gauge('store_collection_version', 'Writes made per collection', ('collection',),
+                              lambda: {(name, ): c.version for name, c in store.collections.items()})
+        self.all = (self.requests, self.duration, self.phases, self.bytes_read, self.bytes_written,
+                    self.io_seconds, self.records, self.versions)
+        self.profiles = OrderedDict()
+        self.profile_ids = itertools.count(1)
+        self.profile_lock = threading.Lock()
+
+        app.json = TimedJSONProvider(app)
+        store.on_io = self.record_io
+        # Registered first so the timing covers the other before_request hooks
+        app.before_request_funcs.setdefault(None, []).insert(0, self.start)
+        app.after_request(self.finish)
+        app.add_url_rule('/metrics', 'metrics', self.render)
+        app.add_url_rule('/metrics/profiles/<int:profile_id>', 'metrics_profile', self.profile)
+        app.extensions['metrics'] = self
+
+    def add_jobs(self, jobs):
+        """Export the job queue's waiting and failed jobs (shared by every
+        worker, so any of them reports the same numbers)"""
+        self.all += (Gauge('jobs', 'Background jobs queued, running or failed for good', ('kind', 'status'),
+                           jobs.counts),)
+
+    def record_io(self, op, path, nbytes, seconds):
+        name = os.path.basename(path)
+        if op == 'read':
+            self.bytes_read.inc(name, amount=nbytes)
+        elif op == 'write':
+            self.bytes_written.inc(name, amount=nbytes)
+        self.io_seconds.inc(name, op, amount=seconds)
+        add_phase(IO_PHASES[op], seconds)
+
+    def start(self):
+        g.metric_started = time.perf_counter()
+        g.metric_phases = {}
+        g.metric_sampler = None
+        if self.app.config['PROFILE_REQUESTS'] and request.headers.get('X-Profile') == '1':
+            g.metric_sampler = Sampler(threading.get_ident(), self.app.config['PROFILE_INTERVAL'])
+
+    def finish(self, response):
+        started = g.get('metric_started')
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        self.requests.inc(route, request.method, str(response.status_code))
+        self.duration.observe(elapsed, route, request.method)
+        phases = g.metric_phases
+        phases['compute'] = max(0.0, elapsed - sum(phases.values()))
+        for phase in PHASES:
+            if phase in phases:
+                self.phases.observe(phases[phase], route, phase)
+        if g.metric_sampler is not None:
+            response.headers['X-Profile-Id'] = str(self.save_profile(g.metric_sampler.stop()))
+        return response
+
+    def save_profile(self, stacks):
+        with self.profile_lock:
+            profile_id = next(self.profile_ids)
+            self.profiles[profile_id] = stacks
+            while len(self.profiles) > self.app.config['PROFILE_KEEP']:
+                self.profiles.popitem(last=False)
+        return profile_id
+
+    def render(self):
+        lines = []
+        for metric in self.all:
+            lines.extend(metric.render())
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+    def profile(self, profile_id):
+        with self.profile_lock:
+            stacks = self.profiles.get(profile_id)
+        if stacks is None:
+            abort(404)
+        return Response(stacks, mimetype='text/plain')
@@ -0,0 +1,163 @@
+"""Password hashing and verification for user accounts.
+
+Passwords are stored as scrypt hashes in the form
+
+    scrypt$<n>$<r>$<p>$<salt>$<hash>
+
+(base64 salt and hash), so the work factor travels with each hash and can be
+raised without invalidating existing accounts: a successful login with an
+older or weaker hash, or with a plaintext password left over from before
+hashing, hands back a fresh hash to store.
+
+scrypt is deliberately slow and memory-hard (128 * n * r bytes per hash), and
+hashlib runs it without holding the GIL. Hashing happens on a small thread
+pool so at most PASSWORD_WORKERS hashes run at once per process however many
+logins arrive; beyond PASSWORD_QUEUE waiting logins the rest get a 503 rather
+than piling up behind each other. Settings, from app.config:
+
+    PASSWORD_SCRYPT_N        CPU/memory cost (a power of two)
+    PASSWORD_SCRYPT_R        block size
+    PASSWORD_SCRYPT_P        parallelism
+    PASSWORD_WORKERS         hashes computed at once by this process
+    PASSWORD_QUEUE           logins/signups waiting for a worker
+
+`flask --app app benchmark-passwords` times the candidate cost settings.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import ServiceUnavailable
+
+DEFAULTS = {
+    'PASSWORD_SCRYPT_N': 2 ** 14,
+    'PASSWORD_SCRYPT_R': 8,
+    'PASSWORD_SCRYPT_P': 1,
+    'PASSWORD_WORKERS': 4,
+    'PASSWORD_QUEUE': 64,
+}
+PREFIX = 'scrypt'
+SALT_SIZE = 16
+HASH_SIZE = 32
+
+
+def b64encode(data):
+    return base64.b64encode(data).decode('ascii').rstrip('=')
+
+
+def b64decode(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def scrypt(password, salt, n, r, p):
+    # OpenSSL refuses to use more than 32 MB unless told otherwise
+    maxmem = 128 * n * r * (p + 2)
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                          maxmem=maxmem, dklen=HASH_SIZE)
+
+
+def hash_password(password, n, r, p):
+    salt = os.urandom(SALT_SIZE)
+    digest = scrypt(password, salt, n, r, p)
+    return f'{PREFIX}${n}${r}${p}${b64encode(salt)}${b64encode(digest)}'
+
+
+def parse_hash(stored):
+    """(n, r, p, salt, digest) from a stored hash, or None if it isn't one"""
+    parts = stored.split('$') if isinstance(stored, str) else []
+    if len(parts) != 6 or parts[0] != PREFIX:
+        return None
+    try:
+        return int(parts[1]), int(parts[2]), int(parts[3]), b64decode(parts[4]), b64decode(parts[5])
+    except ValueError:
+        return None
+
+
+def check_password(stored, password):
+    """Whether password matches stored (a hash, or a legacy plaintext password)"""
+    parsed = parse_hash(stored)
+    if parsed is None:
+        if not isinstance(stored, str):
+            return False
+        return hmac.compare_digest(stored.encode('utf-8'), password.encode('utf-8'))
+    n, r, p, salt, digest = parsed
+    return hmac.compare_digest(scrypt(password, salt, n, r, p), digest)
+
+
+class Passwords:
+    """Hashes and checks passwords on a bounded per-process thread pool"""
+
+    def __init__(self, app):
+        for key, value in DEFAULTS.items():
+            app.config.setdefault(key, value)
+        self.config = app.config
+        self.workers = app.config['PASSWORD_WORKERS']
+        self.max_queue = app.config['PASSWORD_QUEUE']
+        self.pool = None
+        self.pid = None
+        self.waiting = 0
+        self.lock = threading.Lock()
+        self.dummy_hash = None
+        app.extensions['passwords'] = self
+
+    @property
+    def params(self):
+        c = self.config
+        return c['PASSWORD_SCRYPT_N'], c['PASSWORD_SCRYPT_R'], c['PASSWORD_SCRYPT_P']
+
+    def _run(self, fn, *args):
+        with self.lock:
+            if self.pid != os.getpid():
+                # Pool threads don't survive a fork
+                self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix='passwords')
+                self.pid = os.getpid()
+            if self.waiting >= self.workers + self.max_queue:
+                raise ServiceUnavailable('Too many logins in progress, try again shortly')
+            self.waiting += 1
+            pool = self.pool
+        try:
+            return pool.submit(fn, *args).result()
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+    def hash(self, password):
+        return self._run(hash_password, password, *self.params)
+
+    def needs_rehash(self, stored):
+        parsed = parse_hash(stored)
+        return parsed is None or parsed[:3] != self.params
+
+    def verify(self, stored, password):
+        """Check password against a stored hash (None for an unknown user).
+
+        Returns (matched, new_hash), where new_hash is set when the stored
+        value should be replaced with one using the current settings. Unknown
+        users are checked against a throwaway hash so they take as long as
+        real ones.
+        """
+        if stored is None:
+            if self.dummy_hash is None:
+                self.dummy_hash = self.hash(b64encode(os.urandom(SALT_SIZE)))
+            self._run(check_password, self.dummy_hash, password)
+            return False, None
+        if not self._run(check_password, stored, password):
+            return False, None
+        if self.needs_rehash(stored):
+            return True, self.hash(password)
+        return True, None
+
+
+def benchmark(n_values, r, p, rounds=3):
+    """Yield (n, ms per hash, MB per hash) for each candidate n"""
+    for n in n_values:
+        salt = os.urandom(SALT_SIZE)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            scrypt('benchmark password', salt, n, r, p)
+        elapsed = (time.perf_counter() - start) / rounds
+        yield n, elapsed * 1000, 128 * n * r / (1024 * 1024)
@@ -0,0 +1,101 @@
+"""Nearest-neighbour lookup of report photos by perceptual hash.
+
+Photos are compared by the Hamming distance of their 64-bit dHash
+(images.dhash). The index uses multi-index hashing: each hash is split into
+CHUNKS 16-bit pieces, each with its own table. If two hashes are within
+distance d, at least one piece differs by at most d // CHUNKS bits, so a query
+only probes the table buckets within that radius and checks the full distance
+on the few candidates found.
+
+Hashes with almost every bit the same (a blank or solid photo hashes to 0)
+describe no picture, and would all match one another; they are neither
+indexed nor looked up.
+"""
+import threading
+from itertools import combinations
+
+HASH_BITS = 64
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+# default Hamming distance for "similar photo" (out of 64 bits)
+SIMILAR_DISTANCE = 10
+# tighter distance used to flag a likely duplicate submission
+DUPLICATE_DISTANCE = 6
+# a hash needs at least this many bits set, and as many clear, to be compared
+MIN_BITS = 8
+
+
+def informative(value):
+    """Whether a hash has enough of both bit values to tell photos apart"""
+    return MIN_BITS <= bin(value).count('1') <= HASH_BITS - MIN_BITS
+
+
+def chunks(value):
+    return [(value >> (i * CHUNK_BITS)) & CHUNK_MASK for i in range(CHUNKS)]
+
+
+def neighbours(value, radius):
+    """Every CHUNK_BITS-bit value within radius bit flips of value"""
+    for flips in range(radius + 1):
+        for bits in combinations(range(CHUNK_BITS), flips):
+            flipped = value
+            for bit in bits:
+                flipped ^= 1 << bit
+            yield flipped
+
+
+class PhotoIndex:
+    """Hamming-distance index over the 'phash' field of store collections"""
+
+    def __init__(self, *collections, field='phash'):
+        self.field = field
+        self.hashes = {}   # record id -> int hash
+        self.tables = [{} for _ in range(CHUNKS)]   # chunk value -> ids
+        self.lock = threading.Lock()
+        for collection in collections:
+            collection.watch(self._changed)
+
+    def _changed(self, old, new):
+        old_hash = old.get(self.field) if old is not None else None
+        new_hash = new.get(self.field) if new is not None else None
+        if old_hash == new_hash:
+            return
+        with self.lock:
+            if old_hash:
+                self._remove(old['id'])
+            if new_hash and informative(int(new_hash, 16)):
+                self._add(new['id'], int(new_hash, 16))
+
+    def _add(self, record_id, value):
+        self.hashes[record_id] = value
+        for table, piece in zip(self.tables, chunks(value)):
+            table.setdefault(piece, set()).add(record_id)
+
+    def _remove(self, record_id):
+        value = self.hashes.pop(record_id, None)
+        if value is None:
+            return
+        for table, piece in zip(self.tables, chunks(value)):
+            ids = table.get(piece)
+            if ids is not None:
+                ids.discard(record_id)
+                if not ids:
+                    del table[piece]
+
+    def near(self, phash, max_distance=SIMILAR_DISTANCE):
+        """[(record id, distance)] within max_distance of phash, closest first"""
+        value = int(phash, 16)
+        if not informative(value):
+            return []
+        radius = max_distance // CHUNKS
+        found = {}
+        with self.lock:
+            for table, piece in zip(self.tables, chunks(value)):
+                for probe in neighbours(piece, radius):
+                    for record_id in table.get(probe, ()):
+                        if record_id not in found:
+                            found[record_id] = bin(self.hashes[record_id] ^ value).count('1')
+        matches = [(i, d) for i, d in found.items() if d <= max_distance]
+        return sorted(matches, key=lambda item: item[1])
@@ -0,0 +1,160 @@
+"""Token-bucket rate limiting for API routes.
+
+A route decorated with @limiter.limit('submit_report', user=...) draws one
+token from a bucket keyed by the client's IP address, and one from a bucket
+keyed by the user it acts for when that is known. The IP bucket is checked
+first, so a throttled client is turned away before user() reads the body
+(and spools any upload in it). Buckets hold up to `burst`
+tokens and refill at `per_minute`. A request finding either bucket empty gets
+429 with a Retry-After header. Limits, from app.config:
+
+    RATE_LIMITS          {route name: (per_minute, burst)}, merged over DEFAULT_LIMITS
+    RATE_LIMIT_BACKEND   'sqlite' (default) or 'memory'
+    RATE_LIMIT_ENABLED   False turns every check off (e.g. for load tests)
+
+The 'sqlite' backend keeps buckets in data/ratelimit.sqlite3, so every worker
+process on a host draws from the same buckets; a check is one UPSERT
+statement. The 'memory' backend is a dict in each process, which is cheaper
+but gives each worker its own budget. `flask --app app benchmark-ratelimit`
+reports the per-check cost of both.
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, jsonify, request
+
+DEFAULT_LIMITS = {
+    'login': (20, 10),
+    'signup': (5, 5),
+    'submit_report': (6, 3),
+    'submit_report_info': (20, 10),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    allowed INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+# Refill, then take a token if there is a whole one; allowed records which
+TAKE = """
+INSERT INTO buckets (key, tokens, updated, allowed) VALUES (:key, :burst - 1, :now, 1)
+ON CONFLICT (key) DO UPDATE SET
+    tokens = CASE WHEN min(:burst, tokens + (:now - updated) * :rate) >= 1
+                  THEN min(:burst, tokens + (:now - updated) * :rate) - 1
+                  ELSE min(:burst, tokens + (:now - updated) * :rate) END,
+    allowed = min(:burst, tokens + (:now - updated) * :rate) >= 1,
+    updated = :now
+RETURNING tokens, allowed
+"""
+
+
+class MemoryBuckets:
+    """Buckets in a dict, private to this process"""
+
+    def __init__(self):
+        self.buckets = {}   # key -> [tokens, updated]
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Take a token; returns (allowed, tokens left)"""
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [burst, now]
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            bucket[0], bucket[1] = tokens, now
+            return allowed, tokens
+
+
+class SqliteBuckets:
+    """Buckets in a SQLite table shared by every process on the host"""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connect().executescript(SCHEMA)
+
+    def connect(self):
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            # Losing a few buckets in a power cut is harmless
+            db.execute('PRAGMA synchronous=OFF')
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def take(self, key, rate, burst):
+        tokens, allowed = self.connect().execute(
+            TAKE, {'key': key, 'rate': rate, 'burst': burst, 'now': time.time()}).fetchone()
+        return bool(allowed), tokens
+
+
+class RateLimiter:
+    def __init__(self, app, path):
+        app.config.setdefault('RATE_LIMITS', {})
+        app.config.setdefault('RATE_LIMIT_BACKEND', 'sqlite')
+        app.config.setdefault('RATE_LIMIT_ENABLED', True)
+        self.path = path
+        self.backends = {}
+        app.extensions['ratelimit'] = self
+
+    def backend(self, name):
+        if name not in self.backends:
+            self.backends[name] = SqliteBuckets(self.path) if name == 'sqlite' else MemoryBuckets()
+        return self.backends[name]
+
+    def check(self, name, keys):
+        """Take a token for each key; returns seconds to wait, or 0 if allowed"""
+        config = current_app.config
+        per_minute, burst = config['RATE_LIMITS'].get(name) or DEFAULT_LIMITS[name]
+        rate = per_minute / 60
+        buckets = self.backend(config['RATE_LIMIT_BACKEND'])
+        wait = 0
+        for key in keys:
+            allowed, tokens = buckets.take(f'{name}:{key}', rate, burst)
+            if not allowed:
+                wait = max(wait, (1 - tokens) / rate)
+        return wait
+
+    def limit(self, name, user=None):
+        """Decorate a view limited per client IP and, when user(request) gives
+        one, per user id"""
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if current_app.config['RATE_LIMIT_ENABLED']:
+                    wait = self.check(name, [f'ip:{request.remote_addr}'])
+                    user_id = user(request) if user and not wait else None
+                    if user_id:
+                        wait = self.check(name, [f'user:{user_id}'])
+                    if wait:
+                        response = jsonify({'error': 'Too many requests, try again later'})
+                        response.status_code = 429
+                        response.headers['Retry-After'] = str(math.ceil(wait))
+                        return response
+                return view(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+def benchmark(backend, checks=10000):
+    """Microseconds per check for a backend, cycling over 100 keys"""
+    start = time.perf_counter()
+    for i in range(checks):
+        backend.take(f'bench:{i % 100}', 1000.0, 1000)
+    return (time.perf_counter() - start) / checks * 1e6
@@ -0,0 +1,154 @@
+"""Inverted index for searching approved reports.
+
+Report names, locations, last-seen text and approved info updates are split
+into accent- and case-folded tokens. Each token maps to the reports containing
+it, and a sorted vocabulary lets every query term match as a prefix, so a
+search box can query on each keystroke. The index follows store.reports and
+store.approved_info through Collection.watch(), so it never needs a rebuild.
+"""
+import bisect
+import heapq
+import re
+import threading
+import unicodedata
+
+TOKEN_RE = re.compile(r'\w+')
+
+# field -> weight added to a report's score for each matching token
+FIELD_WEIGHTS = {
+    'name': 3.0,
+    'location': 2.0,
+    'lastSeen': 1.0,
+    'info': 1.0,
+}
+
+# a prefix match scores this fraction of an exact token match
+PREFIX_FACTOR = 0.5
+
+
+def normalize(text):
+    """Lowercase text and strip diacritics ('José' -> 'jose')"""
+    decomposed = unicodedata.normalize('NFKD', str(text))
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+def tokenize(text):
+    if not text:
+        return []
+    return TOKEN_RE.findall(normalize(text))
+
+
+class SearchIndex:
+    """Token -> document postings with prefix lookup and weighted scoring"""
+
+    def __init__(self):
+        self.postings = {}   # token -> {doc_id: weight}
+        self.fields = {}     # (doc_id, field key) -> {token: weight}
+        self.vocab = []      # sorted tokens, for prefix expansion
+        self.lock = threading.Lock()
+
+    def set(self, doc_id, key, text, weight):
+        """(Re)index one field of a document"""
+        tokens = {}
+        for token in tokenize(text):
+            tokens[token] = tokens.get(token, 0) + weight
+        with self.lock:
+            self._remove(doc_id, key)
+            if not tokens:
+                return
+            self.fields[(doc_id, key)] = tokens
+            for token, w in tokens.items():
+                docs = self.postings.get(token)
+                if docs is None:
+                    docs = self.postings[token] = {}
+                    bisect.insort(self.vocab, token)
+                docs[doc_id] = docs.get(doc_id, 0) + w
+
+    def remove(self, doc_id, key):
+        with self.lock:
+            self._remove(doc_id, key)
+
+    def _remove(self, doc_id, key):
+        tokens = self.fields.pop((doc_id, key), None)
+        if not tokens:
+            return
+        for token, w in tokens.items():
+            docs = self.postings[token]
+            remaining = docs.get(doc_id, 0) - w
+            if remaining > 0:
+                docs[doc_id] = remaining
+            else:
+                docs.pop(doc_id, None)
+            if not docs:
+                del self.postings[token]
+                i = bisect.bisect_left(self.vocab, token)
+                del self.vocab[i]
+
+    def _expand(self, term):
+        i = bisect.bisect_left(self.vocab, term)
+        while i < len(self.vocab) and self.vocab[i].startswith(term):
+            yield self.vocab[i]
+            i += 1
+
+    def search(self, query, limit=None):
+        """Return doc ids matching every query term, best match first.
+
+        With limit only the best limit ids are ranked, not every match.
+        Returns None when the query has no searchable terms.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return None
+        scores = None
+        with self.lock:
+            for term in terms:
+                term_scores = {}
+                for token in self._expand(term):
+                    factor = 1.0 if token == term else PREFIX_FACTOR
+                    for doc_id, w in self.postings[token].items():
+                        score = w * factor
+                        if score > term_scores.get(doc_id, 0):
+                            term_scores[doc_id] = score
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {d: s + term_scores[d] for d, s in scores.items() if d in term_scores}
+                if not scores:
+                    return []
+        if limit is not None:
+            return heapq.nlargest(limit, scores, key=scores.get)
+        return sorted(scores, key=scores.get, reverse=True)
+
+
+class ReportSearch:
+    """SearchIndex kept in step with approved reports and their info updates"""
+
+    def __init__(self, store):
+        self.store = store
+        self.index = SearchIndex()
+        store.reports.watch(self._report_changed)
+        store.approved_info.watch(self._info_changed)
+
+    def _report_changed(self, old, new):
+        if new is None:
+            for field in ('name', 'location', 'lastSeen'):
+                self.index.remove(old['id'], field)
+            return
+        for field in ('name', 'location', 'lastSeen'):
+            if old is None or old.get(field) != new.get(field):
+                self.index.set(new['id'], field, new.get(field), FIELD_WEIGHTS[field])
+
+    def _info_changed(self, old, new):
+        if old is not None:
+            self.index.remove(old.get('report_id'), ('info', old['id']))
+        if new is not None:
+            self.index.set(new.get('report_id'), ('info', new['id']), new.get('info'), FIELD_WEIGHTS['info'])
+
+    def search(self, query, limit=None):
+        """Approved reports matching query, best first (the best limit of
+        them with a limit); None if query is blank"""
+        ids = self.index.search(query, limit)
+        if ids is None:
+            return None
+        reports = (self.store.reports.get(i) for i in ids)
+        return [r for r in reports if r is not None]
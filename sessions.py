@@ -0,0 +1,105 @@
+"""Server-side sessions shared by all worker processes on a host.
+
+Flask's default session is the whole session dict, signed with secret_key and
+sent back and forth in a cookie. Here the cookie carries only a random session
+id; the data lives in a SQLite table (data/sessions.sqlite3), so every worker
+sees the same sessions, a session can be ended on the server, and nothing
+depends on the secret key staying the same across workers and restarts.
+
+Sessions expire PERMANENT_SESSION_LIFETIME after their last write. Expired
+rows are removed by the occasional save (about one in PURGE_EVERY).
+
+A session whose identity (the IDENTITY_KEY value, i.e. who is logged in)
+changes is saved under a new id and its old row deleted. An id someone
+planted in a victim's browser before login (session fixation) is then
+worthless once the victim logs in.
+"""
+import json
+import os
+import random
+import secrets
+import sqlite3
+import threading
+import time
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+PURGE_EVERY = 100
+# session key naming the logged-in user; the id is replaced when it changes
+IDENTITY_KEY = 'user_id'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_expiry ON sessions (expires_at);
+"""
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        # Who the session belonged to when it was opened
+        self.identity = self.get(IDENTITY_KEY)
+
+
+class SqliteSessionInterface(SessionInterface):
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+
+    def connect(self):
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            row = self.connect().execute('SELECT data FROM sessions WHERE id = ? AND expires_at > ?',
+                                         (sid, time.time())).fetchone()
+            if row is not None:
+                return ServerSession(json.loads(row[0]), sid=sid)
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        db = self.connect()
+        if not session:
+            if session.modified and not session.new:
+                db.execute('DELETE FROM sessions WHERE id = ?', (session.sid,))
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not self.should_set_cookie(app, session):
+            return
+        if session.get(IDENTITY_KEY) != session.identity and not session.new:
+            # Logged in (or switched user): never keep a pre-login id
+            db.execute('DELETE FROM sessions WHERE id = ?', (session.sid,))
+            session.sid = secrets.token_urlsafe(32)
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        db.execute('INSERT INTO sessions (id, data, expires_at) VALUES (?, ?, ?) '
+                   'ON CONFLICT (id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at',
+                   (session.sid, json.dumps(dict(session)), time.time() + lifetime))
+        if random.randrange(PURGE_EVERY) == 0:
+            db.execute('DELETE FROM sessions WHERE expires_at <= ?', (time.time(),))
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
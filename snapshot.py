@@ -0,0 +1,196 @@
+"""Binary snapshot of the store, read through mmap.
+
+The JSON snapshot files have to be read and parsed whole before a worker can
+serve anything. A binary snapshot (data/store.<generation>.snap, one per
+compaction, see storage.py) holds every collection in one file laid out so a
+reader can mmap it and decode single records in place:
+
+    header     MAGIC, format version, collection count
+    directory  per collection: name, record count, version, modified time
+               and the offsets of its tables
+    records    per collection, one fixed 24-byte entry per record in
+               insertion order: id (int64), offset (uint64), length (uint32)
+    order      per collection, uint32 positions of the records sorted by id,
+               for binary-search lookups
+    blobs      per collection, its records as one compact UTF-8 JSON array;
+               the offsets above point at single records inside it
+
+All integers are little-endian and each table is 8-byte aligned, so the
+tables are read as memoryview casts without copying. Opening a snapshot
+touches only the header and directory. A single record is decoded when it is
+asked for, and a whole collection with one json.loads over its array, which
+is as fast as parsing the JSON files; the pages behind the file are shared by
+every process that maps it.
+"""
+import bisect
+import json
+import mmap
+import os
+import struct
+
+MAGIC = b'MPRSNAP\x00'
+FORMAT_VERSION = 2
+
+HEADER = struct.Struct('<8sII')
+# name, count, version, modified, records offset, order offset, blobs offset, blobs length
+DIRECTORY_ENTRY = struct.Struct('<32sQQdQQQQ')
+RECORD = struct.Struct('<qQI4x')
+
+
+class SnapshotError(ValueError):
+    """Not a snapshot, or one written by an incompatible version"""
+
+
+def align(n):
+    return (n + 7) & ~7
+
+
+def encode(record):
+    return json.dumps(record, separators=(',', ':')).encode('utf-8')
+
+
+def snapshot_file(generation):
+    """File name of the snapshot a compaction to generation publishes"""
+    return f'store.{generation}.snap'
+
+
+def write_snapshot(path, collections):
+    """Write {name: (records, version, modified)} to path atomically; records
+    is any iterable of record dicts"""
+    encoded = {}
+    for name, (records, version, modified) in collections.items():
+        encoded[name] = ([(r['id'], encode(r)) for r in records], version, modified)
+
+    offset = align(HEADER.size + DIRECTORY_ENTRY.size * len(encoded))
+    layout = {}
+    for name, (items, _, _) in encoded.items():
+        records_at = offset
+        order_at = align(records_at + RECORD.size * len(items))
+        offset = align(order_at + 4 * len(items))
+        layout[name] = (records_at, order_at)
+    blobs_at = offset
+    directory, blobs = [], {}
+    for name, (items, version, modified) in encoded.items():
+        # '[' + records joined by ',' + ']' so the region parses as one array
+        blobs_len = 2 + sum(len(data) for _, data in items) + max(len(items) - 1, 0)
+        blobs[name] = (blobs_at, blobs_len)
+        directory.append(DIRECTORY_ENTRY.pack(name.encode(), len(items), version,
+                                              modified if modified is not None else float('nan'),
+                                              *layout[name], blobs_at, blobs_len))
+        blobs_at += blobs_len
+
+    tmp_path = f'{path}.tmp.{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(encoded)))
+        f.write(b''.join(directory))
+        for name, (items, _, _) in encoded.items():
+            records_at, order_at = layout[name]
+            at = blobs[name][0] + 1
+            entries = []
+            for record_id, data in items:
+                entries.append(RECORD.pack(record_id, at, len(data)))
+                at += len(data) + 1
+            f.seek(records_at)
+            f.write(b''.join(entries))
+            f.seek(order_at)
+            order = sorted(range(len(items)), key=lambda i: items[i][0])
+            f.write(struct.pack(f'<{len(order)}I', *order))
+        f.seek(offset)
+        for items, _, _ in encoded.values():
+            f.write(b'[' + b','.join(data for _, data in items) + b']')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class SnapshotCollection:
+    """One collection of a mapped snapshot; records decode on access"""
+
+    def __init__(self, buf, name, count, version, modified, records_at, order_at, blobs_at, blobs_len):
+        self.buf = buf
+        self.name = name
+        self.count = count
+        self.version = version
+        self.modified = modified
+        self.entries = buf[records_at:records_at + RECORD.size * count]
+        self.order = buf[order_at:order_at + 4 * count].cast('I')
+        self.blobs = buf[blobs_at:blobs_at + blobs_len]
+        # Every 24-byte entry starts with its id, so a 'q' view with stride 3 reads the ids
+        self.ids_view = self.entries.cast('q')[::3] if count else []
+
+    def __len__(self):
+        return self.count
+
+    def id_at(self, position):
+        return self.ids_view[position]
+
+    def raw(self, position):
+        """Encoded bytes of the record at a position (a view into the map)"""
+        _, offset, length = RECORD.unpack_from(self.entries, position * RECORD.size)
+        return self.buf[offset:offset + length]
+
+    def decode(self, position):
+        return json.loads(bytes(self.raw(position)))
+
+    def position(self, record_id):
+        """Position of a record id, or None"""
+        keys = _SortedIds(self)
+        i = bisect.bisect_left(keys, record_id)
+        if i < self.count and keys[i] == record_id:
+            return self.order[i]
+        return None
+
+    def get(self, record_id):
+        position = self.position(record_id)
+        return None if position is None else self.decode(position)
+
+    def ids(self):
+        return iter(self.ids_view)
+
+    def all(self):
+        """Every record decoded, in insertion order"""
+        return json.loads(bytes(self.blobs))
+
+    def __iter__(self):
+        return iter(self.all())
+
+
+class _SortedIds:
+    """Ids in sorted order, as a sequence bisect can search"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __len__(self):
+        return self.collection.count
+
+    def __getitem__(self, i):
+        return self.collection.ids_view[self.collection.order[i]]
+
+
+class Snapshot:
+    """A snapshot file mapped read-only"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self.map)
+        magic, version, count = HEADER.unpack_from(buf)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise SnapshotError(f'{path} is not a version {FORMAT_VERSION} snapshot')
+        self.collections = {}
+        for i in range(count):
+            name, n, coll_version, modified, *offsets = DIRECTORY_ENTRY.unpack_from(
+                buf, HEADER.size + i * DIRECTORY_ENTRY.size)
+            name = name.rstrip(b'\0').decode()
+            modified = None if modified != modified else modified
+            self.collections[name] = SnapshotCollection(buf, name, n, coll_version, modified, *offsets)
+
+    def __getitem__(self, name):
+        return self.collections[name]
+
+    def __contains__(self, name):
+        return name in self.collections
+
@@ -0,0 +1,271 @@
+"""SQLite persistence for the record store.
+
+SqliteStore keeps the same in-memory collections as Store, so reads and the
+indexes built on Collection.watch() work unchanged, but persists them to
+tables in one SQLite database (WAL mode) instead of JSON snapshots plus a log:
+
+    users, reports, pending_reports, pending_info, approved_info
+        id and the record as JSON
+    changes
+        every write in order (the counterpart of store.log), which other
+        worker processes tail to stay current
+    versions
+        each collection's version number and modification time
+
+A write is one parameterized UPSERT or DELETE on the collection's table plus
+an INSERT into changes, committed together, so a crash never leaves a table
+and the change feed disagreeing. BEGIN IMMEDIATE takes the place of the
+store.lock flock. Workers notice each other's commits through PRAGMA
+data_version, so an idle refresh() costs no query against the tables.
+Compaction just trims old rows from changes; a worker that had not caught up
+with them reloads the tables.
+
+Every read is served from memory, so the tables hold nothing but the
+records: no column or index is kept up to date that no query reads. They
+are still fine to query directly for reporting (sqlite3
+data/registry.sqlite3, with json_extract(data, '$.name') and the like);
+import_json() fills them from the data/*.json files.
+"""
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from storage import COLLECTIONS, COMPACT_EVERY, Store
+
+DB_FILE = 'registry.sqlite3'
+
+CHANGES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    collection TEXT NOT NULL,
+    op TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    modified REAL,
+    record TEXT
+);
+CREATE TABLE IF NOT EXISTS versions (
+    collection TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    modified REAL
+);
+"""
+
+
+def table_sql(name):
+    return f'CREATE TABLE IF NOT EXISTS {name} (\n    id INTEGER PRIMARY KEY,\n    data TEXT NOT NULL\n);'
+
+
+def schema():
+    return '\n'.join([CHANGES_SCHEMA] + [table_sql(name) for name in COLLECTIONS])
+
+
+def drop_field_columns(db):
+    """Rebuild tables made by the first schema, which also copied some fields
+    into indexed columns, as (id, data)"""
+    for name in COLLECTIONS:
+        if [row[1] for row in db.execute(f'PRAGMA table_info({name})')] == ['id', 'data']:
+            continue
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # Another process may have rebuilt it while we waited for the lock
+            if [row[1] for row in db.execute(f'PRAGMA table_info({name})')] != ['id', 'data']:
+                db.execute(table_sql(f'{name}_rebuilt'))
+                db.execute(f'INSERT INTO {name}_rebuilt (id, data) SELECT id, data FROM {name}')
+                db.execute(f'DROP TABLE {name}')
+                db.execute(f'ALTER TABLE {name}_rebuilt RENAME TO {name}')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+
+class SqliteStore(Store):
+    """Store whose collections persist to SQLite tables"""
+
+    def __init__(self, path, compact_every=COMPACT_EVERY, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self.conn = None
+        self.conn_pid = None
+        self.last_seq = 0
+        self.data_version = None
+        # Statements are built once; sqlite3 keeps them prepared in its cache
+        self.upserts = {name: f'INSERT INTO {name} (id, data) VALUES (?, ?) '
+                             f'ON CONFLICT (id) DO UPDATE SET data = excluded.data' for name in COLLECTIONS}
+        self.deletes = {name: f'DELETE FROM {name} WHERE id = ?' for name in COLLECTIONS}
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connect().executescript(schema())
+        drop_field_columns(self.connect())
+        super().__init__(os.path.dirname(path) or '.', compact_every, fsync)
+
+    def connect(self):
+        # One connection per process (every use is under self.lock), so that
+        # PRAGMA data_version only moves for other processes' commits
+        if self.conn is None or self.conn_pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False,
+                                 cached_statements=256)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=FULL' if self.fsync else 'PRAGMA synchronous=NORMAL')
+            self.conn, self.conn_pid = db, os.getpid()
+        return self.conn
+
+    @property
+    def db(self):
+        return self.connect()
+
+    def file_lock(self, mode):
+        # Store.__init__ loads under the flock; a read transaction does here
+        return self.read_transaction()
+
+    @contextmanager
+    def read_transaction(self):
+        """Consistent view of all tables for the reads inside the block"""
+        self.db.execute('BEGIN')
+        try:
+            yield
+        finally:
+            self.db.execute('COMMIT')
+
+    def _load(self):
+        """Read every table and the collection versions"""
+        db = self.db
+        versions = {row[0]: (row[1], row[2]) for row in db.execute('SELECT collection, version, modified FROM versions')}
+        for name, collection in self.collections.items():
+            started = time.perf_counter()
+            rows = [data for (data,) in db.execute(f'SELECT data FROM {name} ORDER BY rowid')]
+            self._io('read', self.path, sum(map(len, rows)), started)
+            started = time.perf_counter()
+            records = {}
+            for data in rows:
+                record = json.loads(data)
+                records[record['id']] = record
+            self._io('parse', self.path, sum(map(len, rows)), started)
+            version, modified = versions.get(name, (0, None))
+            collection.version = max(collection.version, version)
+            collection.modified = modified
+            collection._replace(records)
+        self.last_seq = db.execute('SELECT coalesce(max(seq), 0) FROM changes').fetchone()[0]
+        self.log_entries = db.execute('SELECT count(*) FROM changes').fetchone()[0]
+        self.data_version = self._data_version()
+
+    def _data_version(self):
+        return self.db.execute('PRAGMA data_version').fetchone()[0]
+
+    def _catch_up(self):
+        db = self.db
+        first = db.execute('SELECT min(seq) FROM changes').fetchone()[0]
+        if first is not None and first > self.last_seq + 1:
+            # Changes we never saw were compacted away
+            self._load()
+            return
+        rows = db.execute('SELECT seq, collection, op, id, version, modified, record FROM changes '
+                          'WHERE seq > ? ORDER BY seq', (self.last_seq,))
+        for seq, name, op, record_id, version, modified, record in rows:
+            entry = {'c': name, 'op': op, 'id': record_id, 'v': version, 't': modified}
+            if record is not None:
+                entry['r'] = json.loads(record)
+            self._apply_entry(entry)
+            self.last_seq = seq
+        self.data_version = self._data_version()
+
+    def refresh(self):
+        """Pick up changes committed by other processes"""
+        with self.lock:
+            if self.depth or self._data_version() == self.data_version:
+                return
+            with self.read_transaction():
+                self._catch_up()
+
+    def _begin(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self._catch_up()
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+
+    def _abort(self):
+        self.pending = []
+        self.db.execute('ROLLBACK')
+
+    def _end(self):
+        db = self.db
+        try:
+            self._append()
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        started = time.perf_counter()
+        db.execute('COMMIT')
+        self._io('sync', self.path, 0, started)
+        self.data_version = self._data_version()
+        if self.log_entries >= self.compact_every:
+            if self.compact_requested is None:
+                self.compact()
+            else:
+                self.compact_requested()
+        # SQLite syncs on COMMIT itself, so there is nothing for _sync() to do
+        return 0
+
+    def _append(self):
+        if not self.pending:
+            return
+        db = self.db
+        entries, self.pending = self.pending, []
+        started = time.perf_counter()
+        written = 0
+        for entry in entries:
+            name, record = entry['c'], entry.get('r')
+            data = json.dumps(record) if record is not None else None
+            if entry['op'] == 'put':
+                db.execute(self.upserts[name], (record['id'], data))
+            else:
+                db.execute(self.deletes[name], (entry['id'],))
+            cur = db.execute('INSERT INTO changes (collection, op, id, version, modified, record) '
+                             'VALUES (?, ?, ?, ?, ?, ?)',
+                             (name, entry['op'], entry['id'], entry['v'], entry['t'], data))
+            self.last_seq = cur.lastrowid
+            written += 2 * len(data) if data else 0
+        for name in {entry['c'] for entry in entries}:
+            collection = self.collections[name]
+            db.execute('INSERT INTO versions (collection, version, modified) VALUES (?, ?, ?) '
+                       'ON CONFLICT (collection) DO UPDATE SET version = excluded.version, '
+                       'modified = excluded.modified', (name, collection.version, collection.modified))
+        self.log_entries += len(entries)
+        self._io('write', self.path, written, started)
+
+    def compact(self):
+        """Drop all but the newest row of the change table"""
+        with self.lock:
+            if self.depth:
+                return
+            db = self.db
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.execute('DELETE FROM changes WHERE seq < (SELECT max(seq) FROM changes)')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+            self.log_entries = 1 if self.last_seq else 0
+            self.data_version = self._data_version()
+
+
+def import_json(store, data_dir):
+    """Copy every record from a JSON data directory into store, replacing
+    whatever it held; returns {collection: record count}"""
+    source = Store(data_dir)
+    counts = {}
+    with store.transaction():
+        for name, collection in source.collections.items():
+            target = store.collections[name]
+            for record_id in [i for i in target.records if i not in collection]:
+                target.delete(record_id)
+            for record in collection:
+                if target.get(record['id']) != record:
+                    target.put(record)
+            counts[name] = len(collection)
+    return counts
@@ -1,6 +1,7 @@
 import React, { useState, useEffect } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { LogOut, CheckCircle, XCircle, AlertCircle, RefreshCw, Eye, EyeOff, Trash2, Plus, Edit2 } from 'lucide-react';
+import { applyChange, subscribe, type FeedChange } from './lib/feed';
 
 interface PendingReport {
   id: number;
@@ -51,6 +52,20 @@ function AdminDashboard() {
     fetchAllData();
   }, [adminUser, navigate]);
 
+  // Apply changes made server-side as they happen instead of polling
+  useEffect(() => {
+    if (!adminUser) return;
+    return subscribe<PendingReport | ApprovedReport | PendingInfo>(['reports', 'pending_reports', 'pending_info'], change => {
+      if (change.collection === 'pending_reports') {
+        setPendingReports(prev => applyChange(prev, change as FeedChange<PendingReport>));
+      } else if (change.collection === 'reports') {
+        setApprovedReports(prev => applyChange(prev, change as FeedChange<ApprovedReport>));
+      } else {
+        setPendingInfo(prev => applyChange(prev, change as FeedChange<PendingInfo>));
+      }
+    }, fetchAllData);
+  }, [adminUser]);
+
   const fetchAllData = async () => {
     setLoading(true);
     try {
@@ -2,6 +2,7 @@ import React, { useState, useEffect } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { LogIn, AlertTriangle, Search, MapPin, Calendar, X, Ruler, UserCircle2, FileText, Send, MessageSquare, AlertCircle } from 'lucide-react';
 import ReportInfoModal from './ReportInfoModal';
+import { applyChange, subscribe } from './lib/feed';
 
 interface MissingPerson {
   id: number;
@@ -70,6 +71,11 @@ function HomePage() {
       }
     };
     fetchReports();
+
+    // Pick up newly approved and edited reports as they happen
+    return subscribe<MissingPerson>(['reports'], change => {
+      setReports(prev => applyChange(prev, change));
+    }, fetchReports);
   }, []);
 
   useEffect(() => {
@@ -0,0 +1,55 @@
+// Live updates from GET /api/events. Every event carries the changed record,
+// so lists are patched in place instead of being fetched again; only a
+// 'reset' (events missed while disconnected) needs a reload.
+
+const FEED_URL = 'http://localhost:5000/api/events';
+const KINDS = ['created', 'updated', 'deleted'];
+// Resets arriving together (e.g. after a network drop) cause one reload
+const RESET_DELAY_MS = 500;
+
+export interface FeedChange<T> {
+  collection: string;
+  id: number;
+  record?: T;
+}
+
+// The list with a created/updated record put in place, or a deleted one removed
+export function applyChange<T extends { id: number }>(list: T[], change: FeedChange<T>): T[] {
+  if (!change.record) {
+    return list.filter(item => item.id !== change.id);
+  }
+  const index = list.findIndex(item => item.id === change.id);
+  if (index === -1) {
+    return [...list, change.record];
+  }
+  const next = list.slice();
+  next[index] = change.record;
+  return next;
+}
+
+// Follow changes to some collections; returns a function that unsubscribes
+export function subscribe<T>(
+  collections: string[],
+  onChange: (change: FeedChange<T>) => void,
+  onReset: () => void
+): () => void {
+  const events = new EventSource(`${FEED_URL}?collections=${collections.join(',')}`);
+  const handle = (event: MessageEvent) => onChange(JSON.parse(event.data));
+  collections
+    .flatMap(collection => KINDS.map(kind => `${collection}.${kind}`))
+    .forEach(name => events.addEventListener(name, handle as EventListener));
+
+  let timer: number | undefined;
+  events.addEventListener('reset', () => {
+    if (timer !== undefined) return;
+    timer = window.setTimeout(() => {
+      timer = undefined;
+      onReset();
+    }, RESET_DELAY_MS);
+  });
+
+  return () => {
+    window.clearTimeout(timer);
+    events.close();
+  };
+}
@@ -0,0 +1,607 @@
+"""In-memory record store for the registry.
+
+Every collection (reports, pending reports, info updates, users) is loaded once
+from its JSON file in data/ and kept in memory as a dict keyed by record id.
+Changes are appended to a single log file (data/store.log) so a write only costs
+the size of the changed record. The log is folded back into the JSON files by
+compact() once it grows past COMPACT_EVERY entries, which keeps the files on
+disk in the same format the app has always used.
+
+Several worker processes can share one data directory. Writers serialize on
+an flock() of data/store.lock and each worker picks up the others' changes by
+tailing the log (refresh()); a compaction replaces the log file, which tells
+the other workers to reload the snapshots. Reads never take the file lock
+unless the log has actually changed.
+
+Each collection also carries a version number and modification time that
+every write bumps. They travel in the log entries and in data/store.meta.json,
+so all workers agree on them; HTTP caching uses them as ETags.
+
+With snapshot_format='binary', compaction writes one mmap-able binary file
+(data/store.<generation>.snap, see snapshot.py) instead of the JSON files,
+which a worker starts from faster. store.meta.json names the binary snapshot
+when it is the current one, so either format loads whichever was written last.
+
+Every compaction starts a new generation: the log it folded in is kept as
+data/store.<generation>.log until the next one. A worker that was current
+with that log finishes reading it and carries on with the new snapshot and
+log as they are, instead of reloading and diffing the whole store.
+
+If archive is set (audit.py), retired logs are handed to it instead of being
+deleted, which keeps every change ever made.
+
+If on_io is set, every read, parse, write and fsync of a data file is
+reported to it as on_io(op, path, nbytes, seconds), for metrics.
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from snapshot import Snapshot, snapshot_file, write_snapshot
+
+DATA_DIR = 'data'
+LOG_FILE = 'store.log'
+LOCK_FILE = 'store.lock'
+META_FILE = 'store.meta.json'
+COMPACT_EVERY = 1000
+SNAPSHOT_FORMATS = ('json', 'binary')
+
+# collection name -> snapshot file inside DATA_DIR
+COLLECTIONS = {
+    'reports': 'reports.json',
+    'pending_reports': 'pending_reports.json',
+    'pending_info': 'pending_info_updates.json',
+    'approved_info': 'approved_info_updates.json',
+    'users': 'users.json',
+}
+
+
+def atomic_write(path, data):
+    """Replace path with data (str or bytes) via a synced temp file and rename"""
+    tmp_path = f'{path}.tmp.{os.getpid()}'
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    with open(tmp_path, mode) as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class Index:
+    """Secondary index: field value -> ids of the records holding it"""
+
+    def __init__(self, field):
+        self.field = field
+        self.ids = {}   # value -> {id: None}, keeping insertion order
+
+    def __call__(self, old, new):
+        field = self.field
+        if old is not None and new is not None and old.get(field) == new.get(field):
+            return
+        if old is not None:
+            ids = self.ids.get(old.get(field))
+            if ids is not None:
+                ids.pop(old['id'], None)
+                if not ids:
+                    del self.ids[old.get(field)]
+        if new is not None:
+            self.ids.setdefault(new.get(field), {})[new['id']] = None
+
+    def get(self, value):
+        return list(self.ids.get(value, ()))
+
+
+class Collection:
+    """One named set of records, indexed by id and any added secondary fields"""
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.records = {}
+        self.listeners = []
+        self.indexes = {}
+        # Bumped by every write, from any process
+        self.version = 0
+        self.modified = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, record_id):
+        return record_id in self.records
+
+    def __iter__(self):
+        return iter(list(self.records.values()))
+
+    def get(self, record_id):
+        return self.records.get(record_id)
+
+    def all(self):
+        return list(self.records.values())
+
+    def watch(self, listener):
+        """Call listener(old, new) for every record change, starting with the
+        records already loaded. old is None for inserts and new is None for
+        deletes. Changes made by other processes are reported as they are
+        picked up."""
+        self.listeners.append(listener)
+        for record in self.records.values():
+            listener(None, record)
+
+    def add_index(self, field):
+        """Maintain a field value -> ids index for find()"""
+        if field not in self.indexes:
+            index = Index(field)
+            self.watch(index)
+            self.indexes[field] = index
+        return self.indexes[field]
+
+    def find(self, field, value):
+        """Records whose field equals value, oldest first"""
+        index = self.indexes.get(field)
+        if index is None:
+            return [r for r in self if r.get(field) == value]
+        records = (self.records.get(i) for i in index.get(value))
+        return [r for r in records if r is not None]
+
+    def put(self, record):
+        """Insert or replace a record (keyed by its 'id')"""
+        self.store.write(self.name, 'put', record['id'], record)
+        return record
+
+    def insert(self, record):
+        """Add a new record, bumping its id past any record already using it"""
+        with self.store.transaction():
+            while record['id'] in self.records:
+                record['id'] += 1
+            return self.put(record)
+
+    def update(self, record_id, changes):
+        """Apply changes to an existing record, returning it or None if missing"""
+        with self.store.transaction():
+            record = self.records.get(record_id)
+            if record is None:
+                return None
+            record = dict(record, **changes)
+            return self.put(record)
+
+    def delete(self, record_id):
+        """Remove a record, returning it or None if missing"""
+        with self.store.transaction():
+            record = self.records.get(record_id)
+            if record is None:
+                return None
+            self.store.write(self.name, 'del', record_id)
+            return record
+
+    def _apply(self, op, record_id, record=None):
+        if op == 'put':
+            old = self.records.get(record_id)
+            self.records[record_id] = record
+        elif op == 'del':
+            old = self.records.pop(record_id, None)
+            if old is None:
+                return
+        else:
+            return
+        self._notify(old, record)
+
+    def _notify(self, old, new):
+        for listener in self.listeners:
+            listener(old, new)
+
+    def _replace(self, records):
+        """Swap in a freshly loaded record dict, notifying only what differs"""
+        old_records, self.records = self.records, records
+        if not self.listeners:
+            return
+        for record_id, old in old_records.items():
+            new = records.get(record_id)
+            if new != old:
+                self._notify(old, new)
+        for record_id, new in records.items():
+            if record_id not in old_records:
+                self._notify(None, new)
+
+
+class Store:
+    """All collections plus the append-only log that persists them"""
+
+    def __init__(self, data_dir=DATA_DIR, compact_every=COMPACT_EVERY, fsync=True, snapshot_format='json'):
+        if snapshot_format not in SNAPSHOT_FORMATS:
+            raise ValueError(f'snapshot_format must be one of {", ".join(SNAPSHOT_FORMATS)}')
+        self.data_dir = data_dir
+        self.compact_every = compact_every
+        self.fsync = fsync
+        # 'json' or 'binary'
+        self.snapshot_format = snapshot_format
+        # Compactions so far, and the binary snapshot file of the current one
+        self.generation = 0
+        self.snapshot_name = None
+        self.log_path = os.path.join(data_dir, LOG_FILE)
+        self.meta_path = os.path.join(data_dir, META_FILE)
+        self.lock = threading.RLock()
+        self.collections = {name: Collection(self, name) for name in COLLECTIONS}
+        self.reports = self.collections['reports']
+        self.pending_reports = self.collections['pending_reports']
+        self.pending_info = self.collections['pending_info']
+        self.approved_info = self.collections['approved_info']
+        self.users = self.collections['users']
+        self.users.add_index('user_id')
+        self.pending_info.add_index('report_id')
+        self.approved_info.add_index('report_id')
+
+        # Position in the shared log up to which this process is current. The
+        # log followed is held open, so its inode cannot be freed and handed
+        # to a later log file, which would pass for it
+        self.log_fd = None
+        self.log_inode = None
+        self.log_offset = 0
+        self.log_entries = 0
+
+        # Transaction state (only touched while holding self.lock)
+        self.depth = 0
+        self.pending = []
+        # (collection, id, prior record, prior version, prior modified) per
+        # queued write, to put memory back if the transaction fails
+        self.undo = []
+
+        # Called instead of compacting inline once the log is long, if set
+        self.compact_requested = None
+
+        # Called as on_io(op, path, nbytes, seconds) for data file I/O, if set
+        self.on_io = None
+
+        # Told of every compaction and given the logs it retires, if set (audit.AuditLog)
+        self.archive = None
+
+        # Group commit: one fsync covers every append made before it started
+        self.sync_lock = threading.Lock()
+        self.synced_offset = 0
+
+        os.makedirs(data_dir, exist_ok=True)
+        self.lock_fd = os.open(os.path.join(data_dir, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        with self.lock, self.file_lock(fcntl.LOCK_SH):
+            self._load()
+
+    def _io(self, op, path, nbytes, started):
+        """Report I/O that began at perf_counter() value started"""
+        if self.on_io is not None:
+            self.on_io(op, path, nbytes, time.perf_counter() - started)
+
+    def snapshot_path(self, name):
+        return os.path.join(self.data_dir, COLLECTIONS[name])
+
+    def retired_log_path(self, generation):
+        return os.path.join(self.data_dir, f'store.{generation}.log')
+
+    @contextmanager
+    def file_lock(self, mode):
+        fcntl.flock(self.lock_fd, mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    def _follow(self):
+        """Start following store.log from its beginning, if it exists"""
+        if self.log_fd is not None:
+            os.close(self.log_fd)
+        self.log_fd, self.log_inode, self.log_offset = None, None, 0
+        try:
+            self.log_fd = os.open(self.log_path, os.O_RDONLY)
+        except FileNotFoundError:
+            return
+        self.log_inode = os.fstat(self.log_fd).st_ino
+
+    def _log_stat(self):
+        try:
+            st = os.stat(self.log_path)
+        except FileNotFoundError:
+            return None, 0
+        return st.st_ino, st.st_size
+
+    def _read_meta(self):
+        if not os.path.exists(self.meta_path):
+            return {}
+        with open(self.meta_path, 'r') as f:
+            return json.load(f)
+
+    def _open_snapshot(self, meta):
+        """Map the binary snapshot meta names, or return None"""
+        name = meta.get('snapshot')
+        path = name and os.path.join(self.data_dir, name)
+        if not path or not os.path.exists(path):
+            return None
+        started = time.perf_counter()
+        snapshot = Snapshot(path)
+        self._io('read', path, len(snapshot.map), started)
+        return snapshot
+
+    def _load(self):
+        """Read the snapshot, then replay the log on top of it"""
+        meta = self._read_meta()
+        self.generation = meta.get('generation', 0)
+        snapshot = self._open_snapshot(meta)
+        self.snapshot_name = meta.get('snapshot') if snapshot is not None else None
+        for name, collection in self.collections.items():
+            records = {}
+            path = self.snapshot_path(name)
+            if snapshot is not None:
+                if name in snapshot:
+                    started = time.perf_counter()
+                    for record in snapshot[name]:
+                        records[record['id']] = record
+                    self._io('parse', snapshot.path, 0, started)
+                path = snapshot.path
+            elif os.path.exists(path):
+                started = time.perf_counter()
+                with open(path, 'rb') as f:
+                    data = f.read()
+                self._io('read', path, len(data), started)
+                started = time.perf_counter()
+                for record in json.loads(data):
+                    records[record['id']] = record
+                self._io('parse', path, len(data), started)
+            version, modified = meta.get(name, (0, None))
+            if modified is None and os.path.exists(path):
+                modified = os.path.getmtime(path)
+            # Versions first, so listeners see the ones their changes belong to
+            collection.version = max(collection.version, version)
+            collection.modified = modified
+            collection._replace(records)
+        self._follow()
+        self.log_entries = 0
+        self.synced_offset = 0
+        self._tail()
+
+    def _next_generation(self):
+        """Follow another process's compaction without reloading, if this
+        process was reading the log it retired; returns whether it could"""
+        if self.log_fd is None:
+            return False
+        meta = self._read_meta()
+        retired = self.retired_log_path(self.generation)
+        if meta.get('generation') != self.generation + 1 or not os.path.exists(retired):
+            return False
+        if os.stat(retired).st_ino != self.log_inode:
+            return False
+        # After the rest of the retired log we hold exactly what the new
+        # snapshot does, so the records stay as they are
+        self._tail()
+        self.generation += 1
+        self.snapshot_name = meta.get('snapshot')
+        self._follow()
+        self.log_entries = 0
+        self.synced_offset = 0
+        self._tail()
+        return True
+
+    def _tail(self):
+        """Apply entries appended to the log followed since log_offset"""
+        if self.log_fd is None:
+            self._follow()
+            if self.log_fd is None:
+                return
+        path = self.log_path
+        started = time.perf_counter()
+        # pread, since forked workers share the descriptor's file position
+        size = os.fstat(self.log_fd).st_size
+        data = os.pread(self.log_fd, max(size - self.log_offset, 0), self.log_offset)
+        self._io('read', path, len(data), started)
+        # Only whole lines; a torn tail left by a crashed writer is skipped
+        end = data.rfind(b'\n') + 1
+        parsing = 0
+        for line in data[:end].splitlines():
+            started = time.perf_counter()
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            finally:
+                parsing += time.perf_counter() - started
+            self._apply_entry(entry)
+        if end and self.on_io is not None:
+            self.on_io('parse', path, end, parsing)
+        self.log_offset += end
+        self.synced_offset = max(self.synced_offset, self.log_offset)
+
+    def _apply_entry(self, entry):
+        """Apply a change another process made"""
+        collection = self.collections[entry['c']]
+        # Versions first, so listeners see the ones their changes belong to
+        collection.version = max(collection.version, entry.get('v', collection.version + 1))
+        collection.modified = entry.get('t', collection.modified)
+        collection._apply(entry['op'], entry['id'], entry.get('r'))
+        self.log_entries += 1
+
+    def _catch_up(self):
+        inode, size = self._log_stat()
+        if inode != self.log_inode and not self._next_generation():
+            self._load()
+        elif size > self.log_offset:
+            self._tail()
+
+    def refresh(self):
+        """Pick up changes written by other processes"""
+        inode, size = self._log_stat()
+        if inode == self.log_inode and size == self.log_offset:
+            return
+        with self.lock:
+            if self.depth:
+                return
+            with self.file_lock(fcntl.LOCK_SH):
+                self._catch_up()
+
+    @contextmanager
+    def transaction(self):
+        """Group writes into one locked, atomically appended log batch.
+
+        Reads made inside the block see every committed write from every
+        process, so read-modify-write sequences cannot lose updates. If the
+        block raises, its writes are undone in memory and never logged; a
+        nested block that raises undoes only its own.
+        """
+        with self.lock:
+            mark = len(self.undo)
+            if self.depth:
+                self.depth += 1
+                try:
+                    yield self
+                except BaseException:
+                    self._undo(mark)
+                    raise
+                finally:
+                    self.depth -= 1
+                return
+            self._begin()
+            self.depth = 1
+            try:
+                yield self
+            except BaseException:
+                self.depth = 0
+                try:
+                    self._undo(0)
+                finally:
+                    self._abort()
+                raise
+            self.depth = 0
+            self.undo = []
+            end = self._end()
+        if end:
+            self._sync(end)
+
+    def _undo(self, mark):
+        """Drop the writes queued since mark, restoring what they replaced"""
+        while len(self.undo) > mark:
+            collection, record_id, record, version, modified = self.undo.pop()
+            collection._apply('del' if record is None else 'put', record_id, record)
+            collection.version, collection.modified = version, modified
+        del self.pending[mark:]
+
+    def _begin(self):
+        """Lock out other writers and catch up with what they wrote"""
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        try:
+            self._catch_up()
+        except BaseException:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+            raise
+
+    def _abort(self):
+        """Let other writers in without persisting anything"""
+        self.pending = []
+        fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    def _end(self):
+        """Persist the queued changes and let other writers in"""
+        try:
+            return self._append()
+        finally:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    def write(self, name, op, record_id, record=None):
+        """Apply one change in memory and queue it for the log"""
+        with self.transaction():
+            collection = self.collections[name]
+            self.undo.append((collection, record_id, collection.records.get(record_id),
+                              collection.version, collection.modified))
+            collection.version += 1
+            collection.modified = time.time()
+            entry = {'c': name, 'op': op, 'id': record_id, 'v': collection.version, 't': collection.modified}
+            if record is not None:
+                entry['r'] = record
+            self.pending.append(entry)
+            collection._apply(op, record_id, record)
+
+    def _append(self):
+        """Write the queued entries in one append; returns the new log end"""
+        if not self.pending:
+            return 0
+        data = ''.join(json.dumps(entry) + '\n' for entry in self.pending).encode('utf-8')
+        count = len(self.pending)
+        self.pending = []
+        started = time.perf_counter()
+        with open(self.log_path, 'ab') as f:
+            if self.log_fd is None:
+                # There was no log to follow until this append created it
+                self._follow()
+            if f.tell() and f.tell() != self.log_offset:
+                # Someone left a torn line behind; terminate it so ours parses
+                data = b'\n' + data
+            f.write(data)
+            f.flush()
+            self.log_offset = f.tell()
+        self._io('write', self.log_path, len(data), started)
+        self.log_entries += count
+        if self.log_entries >= self.compact_every:
+            if self.compact_requested is None:
+                self._compact()
+                return 0
+            self.compact_requested()
+        return self.log_offset
+
+    def _sync(self, end):
+        if not self.fsync:
+            return
+        with self.sync_lock:
+            if self.synced_offset >= end:
+                return
+            inode, size = self._log_stat()
+            started = time.perf_counter()
+            with open(self.log_path, 'rb') as f:
+                os.fsync(f.fileno())
+            self._io('sync', self.log_path, 0, started)
+            self.synced_offset = size if inode == self.log_inode else end
+
+    def compact(self):
+        """Rewrite the JSON snapshot files and start a fresh log"""
+        with self.lock, self.file_lock(fcntl.LOCK_EX):
+            self._catch_up()
+            self._compact()
+
+    def _compact(self):
+        generation = self.generation + 1
+        meta = {name: [c.version, c.modified] for name, c in self.collections.items()}
+        meta['generation'] = generation
+        snapshot_name = None
+        if self.snapshot_format == 'binary':
+            snapshot_name = snapshot_file(generation)
+            path = os.path.join(self.data_dir, snapshot_name)
+            started = time.perf_counter()
+            write_snapshot(path, {name: (c.all(), c.version, c.modified) for name, c in self.collections.items()})
+            self._io('write', path, os.path.getsize(path), started)
+            meta['snapshot'] = snapshot_name
+        else:
+            for name, collection in self.collections.items():
+                data = json.dumps(collection.all()).encode('utf-8')
+                started = time.perf_counter()
+                atomic_write(self.snapshot_path(name), data)
+                self._io('write', self.snapshot_path(name), len(data), started)
+        atomic_write(self.meta_path, json.dumps(meta))
+        # Other workers finish reading the log we folded in from its retired
+        # name; replacing it gives store.log a new inode, which they notice
+        if os.path.exists(self.log_path):
+            os.replace(self.log_path, self.retired_log_path(self.generation))
+        atomic_write(self.log_path, b'')
+        stale = []
+        if self.archive is not None:
+            # It keeps the log retired last time, instead of it being deleted
+            self.archive.compacted(generation, snapshot_name and os.path.join(self.data_dir, snapshot_name))
+        else:
+            stale.append(self.retired_log_path(self.generation - 1))
+        if self.snapshot_name:
+            stale.append(os.path.join(self.data_dir, self.snapshot_name))
+        for path in stale:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.generation = generation
+        self.snapshot_name = snapshot_name
+        self._follow()
+        self.log_entries = 0
+        self.synced_offset = 0
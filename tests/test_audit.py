@@ -0,0 +1,41 @@
+import glob
+import os
+import time
+
+import pytest
+
+from audit import AuditError, AuditLog
+from storage import Store
+
+
+@pytest.mark.parametrize('snapshot_format', ['json', 'binary'])
+def test_history_and_as_of_across_compactions(tmp_path, snapshot_format):
+    data_dir = str(tmp_path)
+    store = Store(data_dir, compact_every=5, fsync=False, snapshot_format=snapshot_format)
+    audit = AuditLog(store, checkpoint_every=2)
+    states = []     # (time after a write, the reports as they were then)
+    changes = []    # what happened to record 0, in order
+    for step in range(40):
+        record_id = step % 6
+        if step % 5 == 4 and record_id in store.reports.records:
+            store.reports.delete(record_id)
+            change = ('del', None)
+        else:
+            store.reports.put({'id': record_id, 'step': step})
+            change = ('put', step)
+        if record_id == 0:
+            changes.append(change)
+        states.append((time.time(), {r['id']: r for r in store.reports}))
+        time.sleep(0.002)
+
+    # Eight compactions: archived segments and several checkpoints to cross
+    assert len(glob.glob(os.path.join(audit.dir, 'segment.*.log'))) >= 5
+    assert len(audit.checkpoints()) >= 4
+
+    for log in (audit, AuditLog(Store(data_dir, fsync=False, snapshot_format=snapshot_format))):
+        history = log.history(['reports'], 0)
+        assert [(e['op'], e['r']['step'] if e['op'] == 'put' else None) for e in history] == changes
+        for t, expected in states:
+            assert {r['id']: r for r in log.as_of('reports', t)} == expected
+        with pytest.raises(AuditError):
+            log.as_of('reports', log.checkpoints()[0][1] - 1)
@@ -0,0 +1,52 @@
+from flask import Flask, jsonify
+
+from httpcache import ResponseCache
+from storage import Store
+
+
+def make_app(store):
+    cache = ResponseCache(store)
+    app = Flask(__name__)
+    calls = []
+
+    @app.route('/reports')
+    @cache.cached('reports')
+    def reports():
+        calls.append(1)
+        return jsonify(store.reports.all())
+
+    return app, calls
+
+
+def test_conditional_get_answers_304_until_a_write(tmp_path):
+    store = Store(str(tmp_path), fsync=False)
+    store.reports.put({'id': 1, 'name': 'Asha'})
+    app, calls = make_app(store)
+    client = app.test_client()
+
+    first = client.get('/reports')
+    etag = first.headers['ETag']
+    assert first.status_code == 200 and first.headers['Cache-Control'] == 'no-cache'
+    assert first.headers['Last-Modified']
+
+    again = client.get('/reports', headers={'If-None-Match': etag})
+    assert again.status_code == 304 and again.data == b''
+    assert again.headers['ETag'] == etag
+    # The body is kept, so neither request after the first ran the view
+    assert client.get('/reports').data == first.data
+    assert len(calls) == 1
+
+    store.reports.put({'id': 2, 'name': 'Ravi'})
+    changed = client.get('/reports', headers={'If-None-Match': etag})
+    assert changed.status_code == 200 and changed.headers['ETag'] != etag
+    assert [r['id'] for r in changed.get_json()] == [1, 2]
+    assert len(calls) == 2
+
+
+def test_etag_depends_on_query_string(tmp_path):
+    store = Store(str(tmp_path), fsync=False)
+    app, calls = make_app(store)
+    client = app.test_client()
+    etag = client.get('/reports?limit=1').headers['ETag']
+    assert client.get('/reports?limit=2', headers={'If-None-Match': etag}).status_code == 200
+    assert client.get('/reports?limit=1', headers={'If-None-Match': etag}).status_code == 304
@@ -0,0 +1,53 @@
+import sqlite3
+import time
+
+import jobs
+from jobs import JobQueue
+
+
+def test_failed_job_backs_off_then_gives_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, 'RETRY_DELAY', 0.05)
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'))
+    calls = []
+
+    @queue.handler('flaky')
+    def flaky(payload):
+        calls.append(time.time())
+        raise RuntimeError('down')
+
+    job_id = queue.connect().execute(
+        "INSERT INTO jobs (kind, payload, created_at, updated_at) VALUES ('flaky', '{}', 0, 0)").lastrowid
+    assert queue.run_one()
+    job = queue.get(job_id)
+    assert job['status'] == 'queued' and job['retry_at'] > time.time()
+    # Not claimable until its retry time
+    assert not queue.run_one()
+    assert queue.counts() == {('flaky', 'queued'): 1}
+
+    while queue.get(job_id)['status'] == 'queued':
+        queue.run_one()
+        time.sleep(0.01)
+    job = queue.get(job_id)
+    assert job['status'] == 'failed' and job['attempts'] == jobs.MAX_ATTEMPTS == len(calls)
+    assert job['error'] == 'down' and job['retry_at'] is None
+    gaps = [b - a for a, b in zip(calls, calls[1:])]
+    assert all(gap >= 0.05 * 2 ** i for i, gap in enumerate(gaps))
+    assert queue.counts() == {('flaky', 'failed'): 1}
+
+
+def test_schema_gains_retry_column(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite3')
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, "
+               "payload TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'queued', result TEXT, error TEXT, "
+               "attempts INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL, updated_at REAL NOT NULL, "
+               "lease_until REAL)")
+    db.execute("INSERT INTO jobs (kind, payload, created_at, updated_at) VALUES ('old', '{}', 0, 0)")
+    db.commit()
+    db.close()
+
+    queue = JobQueue(path)
+    done = []
+    queue.handler('old')(lambda payload: done.append(payload) or 'ok')
+    assert queue.run_one()
+    assert done == [{}] and queue.get(1)['status'] == 'done'
@@ -0,0 +1,84 @@
+import base64
+import json
+
+import pytest
+from flask import Flask, jsonify
+
+from listing import ListingError, decode_cursor, encode_cursor, list_response
+
+RECORDS = [{'id': i, 'name': name, 'age': i * 10}
+           for i, name in enumerate(['Asha', 'Ravi', 'asha', 'Meena', 'Ravi', 'Zoya', 'Asha'], 1)]
+
+
+def make_app():
+    app = Flask(__name__)
+
+    @app.route('/reports')
+    def reports():
+        # As the app's list endpoints
+        try:
+            return list_response(iter(RECORDS))
+        except ListingError as e:
+            return jsonify({'error': str(e)}), 400
+
+    return app
+
+
+def walk(client, query):
+    """Records of every page, following X-Next-Cursor"""
+    records = []
+    url = f'/reports?{query}'
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        records.extend(response.get_json())
+        cursor = response.headers.get('X-Next-Cursor')
+        assert (cursor is None) == ('Link' not in response.headers)
+        url = cursor and f'/reports?limit=2&fields=name&cursor={cursor}'
+    return records
+
+
+@pytest.mark.parametrize('sort', ['id', '-id', 'name', '-name'])
+def test_cursor_pages_cover_every_record_once(sort):
+    client = make_app().test_client()
+    records = walk(client, f'limit=2&fields=name&sort={sort}')
+    name = sort.lstrip('-')
+    expected = sorted(RECORDS, key=lambda r: (r[name], r['id']), reverse=sort.startswith('-'))
+    # Ties on name still page by id, and fields= keeps only name and id
+    assert records == [{'id': r['id'], 'name': r['name']} for r in expected]
+
+
+def test_no_paging_params_return_everything():
+    response = make_app().test_client().get('/reports')
+    assert response.get_json() == RECORDS
+    assert 'X-Next-Cursor' not in response.headers
+
+
+def test_cursor_round_trip():
+    for state in ({'offset': 40}, {'sort': '-name', 'after': ['Ravi', 5]}, {'sort': 'id', 'after': [3, 3]}):
+        assert decode_cursor(encode_cursor(state)) == state
+
+
+def forge(state):
+    return base64.urlsafe_b64encode(json.dumps(state).encode()).decode().rstrip('=')
+
+
+@pytest.mark.parametrize('cursor', [
+    'not a cursor!',
+    forge([1, 2]),
+    forge({'offset': -1}),
+    forge({'offset': '5'}),
+    forge({'offset': True}),
+    forge({'offset': 1, 'sort': 'id'}),
+    forge({'sort': 'password', 'after': ['', 1]}),
+    forge({'sort': 'name', 'after': [0, 1]}),
+    forge({'sort': 'id', 'after': [1]}),
+    forge({'sort': 'id', 'after': [1, 'x']}),
+    forge({'sort': 'id', 'after': {'0': 1}}),
+])
+def test_tampered_cursor_is_rejected(cursor):
+    with pytest.raises(ListingError):
+        decode_cursor(cursor)
+    response = make_app().test_client().get(f'/reports?cursor={cursor}')
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'Invalid cursor'}
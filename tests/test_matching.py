@@ -0,0 +1,42 @@
+import random
+
+from matching import NameMatcher, find_duplicates, trigrams
+
+
+class Records:
+    """Just enough of a store collection for a NameMatcher"""
+
+    def __init__(self, names):
+        self.records = {i: {'id': i, 'name': name} for i, name in enumerate(names)}
+
+    def watch(self, listener):
+        for record in self.records.values():
+            listener(None, record)
+
+    def get(self, record_id):
+        return self.records.get(record_id)
+
+
+def test_pruned_scores_match_brute_force():
+    rng = random.Random(5)
+    words = ['Aarav', 'Arjun', 'Priya', 'Priyanka', 'Sharma', 'Verma', 'Nair', 'Iyer', 'Khan', 'Kumar']
+    names = [' '.join(rng.sample(words, rng.randint(1, 3))) for _ in range(500)]
+    matcher = NameMatcher(Records(names))
+    for query in names[:50]:
+        grams = trigrams(query)
+        for threshold in (0.35, 0.6):
+            expected = {}
+            for name, other in matcher.grams.items():
+                score = 2 * len(grams & other) / (len(grams) + len(other))
+                if score >= threshold:
+                    expected[name] = score
+            assert matcher._trigram_scores(grams, threshold) == expected
+
+
+def test_phonetic_match_per_word():
+    records = Records(['John Smith', 'Mohammed Khan', 'Mary Jones'])
+    matcher = NameMatcher(records)
+    assert [records.get(r)['name'] for r in find_duplicates([matcher], 'Muhamad Kaan')] == ['Mohammed Khan']
+    assert 'John Smith' in [r['name'] for r in matcher.search('jon')]
+    # A single word is too little of a two-word name to flag a duplicate
+    assert find_duplicates([matcher], 'jon') == []
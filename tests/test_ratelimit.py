@@ -0,0 +1,91 @@
+import pytest
+from flask import Flask, request
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import ratelimit
+from ratelimit import RateLimiter
+
+
+class Clock:
+    """Stands in for the time module, moved by hand"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    monotonic = time
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, 'time', clock)
+    return clock
+
+
+def make_app(tmp_path, backend='sqlite'):
+    app = Flask(__name__)
+    # 60 a minute (one a second), bursts of 3
+    app.config.update(RATE_LIMIT_BACKEND=backend, RATE_LIMITS={'submit_report': (60, 3)})
+    limiter = RateLimiter(app, str(tmp_path / 'ratelimit.sqlite3'))
+
+    @app.route('/reports', methods=['POST'])
+    @limiter.limit('submit_report', user=lambda request: request.get_json(silent=True)['userId'])
+    def submit():
+        return 'ok'
+
+    return app
+
+
+def submit(client, user_id, **kwargs):
+    return client.post('/reports', json={'userId': user_id}, **kwargs).status_code
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'memory'])
+def test_bucket_runs_out_and_refills(tmp_path, clock, backend):
+    client = make_app(tmp_path, backend).test_client()
+    assert [submit(client, i) for i in range(4)] == [200, 200, 200, 429]
+    response = client.post('/reports', json={'userId': 9})
+    assert response.headers['Retry-After'] == '1'
+
+    clock.now += 1
+    assert [submit(client, i) for i in range(2)] == [200, 429]
+    # Never more than the burst, however long the client waited
+    clock.now += 3600
+    assert [submit(client, i) for i in range(4)] == [200, 200, 200, 429]
+
+
+def test_user_bucket_spans_addresses(tmp_path, clock):
+    client = make_app(tmp_path).test_client()
+    codes = [submit(client, 'u1', environ_base={'REMOTE_ADDR': f'10.0.0.{i}'}) for i in range(4)]
+    assert codes == [200, 200, 200, 429]
+    assert submit(client, 'u2', environ_base={'REMOTE_ADDR': '10.0.0.9'}) == 200
+
+
+def test_sqlite_buckets_are_shared(tmp_path, clock):
+    # Two apps on one file stand for two worker processes
+    first, second = make_app(tmp_path).test_client(), make_app(tmp_path).test_client()
+    assert [submit(first, 1), submit(second, 2), submit(first, 3)] == [200, 200, 200]
+    assert submit(second, 4) == 429
+
+
+def test_forwarded_clients_get_their_own_buckets(tmp_path, clock):
+    app = make_app(tmp_path)
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
+    client = app.test_client()
+
+    def via_proxy(user_id, client_ip):
+        return submit(client, user_id, environ_base={'REMOTE_ADDR': '192.168.0.1'},
+                      headers={'X-Forwarded-For': client_ip})
+
+    assert [via_proxy(i, '203.0.113.1') for i in range(4)] == [200, 200, 200, 429]
+    assert via_proxy(9, '203.0.113.2') == 200
+
+
+def test_disabled_limits_let_everything_through(tmp_path, clock):
+    app = make_app(tmp_path)
+    app.config['RATE_LIMIT_ENABLED'] = False
+    client = app.test_client()
+    assert {submit(client, i) for i in range(10)} == {200}
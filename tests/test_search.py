@@ -0,0 +1,58 @@
+from flask import Flask, request
+
+from listing import list_response, ranked_needed
+from search import ReportSearch
+from storage import Store
+
+
+def make_app(store):
+    search = ReportSearch(store)
+    app = Flask(__name__)
+
+    @app.route('/reports')
+    def reports():
+        # As app.get_reports: rank only what the page needs, keep rank order
+        results = search.search(request.args['search'], limit=ranked_needed(request.args))
+        return list_response(results, default_sort=None, paged=True)
+
+    return app, search
+
+
+def pages(client, url):
+    """Every page of a list, following X-Next-Cursor"""
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        yield response.get_json()
+        cursor = response.headers.get('X-Next-Cursor')
+        url = cursor and f'/reports?search=river&limit=3&cursor={cursor}'
+
+
+def test_search_pages_keep_rank_order(tmp_path):
+    store = Store(str(tmp_path), fsync=False)
+    for i in range(1, 9):
+        # Odd ids match on the name, which outweighs a location match
+        field = 'name' if i % 2 else 'location'
+        store.reports.put({'id': i, field: f'Riverside {i}'})
+    store.reports.put({'id': 20, 'name': 'Hill'})
+    app, search = make_app(store)
+
+    seen = [[r['id'] for r in page] for page in pages(app.test_client(), '/reports?search=river&limit=3')]
+    assert [len(page) for page in seen] == [3, 3, 2]
+    ids = [i for page in seen for i in page]
+    assert ids == [r['id'] for r in search.search('river')]
+    assert set(ids[:4]) == {1, 3, 5, 7}
+
+
+def test_search_follows_store_changes(tmp_path):
+    store = Store(str(tmp_path), fsync=False)
+    store.reports.put({'id': 1, 'name': 'José Álvarez', 'location': 'Pune'})
+    app, search = make_app(store)
+    client = app.test_client()
+
+    assert [r['id'] for r in client.get('/reports?search=jose alv').get_json()] == [1]
+    store.reports.update(1, {'name': 'Ravi'})
+    assert client.get('/reports?search=jose').get_json() == []
+    assert [r['id'] for r in client.get('/reports?search=rav pun').get_json()] == [1]
+    store.reports.delete(1)
+    assert client.get('/reports?search=ravi').get_json() == []
@@ -0,0 +1,75 @@
+from flask import Flask, session
+
+from sessions import SqliteSessionInterface
+
+COOKIE = 'session'
+
+
+def make_app(tmp_path):
+    app = Flask(__name__)
+    app.session_interface = SqliteSessionInterface(str(tmp_path / 'sessions.sqlite3'))
+
+    @app.route('/visit')
+    def visit():
+        session['visits'] = session.get('visits', 0) + 1
+        return str(session['visits'])
+
+    @app.route('/login/<int:user_id>')
+    def login(user_id):
+        session['user_id'] = user_id
+        return 'ok'
+
+    @app.route('/whoami')
+    def whoami():
+        return str(session.get('user_id'))
+
+    @app.route('/logout')
+    def logout():
+        session.clear()
+        return 'ok'
+
+    return app
+
+
+def sid(client):
+    cookie = client.get_cookie(COOKIE)
+    return cookie and cookie.value
+
+
+def test_session_is_shared_between_workers(tmp_path):
+    client = make_app(tmp_path).test_client()
+    client.get('/visit')
+    other = make_app(tmp_path).test_client()
+    other.set_cookie(COOKIE, sid(client))
+    assert other.get('/visit').text == '2'
+
+
+def test_login_rotates_the_session_id(tmp_path):
+    app = make_app(tmp_path)
+    client = app.test_client()
+    client.get('/visit')
+    before = sid(client)
+    client.get('/login/7')
+    after = sid(client)
+    assert after and after != before
+    # The session's data moves to the new id, and the old id is dead
+    assert client.get('/visit').text == '2'
+    attacker = app.test_client()
+    attacker.set_cookie(COOKIE, before)
+    assert attacker.get('/whoami').text == 'None'
+
+    # Writes that keep the identity keep the id
+    client.get('/visit')
+    assert sid(client) == after
+
+
+def test_logout_ends_the_session(tmp_path):
+    app = make_app(tmp_path)
+    client = app.test_client()
+    client.get('/login/7')
+    old = sid(client)
+    client.get('/logout')
+    assert sid(client) is None
+    replay = app.test_client()
+    replay.set_cookie(COOKIE, old)
+    assert replay.get('/whoami').text == 'None'
@@ -0,0 +1,105 @@
+import glob
+import json
+import multiprocessing
+import os
+
+import pytest
+
+from storage import Store
+
+WORKERS = 4
+WRITES = 60
+
+
+def writer(data_dir, worker, snapshot_format):
+    store = Store(data_dir, compact_every=7, fsync=False, snapshot_format=snapshot_format)
+    for i in range(WRITES):
+        store.reports.put({'id': worker * 1000 + i, 'worker': worker})
+        with store.transaction():
+            counter = store.users.get(1)
+            store.users.put({'id': 1, 'count': counter['count'] + 1})
+
+
+@pytest.mark.parametrize('snapshot_format', ['json', 'binary'])
+def test_concurrent_writers_lose_nothing(tmp_path, snapshot_format):
+    data_dir = str(tmp_path)
+    store = Store(data_dir, fsync=False, snapshot_format=snapshot_format)
+    store.users.put({'id': 1, 'count': 0})
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=writer, args=(data_dir, w, snapshot_format)) for w in range(WORKERS)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+        assert p.exitcode == 0
+
+    # Compactions ran while the others appended, so both the live store and a
+    # fresh load have to agree on every write
+    store.refresh()
+    expected = {w * 1000 + i for w in range(WORKERS) for i in range(WRITES)}
+    for s in (store, Store(data_dir, fsync=False, snapshot_format=snapshot_format)):
+        assert set(s.reports.records) == expected
+        assert s.users.get(1)['count'] == WORKERS * WRITES
+
+
+def test_failed_transaction_is_undone(tmp_path):
+    store = Store(str(tmp_path), fsync=False)
+    store.reports.put({'id': 1, 'name': 'a'})
+    store.reports.put({'id': 2, 'name': 'b'})
+    version = store.reports.version
+
+    with pytest.raises(RuntimeError):
+        with store.transaction():
+            store.reports.delete(1)
+            store.reports.update(2, {'name': 'changed'})
+            store.reports.put({'id': 3, 'name': 'c'})
+            raise RuntimeError
+
+    with store.transaction():
+        store.reports.put({'id': 4, 'name': 'd'})
+        with pytest.raises(KeyError):
+            with store.transaction():
+                store.reports.delete(4)
+                raise KeyError(4)
+
+    expected = {1: 'a', 2: 'b', 4: 'd'}
+    assert {r['id']: r['name'] for r in store.reports} == expected
+    assert store.reports.version == version + 1
+    reloaded = Store(str(tmp_path), fsync=False)
+    assert {r['id']: r['name'] for r in reloaded.reports} == expected
+
+
+def contents(store):
+    # A collection never written to takes its modified time from the file
+    # it was loaded from, so that is only compared for the others
+    return {name: ({r['id']: r for r in c}, c.version, c.modified if c.version else None)
+            for name, c in store.collections.items()}
+
+
+def test_snapshot_format_round_trip(tmp_path):
+    data_dir = str(tmp_path)
+    store = Store(data_dir, fsync=False)
+    store.reports.put({'id': 1, 'name': 'José Ñúñez', 'lat': None, 'tags': ['a', {'b': 1.5}]})
+    store.reports.put({'id': 2, 'name': '山田 太郎', 'age': 0})
+    store.users.put({'id': 1, 'user_id': 'admin', 'password': 'x'})
+    store.compact()
+    # Entries still in the log are folded into the converted snapshot too
+    store.reports.update(2, {'age': 7})
+    store.pending_info.put({'id': 3, 'info': 'seen\nnear the "station"'})
+    store.reports.delete(1)
+    store.reports.put({'id': 1, 'name': 'back'})
+    expected = contents(store)
+
+    store.snapshot_format = 'binary'
+    store.compact()
+    assert glob.glob(os.path.join(data_dir, 'store.*.snap'))
+    # Either format loads whichever snapshot was written last
+    for snapshot_format in ('json', 'binary'):
+        assert contents(Store(data_dir, fsync=False, snapshot_format=snapshot_format)) == expected
+
+    store = Store(data_dir, fsync=False, snapshot_format='json')
+    store.compact()
+    assert not glob.glob(os.path.join(data_dir, 'store.*.snap'))
+    assert contents(Store(data_dir, fsync=False)) == expected
+    with open(os.path.join(data_dir, 'reports.json')) as f:
+        assert {r['id']: r for r in json.load(f)} == expected['reports'][0]
@@ -0,0 +1,71 @@
+import hashlib
+import io
+import os
+
+import pytest
+from flask import Flask, jsonify, request
+
+from blobs import BlobStore
+from uploads import Uploads
+
+PNG = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 8
+
+
+def make_app(tmp_path, **config):
+    app = Flask(__name__)
+    app.config.update({'MAX_UPLOAD_SIZE': 4096, 'MAX_CONTENT_LENGTH': 64 * 1024, **config})
+    blobs = BlobStore(str(tmp_path / 'blobs'))
+    uploads = Uploads(app, blobs)
+
+    @app.route('/upload', methods=['POST'])
+    def upload():
+        return jsonify({'image_id': uploads.save(request.files['photo'])})
+
+    return app, uploads
+
+
+def post(app, data, name='photo.png'):
+    return app.test_client().post('/upload', data={'photo': (io.BytesIO(data), name)},
+                                  content_type='multipart/form-data')
+
+
+def spooled(uploads):
+    return os.listdir(uploads.tmp_dir)
+
+
+def test_upload_lands_in_blob_store(tmp_path):
+    app, uploads = make_app(tmp_path)
+    response = post(app, PNG)
+    assert response.status_code == 200
+    digest = response.get_json()['image_id']
+    assert digest == hashlib.sha256(PNG).hexdigest()
+    with open(uploads.blobs.path(digest), 'rb') as f:
+        assert f.read() == PNG
+    assert spooled(uploads) == []
+    assert uploads.limiter.active == 0 and uploads.limiter.bytes == 0
+
+
+@pytest.mark.parametrize('data, status', [
+    (PNG + b'\0' * 4096, 413),                 # over MAX_UPLOAD_SIZE
+    (b'%PDF-1.7\n' + b'\0' * 100, 415),        # not an image
+    (b'GIF8', 415),                            # too short to be one, checked on rewind
+])
+def test_rejected_upload_leaves_nothing_behind(tmp_path, data, status):
+    app, uploads = make_app(tmp_path)
+    response = post(app, data, 'photo.png')
+    assert response.status_code == status
+    assert spooled(uploads) == []
+    assert uploads.limiter.active == 0 and uploads.limiter.bytes == 0
+
+
+def test_request_body_limit(tmp_path):
+    app, uploads = make_app(tmp_path, MAX_UPLOAD_SIZE=1024 * 1024)
+    assert post(app, PNG + b'\0' * 64 * 1024).status_code == 413
+    assert spooled(uploads) == []
+
+
+def test_spool_budget_answers_503(tmp_path):
+    app, uploads = make_app(tmp_path, MAX_SPOOL_BYTES=1024)
+    assert post(app, PNG).status_code == 503
+    assert spooled(uploads) == []
+    assert uploads.limiter.active == 0 and uploads.limiter.bytes == 0
@@ -0,0 +1,169 @@
+"""Streaming handling of multipart file uploads.
+
+Werkzeug normally buffers small uploads in memory and hands the app a file to
+read again. Here every file part is written chunk by chunk to a spool file in
+the blob store's tmp directory while its sha256 is computed and its leading
+bytes are checked against the allowed image types. Saving an upload is then a
+rename into the blob store, with no second read or copy, and memory per upload
+stays at Werkzeug's parse buffer whatever the file size.
+
+Limits, from app.config:
+
+    MAX_CONTENT_LENGTH       whole request body (Flask/Werkzeug enforce it)
+    MAX_UPLOAD_SIZE          one file
+    MAX_CONCURRENT_UPLOADS   files being received at once by this process
+    MAX_SPOOL_BYTES          bytes spooled at once by this process
+
+Going over a size limit answers 413, an unsupported file type 415 and a full
+upload budget 503.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge, ServiceUnavailable, UnsupportedMediaType
+
+from blobs import sniff_mimetype
+
+DEFAULTS = {
+    'MAX_CONTENT_LENGTH': 20 * 1024 * 1024,
+    'MAX_UPLOAD_SIZE': 16 * 1024 * 1024,
+    'MAX_CONCURRENT_UPLOADS': 16,
+    'MAX_SPOOL_BYTES': 256 * 1024 * 1024,
+}
+ALLOWED_MIMETYPES = {'image/png', 'image/jpeg', 'image/gif', 'image/webp'}
+# enough leading bytes to recognise every allowed type
+MAGIC_SIZE = 12
+
+
+class UploadLimiter:
+    """Per-process budget of concurrent uploads and spooled bytes"""
+
+    def __init__(self, max_concurrent, max_bytes):
+        self.max_concurrent = max_concurrent
+        self.max_bytes = max_bytes
+        self.active = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.active >= self.max_concurrent:
+                raise ServiceUnavailable('Too many uploads in progress, try again shortly')
+            self.active += 1
+
+    def release(self, size):
+        with self.lock:
+            self.active -= 1
+            self.bytes -= size
+
+    def reserve(self, size):
+        with self.lock:
+            if self.bytes + size > self.max_bytes:
+                raise ServiceUnavailable('Upload capacity exhausted, try again shortly')
+            self.bytes += size
+
+
+class SpooledUpload:
+    """Write-once spool file that hashes and type-checks data as it arrives"""
+
+    def __init__(self, tmp_dir, max_size, limiter):
+        self.max_size = max_size
+        self.limiter = limiter
+        self.size = 0
+        self.head = b''
+        self.checked = False
+        self.sha = hashlib.sha256()
+        self.adopted = False
+        limiter.acquire()
+        fd, self.path = tempfile.mkstemp(dir=tmp_dir, suffix='.upload')
+        self.file = os.fdopen(fd, 'w+b')
+
+    def write(self, data):
+        if self.size + len(data) > self.max_size:
+            raise RequestEntityTooLarge(f'Files may be at most {self.max_size // (1024 * 1024)} MB')
+        self.limiter.reserve(len(data))
+        self.size += len(data)
+        if not self.checked:
+            self.head += data[:MAGIC_SIZE - len(self.head)]
+            if len(self.head) >= MAGIC_SIZE:
+                self._check_type()
+        self.sha.update(data)
+        return self.file.write(data)
+
+    def _check_type(self):
+        self.checked = True
+        if self.mimetype not in ALLOWED_MIMETYPES:
+            raise UnsupportedMediaType('Photos must be PNG, JPEG, GIF or WebP images')
+
+    @property
+    def mimetype(self):
+        return sniff_mimetype(self.head)
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+    def seek(self, *args):
+        # Werkzeug rewinds once the part is complete; tiny files get checked here
+        if not self.checked and self.size:
+            self._check_type()
+        return self.file.seek(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def save_to(self, blobs):
+        """Move the spooled file into the blob store, returning its digest"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        digest = blobs.adopt(self.path, self.hexdigest())
+        self.adopted = True
+        return digest
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        if not self.adopted and os.path.exists(self.path):
+            os.remove(self.path)
+        self.limiter.release(self.size)
+
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        uploads = current_app.extensions['uploads']
+        spool = SpooledUpload(uploads.tmp_dir, current_app.config['MAX_UPLOAD_SIZE'], uploads.limiter)
+        # Kept here too, since a rejected upload never reaches request.files
+        self.__dict__.setdefault('spools', []).append(spool)
+        return spool
+
+    def close(self):
+        super().close()
+        for spool in self.__dict__.get('spools', ()):
+            spool.close()
+
+
+class Uploads:
+    """Installs UploadRequest on a Flask app, spooling into a blob store"""
+
+    def __init__(self, app, blobs):
+        for key, value in DEFAULTS.items():
+            app.config.setdefault(key, value)
+        if app.config['MAX_CONTENT_LENGTH'] is None:
+            app.config['MAX_CONTENT_LENGTH'] = DEFAULTS['MAX_CONTENT_LENGTH']
+        self.blobs = blobs
+        self.tmp_dir = blobs.tmp_dir
+        self.limiter = UploadLimiter(app.config['MAX_CONCURRENT_UPLOADS'], app.config['MAX_SPOOL_BYTES'])
+        app.request_class = UploadRequest
+        app.extensions['uploads'] = self
+
+    def save(self, file):
+        """Store an uploaded FileStorage in the blob store, returning its digest"""
+        if isinstance(file.stream, SpooledUpload):
+            return file.stream.save_to(self.blobs)
+        return self.blobs.put_file(file.stream)